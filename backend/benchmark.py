@@ -0,0 +1,1130 @@
+#!/usr/bin/env python3
+"""
+InventoryLens AI Backend Benchmarks
+
+Purpose:
+---------
+Measures the backend's hot paths locally, without calling the HuggingFace API:
+- preprocess: per-image CPU time and peak memory of decode -> resize -> encode,
+  comparing full-frame decoding with JPEG draft-mode decoding
+- uploads: peak memory while concurrent oversized and phone-sized uploads hit
+  /detect; exits non-zero when it passes the --max-rss-mb budget
+- postprocess: score filtering, class-aware NMS and label counting at 1k+
+  candidate detections, comparing the original per-detection Python loop, a
+  pure-Python NMS and the array-backed filter_detections
+- serialize: encode time and body size, raw and gzipped, of a /detect
+  response at dense-scene detection counts, comparing FastAPI's default
+  encoder with orjson, the compact format and ?fields=object_counts
+- tiling: recall, precision and latency on a synthetic wide shelf photo of
+  small items, comparing one downscaled upstream call with tiled detection at
+  several tile sizes and overlaps, against a simulated detector that cannot
+  see objects below --min-object-px
+- live: detector calls, dropped frames and result latency of a camera
+  streaming frames over /ws/live, with and without frame differencing,
+  against POSTing every frame to /detect
+- history: batched insert rate into the SQLite analysis history and the
+  latency of history pages and per-label aggregates at --rows analyses
+- startup: time from launch to the first answered request and to the first
+  detection, and per-worker RSS/PSS, for single- and multi-worker Uvicorn
+  and preloaded Gunicorn, plus how many in-flight detections finish when
+  the server is told to stop
+- detectors: /detect throughput and latency with the HuggingFace client
+  (against stub_detection_server.py at the production rate limit) and
+  with the in-process ONNX Runtime engine at several micro-batch sizes
+- load: req/s, latency percentiles, CPU and RSS of a real uvicorn backend
+  driven at a fixed concurrency, with stub_detection_server.py standing in
+  for the HuggingFace API (or against --target for an already running backend)
+
+For preprocess, each variant runs in its own subprocess, and peak memory is
+the RSS growth while one image is processed.
+
+Run this with: `python benchmark.py preprocess --repeat 5`
+          or: `python benchmark.py uploads --concurrency 8`
+          or: `python benchmark.py postprocess --detections 1000 5000`
+          or: `python benchmark.py serialize --detections 100 1000 5000`
+          or: `python benchmark.py tiling --width 6000 --height 1500`
+          or: `python benchmark.py live --fps 10 --seconds 20`
+          or: `python benchmark.py history --rows 1000000`
+          or: `python benchmark.py startup --workers 4`
+          or: `python benchmark.py detectors --model models/detr-resnet-50/model.onnx`
+          or: `python benchmark.py load --concurrency 16 --requests 400`
+"""
+
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# phone, compact-camera, HD and thumbnail resolutions seen in shelf photos
+CORPUS_SIZES = [(4032, 3024), (3264, 2448), (1920, 1080), (640, 480)]
+
+def make_corpus(directory, sizes=CORPUS_SIZES):
+    """Write one synthetic JPEG per size with enough texture to compress like a real photo."""
+    from PIL import Image
+
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for width, height in sizes:
+        path = directory / f"corpus_{width}x{height}.jpg"
+        if not path.exists():
+            noise = Image.effect_noise((width, height), 48)
+            gradient = Image.linear_gradient("L").resize((width, height))
+            image = Image.merge("RGB", (noise, gradient, Image.blend(noise, gradient, 0.5)))
+            image.save(path, format="JPEG", quality=92)
+        paths.append(path)
+    return paths
+
+def _proc_status_mb(field):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) / 1024
+    raise KeyError(field)
+
+def reset_peak_rss():
+    """Reset the kernel's high-water mark so the next peak reading covers only the code that follows.
+
+    Returns the current RSS in MB, or None where /proc is unavailable; the
+    caller then falls back to the process-wide ru_maxrss.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return _proc_status_mb("VmRSS")
+    except OSError:
+        return None
+
+def peak_rss_mb():
+    try:
+        return _proc_status_mb("VmHWM")
+    except (OSError, KeyError):
+        # ru_maxrss is reported in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def preprocess_worker(args):
+    from main import prepare_image
+
+    corpus = [Path(p).read_bytes() for p in args.corpus]
+    use_draft = args.variant == "draft"
+    prepare_image(corpus[-1], use_draft=use_draft, allow_passthrough=False)  # warm up codecs outside the measurement
+    cpu_ms = {}
+    peak_delta_mb = {}
+    for path, data in zip(args.corpus, corpus):
+        cpu_times = []
+        peak_delta = 0.0
+        for _ in range(args.repeat):
+            rss_before = reset_peak_rss()
+            start = time.process_time()
+            prepare_image(data, use_draft=use_draft, allow_passthrough=False)
+            cpu_times.append(time.process_time() - start)
+            if rss_before is not None:
+                peak_delta = max(peak_delta, peak_rss_mb() - rss_before)
+        name = Path(path).name
+        cpu_ms[name] = sum(cpu_times) / len(cpu_times) * 1000
+        peak_delta_mb[name] = peak_delta
+    print(json.dumps({"cpu_ms": cpu_ms, "peak_delta_mb": peak_delta_mb, "peak_rss_mb": peak_rss_mb()}))
+
+def run_preprocess(args):
+    corpus_dir = args.corpus_dir or os.path.join(tempfile.gettempdir(), "inventorylens-corpus")
+    corpus = [str(p) for p in make_corpus(corpus_dir)]
+    reports = {}
+    for variant in ("full_decode", "draft"):
+        output = subprocess.run(
+            [sys.executable, __file__, "_preprocess_worker", "--variant", variant,
+             "--repeat", str(args.repeat), *corpus],
+            check=True, capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout
+        reports[variant] = json.loads(output.strip().splitlines()[-1])
+
+    full, draft = reports["full_decode"], reports["draft"]
+    print(f"{'image':<24}{'CPU full (ms)':>15}{'CPU draft (ms)':>16}{'peak full (MB)':>16}{'peak draft (MB)':>17}")
+    for name, full_ms in full["cpu_ms"].items():
+        print(f"{name:<24}{full_ms:>15.1f}{draft['cpu_ms'][name]:>16.1f}"
+              f"{full['peak_delta_mb'][name]:>16.1f}{draft['peak_delta_mb'][name]:>17.1f}")
+
+async def multipart_stream(filename, content_type, chunk, chunk_count):
+    """Yield a one-file multipart body without holding it in memory; the same chunk is repeated."""
+    boundary = "inventorylens-benchmark"
+    yield (f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"{filename}\"\r\n"
+           f"Content-Type: {content_type}\r\n\r\n").encode()
+    for _ in range(chunk_count):
+        yield chunk
+    yield f"\r\n--{boundary}--\r\n".encode()
+
+async def drive_uploads(args):
+    import httpx
+    import main as backend
+
+    async def stub_detection(request):
+        return httpx.Response(200, json=[])
+
+    backend.detector._client = httpx.AsyncClient(transport=httpx.MockTransport(stub_detection))
+    backend.upstream_scheduler = backend.UpstreamScheduler(rate=0)
+    phone_jpeg = make_corpus(args.corpus_dir or os.path.join(tempfile.gettempdir(), "inventorylens-corpus"))[0].read_bytes()
+    junk_chunk = os.urandom(1024 * 1024)
+    headers = {"Content-Type": "multipart/form-data; boundary=inventorylens-benchmark"}
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=backend.app), base_url="http://benchmark") as client:
+        async def oversized():
+            body = multipart_stream("huge.jpg", "image/jpeg", junk_chunk, args.oversized_mb)
+            return (await client.post("/detect", content=body, headers=headers, timeout=None)).status_code
+
+        async def phone_photo():
+            files = {"file": ("phone.jpg", phone_jpeg, "image/jpeg")}
+            return (await client.post("/detect", files=files, timeout=None)).status_code
+
+        rss_before = reset_peak_rss()
+        statuses = await asyncio.gather(*[oversized() for _ in range(args.concurrency)],
+                                        *[phone_photo() for _ in range(args.concurrency)])
+        return statuses, peak_rss_mb() - (rss_before or 0.0)
+
+def run_uploads(args):
+    statuses, peak_delta = asyncio.run(drive_uploads(args))
+    oversized, accepted = statuses[:args.concurrency], statuses[args.concurrency:]
+    print(f"{args.concurrency} x {args.oversized_mb} MB uploads: statuses {sorted(set(oversized))}")
+    print(f"{args.concurrency} x phone photo uploads: statuses {sorted(set(accepted))}")
+    print(f"peak RSS growth: {peak_delta:.1f} MB (budget {args.max_rss_mb} MB)")
+    if set(oversized) != {413} or set(accepted) != {200} or peak_delta > args.max_rss_mb:
+        sys.exit(1)
+
+def synthetic_detections(count, seed=0):
+    """Dense-shelf candidates: items in a grid, each reported several times with jittered boxes like DETR does."""
+    import random
+
+    rng = random.Random(seed)
+    labels = ["bottle", "cup", "can", "box", "jar", "book"]
+    detections = []
+    while len(detections) < count:
+        col, row = rng.randrange(40), rng.randrange(12)
+        label = labels[(col + row) % len(labels)]
+        xmin, ymin = col * 50, row * 120
+        for _ in range(rng.randint(1, 4)):
+            jitter = [rng.randint(-6, 6) for _ in range(4)]
+            detections.append({
+                "score": round(rng.uniform(0.05, 0.99), 4),
+                "label": label,
+                "box": {"xmin": xmin + jitter[0], "ymin": ymin + jitter[1],
+                        "xmax": xmin + 45 + jitter[2], "ymax": ymin + 110 + jitter[3]},
+            })
+    return detections[:count]
+
+def legacy_filter(detections, threshold=0.3):
+    # the post-processing loop detect_objects/full_analysis used before it was vectorized
+    object_counts = {}
+    filtered_detections = []
+    for detection in detections:
+        if isinstance(detection, dict) and detection.get("score", 0) > threshold:
+            label = detection.get("label", "unknown")
+            object_counts[label] = object_counts.get(label, 0) + 1
+            filtered_detections.append({
+                "label": label,
+                "confidence": round(detection.get("score", 0), 3),
+                "box": detection.get("box", {})
+            })
+    return filtered_detections, object_counts
+
+def python_nms_filter(detections, threshold=0.3, iou_threshold=0.6):
+    """Reference greedy class-aware NMS written as plain Python loops."""
+    candidates = sorted((d for d in detections if d.get("score", 0) > threshold), key=lambda d: -d["score"])
+    kept = []
+    for detection in candidates:
+        box = detection["box"]
+        area = (box["xmax"] - box["xmin"]) * (box["ymax"] - box["ymin"])
+        suppressed = False
+        for other in kept:
+            if other["label"] != detection["label"]:
+                continue
+            ob = other["box"]
+            inter_w = max(0, min(box["xmax"], ob["xmax"]) - max(box["xmin"], ob["xmin"]))
+            inter_h = max(0, min(box["ymax"], ob["ymax"]) - max(box["ymin"], ob["ymin"]))
+            intersection = inter_w * inter_h
+            other_area = (ob["xmax"] - ob["xmin"]) * (ob["ymax"] - ob["ymin"])
+            if intersection / max(area + other_area - intersection, 1e-9) > iou_threshold:
+                suppressed = True
+                break
+        if not suppressed:
+            kept.append(detection)
+    object_counts = {}
+    for detection in kept:
+        object_counts[detection["label"]] = object_counts.get(detection["label"], 0) + 1
+    return kept, object_counts
+
+def run_postprocess(args):
+    from main import filter_detections
+
+    def best_of(func, detections):
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            result = func(detections)
+            timings.append(time.perf_counter() - start)
+        return min(timings) * 1000, result
+
+    print(f"{'candidates':>10}{'loop, no NMS':>16}{'python NMS':>14}{'vectorized NMS':>17}{'kept':>7}{'loop count':>12}")
+    for count in args.detections:
+        detections = synthetic_detections(count)
+        loop_ms, (_, loop_counts) = best_of(legacy_filter, detections)
+        python_ms, (python_kept, _) = best_of(lambda d: python_nms_filter(d, iou_threshold=args.iou), detections)
+        vector_ms, result = best_of(lambda d: filter_detections(d, 0.3, args.iou, len(d)), detections)
+        if result["total_objects"] != len(python_kept):
+            print(f"warning: vectorized kept {result['total_objects']} boxes, python reference kept {len(python_kept)}")
+        print(f"{count:>10}{loop_ms:>14.2f}ms{python_ms:>12.2f}ms{vector_ms:>15.2f}ms"
+              f"{result['total_objects']:>7}{sum(loop_counts.values()):>12}")
+
+def run_serialize(args):
+    import gzip
+
+    from fastapi.encoders import jsonable_encoder
+    from fastapi.responses import JSONResponse
+    from main import GZIP_LEVEL, ResponseOptions, filter_detections
+
+    def best_of(func):
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            body = func()
+            timings.append(time.perf_counter() - start)
+        return min(timings) * 1000, body
+
+    variants = {
+        # what a route returning a dict got: jsonable_encoder walks the result, then json.dumps renders it
+        "default": lambda content: JSONResponse(jsonable_encoder(content)).body,
+        "orjson": lambda content: ResponseOptions("full", None).respond(content).body,
+        "compact": lambda content: ResponseOptions("compact", None).respond(content).body,
+        "fields": lambda content: ResponseOptions("full", "object_counts").respond(content).body,
+    }
+    print(f"{'detections':>10}{'variant':>10}{'encode':>11}{'bytes':>10}{'gzip bytes':>12}{'gzip':>10}")
+    for count in args.detections:
+        # NMS off so every candidate survives, as on a densely stocked shelf
+        result = filter_detections(synthetic_detections(count), 0.0, 1.0, count)
+        content = {**result, "cached": False, "payload": {"format": "json", "passthrough": False, "bytes": 240000, "encode_ms": 9.1}}
+        for name, render in variants.items():
+            encode_ms, body = best_of(lambda: render(content))
+            gzip_ms, compressed = best_of(lambda: gzip.compress(body, GZIP_LEVEL))
+            print(f"{count:>10}{name:>10}{encode_ms:>9.2f}ms{len(body):>10}{len(compressed):>12}{gzip_ms:>8.2f}ms")
+
+SHELF_COLORS = {"bottle": (200, 30, 30), "can": (30, 160, 40), "box": (40, 60, 200), "jar": (210, 180, 20)}
+
+def make_shelf(width, height, item_px, seed=0):
+    """A gray shelf with rows of small colored items; returns the JPEG and the ground-truth boxes."""
+    import io
+    import random
+    from PIL import Image, ImageDraw
+
+    rng = random.Random(seed)
+    image = Image.new("RGB", (width, height), (128, 128, 128))
+    draw = ImageDraw.Draw(image)
+    truth = []
+    pitch = int(item_px * 1.6)
+    for y in range(pitch // 2, height - item_px * 2, int(item_px * 2.6)):
+        for x in range(rng.randint(0, pitch // 2), width - item_px, pitch):
+            label = rng.choice(list(SHELF_COLORS))
+            w, h = rng.randint(item_px * 3 // 4, item_px), rng.randint(item_px, item_px * 2)
+            draw.rectangle([x, y, x + w - 1, y + h - 1], fill=SHELF_COLORS[label])
+            truth.append((label, x, y, x + w, y + h))
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=92)
+    return buffer.getvalue(), truth
+
+def find_runs(mask):
+    # (start, end) of every run of True values
+    padded = [False, *mask.tolist(), False]
+    edges = [i - 1 for i in range(1, len(padded)) if padded[i] != padded[i - 1]]
+    return list(zip(edges[::2], edges[1::2]))
+
+def simulated_detections(jpeg_bytes, min_object_px):
+    """Find the colored items in one upstream image the way a detector with a minimum object size would."""
+    import io
+    import numpy as np
+    from PIL import Image
+
+    pixels = np.asarray(Image.open(io.BytesIO(jpeg_bytes)).convert("RGB"), dtype=np.int16)
+    height, width, _ = pixels.shape
+    saturated = pixels.max(axis=2) - pixels.min(axis=2) > 60
+    detections = []
+    # shelf rows are separated by gray bands, and items within a row by gray gaps
+    for band_y0, band_y1 in find_runs(saturated.any(axis=1)):
+        for x0, x1 in find_runs(saturated[band_y0:band_y1].any(axis=0)):
+            rows = saturated[band_y0:band_y1, x0:x1].any(axis=1).nonzero()[0]
+            y0, y1 = band_y0 + int(rows[0]), band_y0 + int(rows[-1]) + 1
+            if x1 - x0 < min_object_px or y1 - y0 < min_object_px:
+                continue
+            mean = pixels[y0:y1, x0:x1][saturated[y0:y1, x0:x1]].mean(axis=0)
+            label = min(SHELF_COLORS, key=lambda name: sum((mean - SHELF_COLORS[name]) ** 2))
+            # an item cut by the image border looks like a partial object to the model
+            clipped = x0 == 0 or y0 == 0 or x1 == width or y1 == height
+            detections.append({
+                "score": 0.55 if clipped else 0.9,
+                "label": label,
+                "box": {"xmin": x0, "ymin": y0, "xmax": x1, "ymax": y1},
+            })
+    return detections
+
+def match_truth(detections, truth, scale, iou_threshold=0.5):
+    matched, true_positives = set(), 0
+    for detection in detections:
+        box = [value * scale for value in (detection["box"]["xmin"], detection["box"]["ymin"],
+                                           detection["box"]["xmax"], detection["box"]["ymax"])]
+        best, best_iou = None, iou_threshold
+        for index, (label, *item) in enumerate(truth):
+            if index in matched or label != detection["label"]:
+                continue
+            inter_w = max(0, min(box[2], item[2]) - max(box[0], item[0]))
+            inter_h = max(0, min(box[3], item[3]) - max(box[1], item[1]))
+            intersection = inter_w * inter_h
+            union = (box[2] - box[0]) * (box[3] - box[1]) + (item[2] - item[0]) * (item[3] - item[1]) - intersection
+            if intersection / union >= best_iou:
+                best, best_iou = index, intersection / union
+        if best is not None:
+            matched.add(best)
+            true_positives += 1
+    return true_positives
+
+async def drive_tiling(args):
+    import httpx
+    import main as backend
+    import stub_detection_server as stub
+
+    shelf_jpeg, truth = make_shelf(args.width, args.height, args.item_px)
+    calls = {"count": 0}
+
+    async def simulated_detector(request):
+        calls["count"] += 1
+        # read the body and threshold the way the Inference API (and the stub server) does
+        image_bytes, threshold = stub.parse_request(request.content, request.headers.get("content-type", ""))
+        detections = await asyncio.to_thread(simulated_detections, image_bytes, args.min_object_px)
+        detections = [d for d in detections if d["score"] >= threshold]
+        await asyncio.sleep(args.latency_ms / 1000)
+        return httpx.Response(200, json=detections)
+
+    backend.detector._client = httpx.AsyncClient(transport=httpx.MockTransport(simulated_detector))
+    backend.upstream_scheduler = backend.UpstreamScheduler(rate=0)
+    backend.detection_cache = backend.DetectionCache(max_entries=0, directory="")
+    variants = [("downscaled", "")] + [
+        (f"tiled {size}px / {overlap:.0%}", f"&tiled=true&tile_size={size}&tile_overlap={overlap}")
+        for size in args.tile_sizes for overlap in args.overlaps
+    ]
+    reports = []
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=backend.app), base_url="http://benchmark") as client:
+        for name, query in variants:
+            calls["count"] = 0
+            start = time.perf_counter()
+            response = await client.post(f"/analyze?max_detections=5000{query}", timeout=None,
+                                         files={"file": ("shelf.jpg", shelf_jpeg, "image/jpeg")})
+            elapsed = time.perf_counter() - start
+            body = response.json()
+            detections = body["object_detection"]["detections"]
+            scale = args.width / body["image_info"]["size"][0]
+            true_positives = match_truth(detections, truth, scale)
+            reports.append({
+                "variant": name,
+                "upstream_calls": calls["count"],
+                "latency_ms": elapsed * 1000,
+                "counted": len(detections),
+                "recall": true_positives / len(truth),
+                "precision": true_positives / max(len(detections), 1),
+            })
+    return truth, reports
+
+def run_tiling(args):
+    truth, reports = asyncio.run(drive_tiling(args))
+    print(f"{args.width}x{args.height} shelf, {len(truth)} items of ~{args.item_px}px, "
+          f"detector misses objects under {args.min_object_px}px, {args.latency_ms:.0f} ms per call")
+    print(f"{'variant':<22}{'calls':>7}{'latency':>11}{'counted':>9}{'recall':>8}{'precision':>11}")
+    for r in reports:
+        print(f"{r['variant']:<22}{r['upstream_calls']:>7}{r['latency_ms']:>9.0f}ms{r['counted']:>9}"
+              f"{r['recall']:>8.1%}{r['precision']:>11.1%}")
+
+def camera_frames(count, change_every, width=1280, height=720, seed=0):
+    """A fixed camera on a shelf: sensor noise on every frame and one item taken away every change_every frames."""
+    import io
+    import numpy as np
+    from PIL import Image
+
+    shelf_jpeg, truth = make_shelf(width, height, 40, seed)
+    scene = np.asarray(Image.open(io.BytesIO(shelf_jpeg)).convert("RGB"), dtype=np.int16)
+    rng = np.random.default_rng(seed)
+    frames = []
+    for i in range(count):
+        if i and i % change_every == 0 and truth:
+            _, x0, y0, x1, y1 = truth.pop(rng.integers(len(truth)))
+            scene[y0:y1, x0:x1] = 128
+        noisy = np.clip(scene + rng.normal(0, 4, scene.shape), 0, 255).astype(np.uint8)
+        buffer = io.BytesIO()
+        Image.fromarray(noisy).save(buffer, format="JPEG", quality=85)
+        frames.append(buffer.getvalue())
+    return frames
+
+async def stream_frames(base_url, frames, args, min_change):
+    import websockets
+
+    sent_at = {}
+    results = Counter()
+    latencies = []
+    url = base_url.replace("http://", "ws://") + f"/ws/live?min_change={min_change}"
+    async with websockets.connect(url, max_size=None) as websocket:
+        async def send():
+            start = time.perf_counter()
+            for index, frame in enumerate(frames, 1):
+                await asyncio.sleep(max(0.0, start + index / args.fps - time.perf_counter()))
+                sent_at[index] = time.perf_counter()
+                await websocket.send(frame)
+
+        sender = asyncio.create_task(send())
+        accounted = 0
+        while accounted < len(frames):
+            message = json.loads(await websocket.recv())
+            latencies.append(time.perf_counter() - sent_at[message["frame"]])
+            results["dropped"] += message["dropped"]
+            results["errors" if message["type"] == "error" else "reused" if message["reused"] else "detected"] += 1
+            accounted += 1 + message["dropped"]
+        await sender
+    return results, sorted(latencies)
+
+async def post_frames(base_url, frames, args):
+    import httpx
+
+    results = Counter()
+    latencies = []
+    async with httpx.AsyncClient(base_url=base_url, timeout=300.0) as client:
+        async def post(frame):
+            start = time.perf_counter()
+            response = await client.post("/detect", files={"file": ("frame.jpg", frame, "image/jpeg")})
+            latencies.append(time.perf_counter() - start)
+            results["detected" if response.status_code == 200 else "errors"] += 1
+
+        tasks = []
+        start = time.perf_counter()
+        for index, frame in enumerate(frames, 1):
+            await asyncio.sleep(max(0.0, start + index / args.fps - time.perf_counter()))
+            tasks.append(asyncio.create_task(post(frame)))
+        await asyncio.gather(*tasks)
+    return results, sorted(latencies)
+
+def run_live(args):
+    frames = camera_frames(int(args.fps * args.seconds), max(1, int(args.fps * args.change_every)))
+    base_url, processes = start_local_stack(args)
+    reports = []
+    try:
+        for name, run in [
+            ("POST /detect per frame", lambda: post_frames(base_url, frames, args)),
+            ("/ws/live, no differencing", lambda: stream_frames(base_url, frames, args, 0.0)),
+            ("/ws/live", lambda: stream_frames(base_url, frames, args, args.min_change)),
+        ]:
+            results, latencies = asyncio.run(run())
+            reports.append((name, results, latencies))
+    finally:
+        stop_processes(processes)
+
+    print(f"{len(frames)} frames at {args.fps:g} fps, scene changes every {args.change_every:g}s, "
+          f"stub latency {args.stub_latency_ms:.0f} ms")
+    print(f"{'mode':<28}{'detector':>10}{'reused':>8}{'dropped':>9}{'errors':>8}{'p50 ms':>9}{'p95 ms':>9}{'max ms':>9}")
+    for name, results, latencies in reports:
+        print(f"{name:<28}{results['detected']:>10}{results['reused']:>8}{results['dropped']:>9}{results['errors']:>8}"
+              f"{percentile(latencies, 50) * 1000:>9.0f}{percentile(latencies, 95) * 1000:>9.0f}"
+              f"{(latencies[-1] if latencies else 0) * 1000:>9.0f}")
+
+def synthetic_history(count, days, seed=0):
+    """History entries in HistoryStore's queue layout, spread evenly over the last `days` days."""
+    import random
+
+    rng = random.Random(seed)
+    labels = ["bottle", "cup", "can", "box", "jar", "book", "chair", "laptop", "keyboard", "vase"]
+    start = time.time() - days * 86400
+    step = days * 86400 / count
+    for i in range(count):
+        counts = {label: rng.randint(1, 12) for label in rng.sample(labels, rng.randint(1, 4))}
+        yield (start + i * step, "detect", f"shelf-{i}.jpg", f"{rng.getrandbits(256):064x}", 800, 600,
+               sum(counts.values()), 0, counts, None)
+
+async def drive_history(args, path):
+    import main as backend
+
+    store = backend.HistoryStore(path, batch_size=args.batch_size)
+    await store.start()
+    loop = asyncio.get_running_loop()
+    reports = {}
+    try:
+        batch = []
+        start = time.perf_counter()
+        for entry in synthetic_history(args.rows, args.days):
+            batch.append(entry)
+            if len(batch) == args.batch_size:
+                await loop.run_in_executor(store._executor, store._write, batch)
+                batch = []
+        if batch:
+            await loop.run_in_executor(store._executor, store._write, batch)
+        reports["insert_rows_per_s"] = args.rows / (time.perf_counter() - start)
+
+        # the request path only enqueues; time that with the writer running
+        outcome = {"error": None, "image_hash": "0" * 64, "image_info": {"size": (800, 600)}, "cached": False,
+                   "object_detection": {"total_objects": 3, "object_counts": {"cup": 3}, "detections": []}}
+        start = time.perf_counter()
+        for _ in range(1000):
+            store.record("detect", "shelf.jpg", outcome)
+        reports["record_us"] = (time.perf_counter() - start) / 1000 * 1e6
+
+        oldest = (await store.query("SELECT MIN(id) AS id FROM analyses"))[0]["id"]
+        some_hash = (await store.query("SELECT image_hash FROM analyses WHERE id = ?", [oldest + args.rows // 2]))[0]["image_hash"]
+        now = time.time()
+
+        async def best_of(coroutine_factory):
+            timings = []
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                await coroutine_factory()
+                timings.append(time.perf_counter() - started)
+            return min(timings) * 1000
+
+        reports["queries_ms"] = {
+            "first page": await best_of(lambda: store.page(50)),
+            "page 50 rows from the oldest": await best_of(lambda: store.page(50, before_id=oldest + 50)),
+            "first page, label=vase": await best_of(lambda: store.page(50, label="vase")),
+            "by image_hash": await best_of(lambda: store.page(50, image_hash=some_hash)),
+            "label totals, last 24h": await best_of(lambda: store.label_totals(now - 86400, now)),
+            f"label totals, last {args.days}d": await best_of(lambda: store.label_totals(now - args.days * 86400, now)),
+            f"raw GROUP BY, last {args.days}d": await best_of(lambda: store.query(
+                "SELECT label, COUNT(*), SUM(count) FROM analysis_labels WHERE created_at >= ? AND created_at < ? GROUP BY label",
+                [now - args.days * 86400, now])),
+        }
+    finally:
+        await store.close()
+    return reports
+
+def run_history(args):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "history.sqlite3")
+        reports = asyncio.run(drive_history(args, path))
+        size_mb = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)) / 1024 / 1024
+    print(f"{args.rows} analyses over {args.days} days, batches of {args.batch_size}, database {size_mb:.0f} MB")
+    print(f"insert: {reports['insert_rows_per_s']:,.0f} analyses/s; record() on the request path: {reports['record_us']:.1f} us")
+    for name, ms in reports["queries_ms"].items():
+        print(f"{name:<36}{ms:>9.2f} ms")
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def wait_until_ready(url, timeout=30.0):
+    import httpx
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(url, timeout=1.0).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} did not become ready within {timeout:.0f}s")
+
+def process_tree(pid):
+    """The process and its direct children, which covers uvicorn's worker processes."""
+    pids = [pid]
+    for entry in Path("/proc").iterdir():
+        if entry.name.isdigit():
+            try:
+                fields = (entry / "stat").read_text().rsplit(")", 1)[1].split()
+            except OSError:
+                continue
+            if int(fields[1]) == pid:
+                pids.append(int(entry.name))
+    return pids
+
+def cpu_seconds(pids):
+    ticks = os.sysconf("SC_CLK_TCK")
+    total = 0.0
+    for pid in pids:
+        try:
+            fields = Path(f"/proc/{pid}/stat").read_text().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        # utime and stime are fields 14 and 15 of /proc/<pid>/stat
+        total += (int(fields[11]) + int(fields[12])) / ticks
+    return total
+
+def rss_mb(pids, field="VmRSS"):
+    total = 0.0
+    for pid in pids:
+        try:
+            for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+                if line.startswith(field + ":"):
+                    total += int(line.split()[1]) / 1024
+        except OSError:
+            continue
+    return total
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+async def drive_load(base_url, endpoint, corpus, args):
+    import httpx
+
+    latencies = []
+    statuses = Counter()
+    next_request = iter(range(args.requests))
+
+    def upload(i):
+        data = corpus[i % len(corpus)]
+        if args.unique:
+            # bytes after the JPEG end marker are ignored by decoders but give each upload its own cache key
+            data = data + i.to_bytes(8, "big")
+        return data
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=300.0,
+                                 limits=httpx.Limits(max_connections=args.concurrency)) as client:
+        async def worker():
+            for i in next_request:
+                start = time.perf_counter()
+                try:
+                    if endpoint == "/detect/batch":
+                        files = [("files", (f"{i}-{j}.jpg", upload(i * args.batch_size + j), "image/jpeg"))
+                                 for j in range(args.batch_size)]
+                        async with client.stream("POST", endpoint, files=files) as response:
+                            async for _ in response.aiter_lines():
+                                pass
+                    else:
+                        response = await client.post(endpoint, files={"file": ("shelf.jpg", upload(i), "image/jpeg")})
+                    statuses[response.status_code] += 1
+                except httpx.HTTPError as e:
+                    statuses[type(e).__name__] += 1
+                latencies.append(time.perf_counter() - start)
+
+        started = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    images = len(latencies) * (args.batch_size if endpoint == "/detect/batch" else 1)
+    return {
+        "endpoint": endpoint,
+        "requests": len(latencies),
+        "statuses": {str(k): v for k, v in statuses.items()},
+        "elapsed_s": elapsed,
+        "requests_per_s": len(latencies) / elapsed,
+        "images_per_s": images / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p90_ms": percentile(latencies, 90) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "max_ms": latencies[-1] * 1000 if latencies else 0.0,
+    }
+
+def start_stub(args):
+    """Launch stub_detection_server.py; returns (its detection URL, the process)."""
+    stub_port = free_port()
+    stub = subprocess.Popen([
+        sys.executable, os.path.join(BACKEND_DIR, "stub_detection_server.py"),
+        "--port", str(stub_port),
+        "--latency-ms", str(args.stub_latency_ms),
+        "--cold-start-seconds", str(args.stub_cold_start),
+        "--rate-limit-rps", str(args.stub_rate_limit),
+        "--error-rate", str(args.stub_error_rate),
+        "--detections", str(args.stub_detections),
+    ], cwd=BACKEND_DIR)
+    try:
+        wait_until_ready(f"http://127.0.0.1:{stub_port}/health")
+    except Exception:
+        stop_processes([stub])
+        raise
+    return f"http://127.0.0.1:{stub_port}/models/facebook/detr-resnet-50", stub
+
+def start_local_stack(args):
+    """Launch the stub detection server and a uvicorn backend pointed at it; returns (base_url, processes)."""
+    stub_url, stub = start_stub(args)
+    backend_port = free_port()
+    env = {
+        **os.environ,
+        "OBJECT_DETECTION_URL": stub_url,
+        # measure the pipeline rather than the cache unless asked to
+        "DETECTION_CACHE_SIZE": "256" if args.cache else "0",
+        "DETECTION_CACHE_DIR": "",
+        "UPSTREAM_RATE_LIMIT": "0",
+        "UPSTREAM_QUEUE_SIZE": "100000",
+        "UPSTREAM_QUEUE_PER_CLIENT": "100000",
+    }
+    for assignment in args.backend_env:
+        key, value = assignment.split("=", 1)
+        env[key] = value
+    backend = subprocess.Popen([
+        sys.executable, "-m", "uvicorn", "main:app",
+        "--host", "127.0.0.1", "--port", str(backend_port), "--log-level", "warning",
+    ], cwd=BACKEND_DIR, env=env)
+    processes = [stub, backend]
+    try:
+        wait_until_ready(f"http://127.0.0.1:{backend_port}/health")
+    except Exception:
+        stop_processes(processes)
+        raise
+    return f"http://127.0.0.1:{backend_port}", processes
+
+def pss_mb(pid):
+    try:
+        for line in Path(f"/proc/{pid}/smaps_rollup").read_text().splitlines():
+            if line.startswith("Pss:"):
+                return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return float("nan")
+
+def startup_modes(args):
+    uvicorn = [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--log-level", "warning"]
+    gunicorn = [sys.executable, "-m", "gunicorn", "main:app", "-c", "gunicorn.conf.py", "--log-level", "warning"]
+    modes = [
+        ("uvicorn, eager imports", uvicorn, {"LAZY_IMPORTS": "false"}, 1),
+        ("uvicorn, lazy imports", uvicorn, {}, 1),
+        (f"uvicorn --workers {args.workers}", uvicorn + ["--workers", str(args.workers)], {}, args.workers),
+    ]
+    if importlib.util.find_spec("gunicorn"):
+        modes.append((f"gunicorn preload x{args.workers}", gunicorn, {}, args.workers))
+    else:
+        print("gunicorn is not installed; skipping the preloaded mode")
+    return modes
+
+async def measure_startup(base_url, process, args):
+    import httpx
+
+    image = make_corpus(args.corpus_dir or os.path.join(tempfile.gettempdir(), "inventorylens-corpus"))[-1].read_bytes()
+    async with httpx.AsyncClient(base_url=base_url, timeout=60.0) as client:
+        while True:
+            if process.poll() is not None:
+                raise RuntimeError(f"backend exited with {process.returncode}")
+            try:
+                if (await client.get("/health")).status_code == 200:
+                    break
+            except httpx.HTTPError:
+                await asyncio.sleep(0.01)
+        ready_at = time.perf_counter()
+        response = await client.post("/detect", files={"file": ("shelf.jpg", image, "image/jpeg")})
+        first_detection_at = time.perf_counter()
+        if response.status_code != 200:
+            raise RuntimeError(f"first detection failed with {response.status_code}: {response.text}")
+        # warm every worker before reading memory
+        for i in range(args.warm_requests):
+            await client.post("/detect", files={"file": ("shelf.jpg", image + i.to_bytes(4, "big"), "image/jpeg")})
+    return ready_at, first_detection_at
+
+async def drain_on_stop(base_url, process, args):
+    """Start slow detections, ask the server to stop mid-flight and count how many still complete."""
+    import httpx
+    import signal
+
+    image = make_corpus(args.corpus_dir or os.path.join(tempfile.gettempdir(), "inventorylens-corpus"))[-1].read_bytes()
+    async with httpx.AsyncClient(base_url=base_url, timeout=60.0) as client:
+        async def detect(i):
+            try:
+                files = {"file": ("shelf.jpg", image + (10 ** 6 + i).to_bytes(4, "big"), "image/jpeg")}
+                return (await client.post("/detect", files=files)).status_code
+            except httpx.HTTPError as e:
+                return type(e).__name__
+        tasks = [asyncio.create_task(detect(i)) for i in range(args.drain_requests)]
+        await asyncio.sleep(args.stub_latency_ms / 1000 / 2)
+        process.send_signal(signal.SIGTERM)
+        return Counter(await asyncio.gather(*tasks))
+
+def run_startup(args):
+    stub_url, stub = start_stub(args)
+    reports = []
+    try:
+        for name, command, extra_env, workers in startup_modes(args):
+            port = free_port()
+            env = {**os.environ, **extra_env, "OBJECT_DETECTION_URL": stub_url, "PORT": str(port),
+                   "WEB_CONCURRENCY": str(workers), "HISTORY_DB_PATH": "", "DETECTION_CACHE_DIR": "",
+                   "UPSTREAM_RATE_LIMIT": "0", "UPSTREAM_WARMUP": "false"}
+            if "uvicorn" in name:
+                command = command + ["--port", str(port)]
+            else:
+                command = command + ["--bind", f"127.0.0.1:{port}"]
+            launched_at = time.perf_counter()
+            process = subprocess.Popen(command, cwd=BACKEND_DIR, env=env)
+            try:
+                ready_at, first_detection_at = asyncio.run(measure_startup(f"http://127.0.0.1:{port}", process, args))
+                pids = process_tree(process.pid)
+                serving = pids[1:] if workers > 1 or len(pids) > 1 else pids
+                report = {
+                    "mode": name,
+                    "ready_ms": (ready_at - launched_at) * 1000,
+                    "first_detection_ms": (first_detection_at - ready_at) * 1000,
+                    "worker_rss_mb": rss_mb(serving) / len(serving),
+                    "worker_pss_mb": sum(pss_mb(pid) for pid in serving) / len(serving),
+                    "total_pss_mb": sum(pss_mb(pid) for pid in pids),
+                }
+                report["drain"] = dict(asyncio.run(drain_on_stop(f"http://127.0.0.1:{port}", process, args)))
+                reports.append(report)
+            finally:
+                stop_processes([process])
+    finally:
+        stop_processes([stub])
+
+    print(f"stub latency {args.stub_latency_ms:.0f} ms; {args.drain_requests} detections in flight when SIGTERM arrives")
+    print(f"{'mode':<26}{'ready ms':>10}{'1st detect':>12}{'RSS/worker':>12}{'PSS/worker':>12}{'PSS total':>11}  drain")
+    for r in reports:
+        print(f"{r['mode']:<26}{r['ready_ms']:>10.0f}{r['first_detection_ms']:>10.0f}ms{r['worker_rss_mb']:>10.0f}MB"
+              f"{r['worker_pss_mb']:>10.0f}MB{r['total_pss_mb']:>9.0f}MB  {r['drain']}")
+
+def stop_processes(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+def run_load(args):
+    corpus_dir = args.corpus_dir or os.path.join(tempfile.gettempdir(), "inventorylens-corpus")
+    corpus = [p.read_bytes() for p in make_corpus(corpus_dir)]
+    processes = []
+    if args.target:
+        base_url, backend_pid = args.target.rstrip("/"), None
+    else:
+        base_url, processes = start_local_stack(args)
+        backend_pid = processes[1].pid
+
+    reports = []
+    try:
+        for endpoint in args.endpoints:
+            pids = process_tree(backend_pid) if backend_pid else []
+            cpu_before = cpu_seconds(pids)
+            report = asyncio.run(drive_load(base_url, endpoint, corpus, args))
+            if pids:
+                report["backend_cpu_s"] = cpu_seconds(pids) - cpu_before
+                report["backend_cpu_percent"] = report["backend_cpu_s"] / report["elapsed_s"] * 100
+                report["backend_rss_mb"] = rss_mb(pids)
+                report["backend_peak_rss_mb"] = rss_mb(pids, "VmHWM")
+            reports.append(report)
+    finally:
+        stop_processes(processes)
+
+    print(f"concurrency {args.concurrency}, {args.requests} requests per endpoint, corpus {len(corpus)} images")
+    print(f"{'endpoint':<15}{'req/s':>8}{'img/s':>8}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}{'max ms':>9}"
+          f"{'CPU %':>8}{'RSS MB':>8}{'peak MB':>9}  statuses")
+    for r in reports:
+        print(f"{r['endpoint']:<15}{r['requests_per_s']:>8.1f}{r['images_per_s']:>8.1f}{r['p50_ms']:>9.0f}"
+              f"{r['p90_ms']:>9.0f}{r['p99_ms']:>9.0f}{r['max_ms']:>9.0f}"
+              f"{r.get('backend_cpu_percent', float('nan')):>8.0f}{r.get('backend_rss_mb', float('nan')):>8.0f}"
+              f"{r.get('backend_peak_rss_mb', float('nan')):>9.0f}  {r['statuses']}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"args": {k: v for k, v in vars(args).items() if k != "func"}, "results": reports}, f, indent=2)
+
+STAND_IN_LABELS = ["bottle", "cup", "bowl", "book", "can", "box", "jar", "banana", "apple", "orange", "vase", "clock"]
+
+def make_stand_in_detr(directory, num_queries=100, num_classes=91, seed=0):
+    """Write a random network with DETR's ONNX signature to directory/model.onnx, plus its config.json.
+
+    A four-layer strided convolution replaces ResNet-50 and the transformer,
+    so it runs far faster than the real model. It exercises the local
+    engine and micro-batching offline; it does not measure DETR itself.
+    """
+    import numpy as np
+    import onnx
+    from onnx import TensorProto, helper, numpy_helper
+
+    rng = np.random.default_rng(seed)
+    initializers = []
+    nodes = []
+
+    def constant(name, values):
+        initializers.append(numpy_helper.from_array(values, name))
+        return name
+
+    features, channels = "pixel_values", 3
+    for i, (out_channels, kernel, stride) in enumerate([(32, 7, 4), (64, 3, 2), (128, 3, 2), (256, 3, 2)]):
+        weight = rng.standard_normal((out_channels, channels, kernel, kernel)) * (2 / (channels * kernel * kernel)) ** 0.5
+        nodes.append(helper.make_node("Conv", [features, constant(f"conv{i}.weight", weight.astype(np.float32))], [f"conv{i}"],
+                                      kernel_shape=[kernel, kernel], strides=[stride, stride], pads=[kernel // 2] * 4))
+        nodes.append(helper.make_node("Relu", [f"conv{i}"], [f"relu{i}"]))
+        features, channels = f"relu{i}", out_channels
+    nodes.append(helper.make_node("GlobalAveragePool", [features], ["pooled"]))
+    nodes.append(helper.make_node("Flatten", ["pooled"], ["embedding"]))
+
+    # a dozen queries are confident about a fixed class, so every image yields some boxes
+    classes = num_classes + 1
+    bias = np.zeros(num_queries * classes, dtype=np.float32)
+    for query in range(len(STAND_IN_LABELS)):
+        bias[query * classes + query] = 10.0
+    nodes.append(helper.make_node("MatMul", ["embedding", constant("class.weight", (rng.standard_normal((channels, num_queries * classes)) * 0.05).astype(np.float32))], ["class_scores"]))
+    nodes.append(helper.make_node("Add", ["class_scores", constant("class.bias", bias)], ["class_logits"]))
+    nodes.append(helper.make_node("Reshape", ["class_logits", constant("logits.shape", np.array([-1, num_queries, classes], dtype=np.int64))], ["logits"]))
+    nodes.append(helper.make_node("MatMul", ["embedding", constant("box.weight", rng.standard_normal((channels, num_queries * 4)).astype(np.float32))], ["box_scores"]))
+    nodes.append(helper.make_node("Reshape", ["box_scores", constant("boxes.shape", np.array([-1, num_queries, 4], dtype=np.int64))], ["box_logits"]))
+    nodes.append(helper.make_node("Sigmoid", ["box_logits"], ["pred_boxes"]))
+
+    graph = helper.make_graph(
+        nodes, "stand_in_detr",
+        [helper.make_tensor_value_info("pixel_values", TensorProto.FLOAT, ["batch", 3, "height", "width"])],
+        [helper.make_tensor_value_info("logits", TensorProto.FLOAT, ["batch", num_queries, classes]),
+         helper.make_tensor_value_info("pred_boxes", TensorProto.FLOAT, ["batch", num_queries, 4])],
+        initializers,
+    )
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)])
+    model.ir_version = 8
+    os.makedirs(directory, exist_ok=True)
+    model_path = os.path.join(directory, "model.onnx")
+    onnx.save(model, model_path)
+    with open(os.path.join(directory, "config.json"), "w") as f:
+        json.dump({"id2label": {str(i): label for i, label in enumerate(STAND_IN_LABELS)}}, f)
+    return model_path
+
+def run_detectors(args):
+    import httpx
+
+    corpus_dir = args.corpus_dir or os.path.join(tempfile.gettempdir(), "inventorylens-corpus")
+    corpus = [p.read_bytes() for p in make_corpus(corpus_dir)]
+    model_path = args.model
+    if model_path is None:
+        model_path = make_stand_in_detr(os.path.join(tempfile.gettempdir(), "inventorylens-stand-in-detr"))
+        print(f"no --model given; using a stand-in network with DETR's inputs and outputs at {model_path}")
+
+    modes = [(f"huggingface (stub, {args.remote_rate_limit:g} req/s limit)", ["DETECTOR_BACKEND=huggingface", f"UPSTREAM_RATE_LIMIT={args.remote_rate_limit}"])]
+    for batch_size in args.max_batch:
+        modes.append((f"onnx, batches of <= {batch_size}", [
+            "DETECTOR_BACKEND=onnx", f"LOCAL_MODEL_PATH={model_path}", f"LOCAL_BATCH_SIZE={batch_size}",
+            f"LOCAL_BATCH_WAIT_MS={args.batch_wait_ms}", "LOCAL_QUEUE_SIZE=100000",
+        ]))
+
+    reports = []
+    for name, backend_env in modes:
+        mode_args = argparse.Namespace(**{**vars(args), "backend_env": args.backend_env + ["HISTORY_DB_PATH="] + backend_env})
+        base_url, processes = start_local_stack(mode_args)
+        try:
+            pids = process_tree(processes[1].pid)
+            cpu_before = cpu_seconds(pids)
+            report = asyncio.run(drive_load(base_url, "/detect", corpus, args))
+            report["mode"] = name
+            report["backend_cpu_percent"] = (cpu_seconds(pids) - cpu_before) / report["elapsed_s"] * 100
+            report["detector"] = httpx.get(f"{base_url}/health").json()["detector"]
+            reports.append(report)
+        finally:
+            stop_processes(processes)
+
+    print(f"/detect, concurrency {args.concurrency}, {args.requests} requests, stub latency {args.stub_latency_ms:.0f} ms, {os.cpu_count()} CPUs")
+    print(f"{'mode':<40}{'img/s':>8}{'p50 ms':>9}{'p99 ms':>9}{'CPU %':>8}{'avg batch':>11}  statuses")
+    for r in reports:
+        batching = r["detector"].get("batching", {})
+        print(f"{r['mode']:<40}{r['images_per_s']:>8.1f}{r['p50_ms']:>9.0f}{r['p99_ms']:>9.0f}"
+              f"{r['backend_cpu_percent']:>8.0f}{batching.get('avg_batch_size', float('nan')):>11.2f}  {r['statuses']}")
+
+def add_stack_arguments(parser):
+    """Options of the backend and stub detection server launched by start_local_stack."""
+    parser.add_argument("--cache", action="store_true", help="leave the backend's detection cache enabled")
+    parser.add_argument("--backend-env", action="append", default=[], metavar="KEY=VALUE",
+                        help="extra environment for the launched backend")
+    parser.add_argument("--stub-latency-ms", type=float, default=300.0)
+    parser.add_argument("--stub-cold-start", type=float, default=0.0, help="seconds of 503 'loading' answers")
+    parser.add_argument("--stub-rate-limit", type=float, default=0.0, help="requests per second before 429s")
+    parser.add_argument("--stub-error-rate", type=float, default=0.0)
+    parser.add_argument("--stub-detections", type=int, default=12)
+
+def main():
+    parser = argparse.ArgumentParser(description="InventoryLens AI backend benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    preprocess = subparsers.add_parser("preprocess", help="decode/resize/encode CPU time and peak RSS")
+    preprocess.add_argument("--repeat", type=int, default=5)
+    preprocess.add_argument("--corpus-dir", default=None)
+    preprocess.set_defaults(func=run_preprocess)
+
+    uploads = subparsers.add_parser("uploads", help="peak memory under concurrent large uploads")
+    uploads.add_argument("--concurrency", type=int, default=8)
+    uploads.add_argument("--oversized-mb", type=int, default=50)
+    uploads.add_argument("--max-rss-mb", type=float, default=150)
+    uploads.add_argument("--corpus-dir", default=None)
+    uploads.set_defaults(func=run_uploads)
+
+    postprocess = subparsers.add_parser("postprocess", help="score filter + NMS + counting at 1k+ detections")
+    postprocess.add_argument("--detections", type=int, nargs="+", default=[1000, 2000, 5000])
+    postprocess.add_argument("--iou", type=float, default=0.6)
+    postprocess.add_argument("--repeat", type=int, default=5)
+    postprocess.set_defaults(func=run_postprocess)
+
+    serialize = subparsers.add_parser("serialize", help="response encode time and size: default, orjson, compact, fields, gzip")
+    serialize.add_argument("--detections", type=int, nargs="+", default=[100, 1000, 5000])
+    serialize.add_argument("--repeat", type=int, default=20)
+    serialize.set_defaults(func=run_serialize)
+
+    tiling = subparsers.add_parser("tiling", help="small-object recall and latency of tiled vs downscaled detection")
+    tiling.add_argument("--width", type=int, default=6000)
+    tiling.add_argument("--height", type=int, default=1500)
+    tiling.add_argument("--item-px", type=int, default=60, help="width of the shelf items in the full photo")
+    tiling.add_argument("--min-object-px", type=int, default=24, help="smallest object the simulated detector finds")
+    tiling.add_argument("--latency-ms", type=float, default=300.0, help="simulated inference time per call")
+    tiling.add_argument("--tile-sizes", type=int, nargs="+", default=[800, 640])
+    tiling.add_argument("--overlaps", type=float, nargs="+", default=[0.0, 0.2])
+    tiling.set_defaults(func=run_tiling)
+
+    live = subparsers.add_parser("live", help="detector calls and latency of /ws/live against POSTing every frame")
+    live.add_argument("--fps", type=float, default=10.0)
+    live.add_argument("--seconds", type=float, default=20.0)
+    live.add_argument("--change-every", type=float, default=2.0, help="seconds between scene changes")
+    live.add_argument("--min-change", type=float, default=0.001, help="min_change passed to /ws/live")
+    add_stack_arguments(live)
+    live.set_defaults(func=run_live)
+
+    history = subparsers.add_parser("history", help="history store insert rate and query latency at scale")
+    history.add_argument("--rows", type=int, default=200000)
+    history.add_argument("--days", type=int, default=90)
+    history.add_argument("--batch-size", type=int, default=500)
+    history.add_argument("--repeat", type=int, default=5)
+    history.set_defaults(func=run_history)
+
+    startup = subparsers.add_parser("startup", help="time to first request, per-worker memory and shutdown draining")
+    startup.add_argument("--workers", type=int, default=4)
+    startup.add_argument("--warm-requests", type=int, default=16, help="detections sent before memory is read")
+    startup.add_argument("--drain-requests", type=int, default=8)
+    startup.add_argument("--corpus-dir", default=None)
+    add_stack_arguments(startup)
+    startup.set_defaults(func=run_startup)
+
+    detectors = subparsers.add_parser("detectors", help="/detect throughput of the remote detector against the local ONNX engine")
+    detectors.add_argument("--model", default=None, help="ONNX export of DETR; a stand-in network is generated when omitted")
+    detectors.add_argument("--max-batch", type=int, nargs="+", default=[1, 8], help="LOCAL_BATCH_SIZE values to compare")
+    detectors.add_argument("--batch-wait-ms", type=float, default=10.0)
+    detectors.add_argument("--remote-rate-limit", type=float, default=5.0, help="UPSTREAM_RATE_LIMIT for the remote backend")
+    detectors.add_argument("--concurrency", type=int, default=16)
+    detectors.add_argument("--requests", type=int, default=200)
+    detectors.add_argument("--unique", action=argparse.BooleanOptionalAction, default=True)
+    detectors.add_argument("--corpus-dir", default=None)
+    add_stack_arguments(detectors)
+    detectors.set_defaults(func=run_detectors, batch_size=1)
+
+    load = subparsers.add_parser("load", help="throughput and latency percentiles against a stub detection API")
+    load.add_argument("--endpoints", nargs="+", default=["/detect", "/analyze", "/detect/batch"])
+    load.add_argument("--concurrency", type=int, default=16)
+    load.add_argument("--requests", type=int, default=200, help="requests per endpoint")
+    load.add_argument("--batch-size", type=int, default=8, help="images per /detect/batch request")
+    load.add_argument("--unique", action=argparse.BooleanOptionalAction, default=True,
+                      help="give every upload distinct bytes so the cache and coalescing cannot hide the pipeline")
+    load.add_argument("--target", default=None, help="drive an already running backend instead of starting one")
+    add_stack_arguments(load)
+    load.add_argument("--corpus-dir", default=None)
+    load.add_argument("--output", default=None, help="write the full report as JSON")
+    load.set_defaults(func=run_load)
+
+    worker = subparsers.add_parser("_preprocess_worker")
+    worker.add_argument("--variant", choices=["full_decode", "draft"], required=True)
+    worker.add_argument("--repeat", type=int, default=5)
+    worker.add_argument("corpus", nargs="+")
+    worker.set_defaults(func=preprocess_worker)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
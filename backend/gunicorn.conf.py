@@ -0,0 +1,39 @@
+"""
+InventoryLens AI Production Server Settings
+
+Purpose:
+---------
+Gunicorn configuration for running the backend in production:
+- One Uvicorn worker per CPU (override with WEB_CONCURRENCY)
+- The app is imported once in the master and forked, so workers start in
+  milliseconds and share the loaded modules' memory
+- No file watcher; on SIGTERM each worker stops accepting connections and
+  gets SHUTDOWN_DRAIN_SECONDS to finish in-flight requests and queued jobs
+
+Run this with: `gunicorn main:app -c gunicorn.conf.py`
+          or: `python start_backend.py --production`
+"""
+
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "0")) or multiprocessing.cpu_count()
+# main.py divides the upstream rate limit and preprocessing threads by this
+os.environ["WEB_CONCURRENCY"] = str(workers)
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+
+# in-flight requests drain first, then queued jobs in the app's shutdown; the master kills a worker
+# still busy after graceful_timeout, which stays under Render's 30 s shutdown window by default
+graceful_timeout = int(float(os.getenv("SHUTDOWN_DRAIN_SECONDS", "20"))) + 5
+timeout = int(os.getenv("WORKER_TIMEOUT", "120"))
+# longer than the proxy's idle timeout, so the proxy never reuses a connection the worker just closed
+keepalive = 75
+accesslog = None
+errorlog = "-"
+
+def when_ready(server):
+    # runs in the master after the app is preloaded and before any worker is forked
+    import main
+    main.load_heavy_modules()
@@ -1,18 +1,337 @@
 # step 1: set up FastAPI project with environment loading via dotenv
-from fastapi import FastAPI, File, UploadFile, HTTPException 
+from fastapi import FastAPI, File, UploadFile, HTTPException, Query, Request, Depends, WebSocket
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-import requests
+from fastapi.responses import JSONResponse, ORJSONResponse, PlainTextResponse, StreamingResponse
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.requests import HTTPConnection
+import asyncio
 import base64
+import hashlib
+import importlib
+import importlib.util
 import io
-from PIL import Image
+import math
+import random
+import sys
+import time
+import uuid
+import zlib
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from PIL import UnidentifiedImageError
 import os
-from typing import List, Dict, Any
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import List, Dict, Any, Optional, Tuple, Sequence, Callable, Awaitable
 import json
+import sqlite3
+import orjson
 from dotenv import load_dotenv
 
 load_dotenv()
-app = FastAPI(title="InventoryLens AI", version="1.0.0")
+
+# step 20: perf(startup): load the heavy modules on first use so a worker starts serving sooner
+LAZY_IMPORTS = os.getenv("LAZY_IMPORTS", "true").lower() == "true"
+
+def lazy_import(name: str):
+    """Return module `name`, executing it only when one of its attributes is first used."""
+    if not LAZY_IMPORTS or name in sys.modules:
+        return importlib.import_module(name)
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+httpx = lazy_import("httpx")
+np = lazy_import("numpy")
+Image = lazy_import("PIL.Image")
+
+def load_heavy_modules() -> None:
+    # LazyLoader is not thread-safe: a module first touched from two pool threads at once can be seen
+    # half-executed, so the lifespan finishes loading on the event loop before any thread runs.
+    # A pre-forking server also calls this in the parent so every worker shares the loaded pages.
+    for module in (httpx, np, Image):
+        getattr(module, "__file__")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    load_heavy_modules()
+    # the upstream connection pool opens on the first detection; a local model is loaded here, in each worker
+    await history_store.start()
+    await analysis_jobs.start()
+    if detector.load_on_startup:
+        await detector.start()
+    warmup_task = asyncio.create_task(keep_model_warm(detector)) if UPSTREAM_WARMUP else None
+    try:
+        yield
+    finally:
+        if warmup_task is not None:
+            warmup_task.cancel()
+        # queued and running jobs get SHUTDOWN_DRAIN_SECONDS to finish before they are cancelled
+        await analysis_jobs.close(SHUTDOWN_DRAIN_SECONDS)
+        await detector.close()
+        await history_store.close()
+        shutdown_preprocess_pool()
+
+app = FastAPI(title="InventoryLens AI", version="1.0.0", lifespan=lifespan, default_response_class=ORJSONResponse)
+
+# step 13: perf(uploads): bound upload size while streaming and guard against decompression bombs
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(10 * 1024 * 1024)))
+MAX_BATCH_UPLOAD_BYTES = int(os.getenv("MAX_BATCH_UPLOAD_BYTES", str(200 * 1024 * 1024)))
+BATCH_MAX_FILES = int(os.getenv("BATCH_MAX_FILES", "500"))
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", str(40_000_000)))
+# room for multipart boundaries and part headers on top of the file itself
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+# PIL refuses to decode anything past twice this, a backstop behind the header check
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+def multipart_boundary(content_type: bytes) -> Optional[bytes]:
+    for param in content_type.split(b";")[1:]:
+        name, _, value = param.strip().partition(b"=")
+        if name.lower() == b"boundary" and value:
+            return value.strip(b'"')
+    return None
+
+class UploadLimitMiddleware:
+    """Rejects oversized request bodies with 413 before they are buffered.
+
+    A declared Content-Length over the limit is refused without reading the
+    body. Otherwise the bytes are counted as they arrive, and the upload is
+    aborted as soon as the running total passes the limit, while the
+    multipart parser is still consuming the stream. Batch uploads are also
+    aborted as soon as they carry more than max_batch_files parts.
+    """
+
+    def __init__(self, app, max_bytes: int = MAX_UPLOAD_BYTES, max_batch_bytes: int = MAX_BATCH_UPLOAD_BYTES,
+                 max_batch_files: int = BATCH_MAX_FILES):
+        self.app = app
+        self.max_bytes = max_bytes + MULTIPART_OVERHEAD_BYTES
+        self.max_batch_bytes = max_batch_bytes + MULTIPART_OVERHEAD_BYTES
+        self.max_batch_files = max_batch_files
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in ("POST", "PUT"):
+            return await self.app(scope, receive, send)
+        
+        batch = scope["path"].endswith("/batch")
+        limit = self.max_batch_bytes if batch else self.max_bytes
+        headers = dict(scope["headers"])
+        declared = headers.get(b"content-length")
+        if declared is not None and declared.isdigit() and int(declared) > limit:
+            response = JSONResponse(status_code=413, content={"detail": f"Upload too large (max {limit - MULTIPART_OVERHEAD_BYTES} bytes)"})
+            return await response(scope, receive, send)
+        
+        received = 0
+        # every part opens with "--boundary" and a line break; the closing "--boundary--" is not counted
+        delimiter = multipart_boundary(headers.get(b"content-type", b"")) if batch else None
+        delimiter = b"--" + delimiter + b"\r\n" if delimiter else None
+        delimiters = 0
+        tail = b""
+        
+        async def limited_receive():
+            nonlocal received, delimiters, tail
+            message = await receive()
+            if message["type"] == "http.request":
+                body = message.get("body", b"")
+                received += len(body)
+                if received > limit:
+                    # FastAPI re-raises HTTPExceptions from form parsing, so this becomes a 413 response
+                    raise HTTPException(status_code=413, detail=f"Upload too large (max {limit - MULTIPART_OVERHEAD_BYTES} bytes)")
+                if delimiter is not None:
+                    # keep the end of the previous chunk so a delimiter split across chunks still counts once
+                    window = tail + body
+                    delimiters += window.count(delimiter)
+                    tail = window[-(len(delimiter) - 1):]
+                    # refused on the chunk that opens part max_batch_files + 1, before its content arrives
+                    if delimiters > self.max_batch_files:
+                        raise HTTPException(status_code=413, detail=f"Too many files in batch (max {self.max_batch_files})")
+            return message
+        
+        await self.app(scope, limited_receive, send)
+
+def inspect_image_header(image_data: bytes) -> None:
+    """Check format and pixel count from the image header alone; nothing is decoded here."""
+    try:
+        with Image.open(io.BytesIO(image_data)) as image:
+            width, height = image.size
+    except Image.DecompressionBombError:
+        raise HTTPException(status_code=413, detail=f"Image has too many pixels (max {MAX_IMAGE_PIXELS})")
+    except (UnidentifiedImageError, OSError):
+        raise HTTPException(status_code=400, detail="Unsupported or corrupt image file")
+    if width * height > MAX_IMAGE_PIXELS:
+        raise HTTPException(status_code=413, detail=f"Image has too many pixels ({width}x{height}, max {MAX_IMAGE_PIXELS})")
+
+async def read_upload(file: UploadFile, max_bytes: int = MAX_UPLOAD_BYTES) -> bytes:
+    with timed_stage("read"):
+        return await _read_upload(file, max_bytes)
+
+async def _read_upload(file: UploadFile, max_bytes: int) -> bytes:
+    if not file.content_type or not file.content_type.startswith("image/"):
+        raise HTTPException(status_code=400, detail="File must be an image")
+    if file.size is not None and file.size > max_bytes:
+        raise HTTPException(status_code=413, detail=f"Upload too large (max {max_bytes} bytes)")
+    # one read capped one byte past the limit, so a file without a known size still cannot overrun it
+    image_data = await file.read(max_bytes + 1)
+    if len(image_data) > max_bytes:
+        raise HTTPException(status_code=413, detail=f"Upload too large (max {max_bytes} bytes)")
+    if not image_data:
+        raise HTTPException(status_code=400, detail="Empty image file")
+    inspect_image_header(image_data)
+    return image_data
+
+app.add_middleware(UploadLimitMiddleware)
+
+# step 21: perf(responses): orjson bodies, an opt-in compact detection format, field selection and gzip
+GZIP_MIN_BYTES = int(os.getenv("GZIP_MIN_BYTES", "1024"))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "5"))
+# job event streams stay uncompressed: each event is tiny and every open stream would hold a compressor
+GZIP_SKIP_TYPES = ("text/event-stream",)
+COMPACT_DETECTION_FIELDS = ["label", "confidence", "xmin", "ymin", "xmax", "ymax"]
+# returned whatever ?fields= asks for, so a failed or streamed result still says what it is
+ALWAYS_SELECTED_FIELDS = ("type", "index", "frame", "success", "error", "status_code", "retry_after")
+
+def compact_detections(detections: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Detections as fixed-order rows, with each label replaced by its index into a label table."""
+    label_ids: Dict[str, int] = {}
+    rows = []
+    for detection in detections:
+        box = detection.get("box") or {}
+        rows.append([
+            label_ids.setdefault(detection.get("label", "unknown"), len(label_ids)),
+            detection.get("confidence"),
+            box.get("xmin"), box.get("ymin"), box.get("xmax"), box.get("ymax")
+        ])
+    return {"fields": COMPACT_DETECTION_FIELDS, "labels": list(label_ids), "rows": rows}
+
+def compact_response(content: Dict[str, Any]) -> Dict[str, Any]:
+    compacted = {}
+    for key, value in content.items():
+        if key == "detections" and isinstance(value, list):
+            value = compact_detections(value)
+        elif isinstance(value, dict):
+            value = compact_response(value)
+        compacted[key] = value
+    return compacted
+
+def parse_fields(fields: str) -> Dict[str, Any]:
+    """Turn "a,b.c" into {"a": None, "b": {"c": None}}, where None selects the whole value."""
+    tree: Dict[str, Any] = {}
+    for path in fields.split(","):
+        parts = [part for part in path.strip().split(".") if part]
+        node = tree
+        for depth, part in enumerate(parts):
+            if depth == len(parts) - 1:
+                node[part] = None
+            elif node.get(part, {}) is None:
+                break
+            else:
+                node = node.setdefault(part, {})
+    return tree
+
+def select_fields(content: Dict[str, Any], tree: Dict[str, Any]) -> Dict[str, Any]:
+    selected = {key: content[key] for key in ALWAYS_SELECTED_FIELDS if key in content}
+    for key, subtree in tree.items():
+        if key in content:
+            value = content[key]
+            selected[key] = select_fields(value, subtree) if subtree is not None and isinstance(value, dict) else value
+    return selected
+
+class ResponseOptions:
+    """Per-request response shape, read from the query string."""
+
+    def __init__(
+        self,
+        response_format: str = Query("full", alias="format", pattern="^(full|compact)$",
+                                     description="compact sends detections as [label, confidence, xmin, ymin, xmax, ymax] rows with a label table"),
+        fields: Optional[str] = Query(None, description="Comma-separated fields to return, dotted for nested ones, e.g. object_counts"),
+    ):
+        self.compact = response_format == "compact"
+        self.fields = parse_fields(fields) if fields else None
+
+    def shape(self, content: Dict[str, Any]) -> Dict[str, Any]:
+        # selecting first means detections the client did not ask for are never compacted
+        if self.fields is not None:
+            content = select_fields(content, self.fields)
+        if self.compact:
+            content = compact_response(content)
+        return content
+
+    def respond(self, content: Dict[str, Any]) -> ORJSONResponse:
+        # returning a response skips FastAPI's jsonable_encoder walk over every detection
+        return ORJSONResponse(self.shape(content))
+
+def accepts_gzip(accept_encoding: str) -> bool:
+    for coding in accept_encoding.split(","):
+        name, *params = (part.strip() for part in coding.split(";"))
+        if name.lower() not in ("gzip", "*"):
+            continue
+        quality = next((param[2:] for param in params if param.lower().startswith("q=")), "1")
+        try:
+            return float(quality) > 0
+        except ValueError:
+            return False
+    return False
+
+class GZipMiddleware:
+    """Gzips response bodies for clients that send Accept-Encoding: gzip.
+
+    Unlike Starlette's GZipMiddleware, every chunk of a streamed response
+    is flushed through the compressor as it is sent, so /detect/batch
+    lines still reach the client one at a time.
+    """
+
+    def __init__(self, app, minimum_size: int = GZIP_MIN_BYTES, level: int = GZIP_LEVEL):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.level = level
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not accepts_gzip(Headers(scope=scope).get("accept-encoding", "")):
+            return await self.app(scope, receive, send)
+        
+        start_message = None
+        compressor = None
+        
+        async def gzip_send(message):
+            nonlocal start_message, compressor
+            if message["type"] == "http.response.start":
+                # held back until the first body chunk shows whether the response is worth compressing
+                start_message = message
+                return
+            if message["type"] != "http.response.body":
+                return await send(message)
+            
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if start_message is not None:
+                headers = MutableHeaders(scope=start_message)
+                if ("content-encoding" not in headers
+                        and not headers.get("content-type", "").startswith(GZIP_SKIP_TYPES)
+                        and (more_body or len(body) >= self.minimum_size)):
+                    compressor = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                    headers["Content-Encoding"] = "gzip"
+                    headers.add_vary_header("Accept-Encoding")
+                    del headers["Content-Length"]
+            if compressor is not None:
+                # a sync flush ends each chunk on a byte boundary, so the client can decode it on arrival
+                body = compressor.compress(body) + compressor.flush(zlib.Z_SYNC_FLUSH if more_body else zlib.Z_FINISH)
+            if start_message is not None:
+                if compressor is not None and not more_body:
+                    headers["Content-Length"] = str(len(body))
+                await send(start_message)
+                start_message = None
+            await send({**message, "body": body})
+        
+        await self.app(scope, receive, gzip_send)
+
+# added before request_context, whose call_next re-streams every body and would hide the real size
+app.add_middleware(GZipMiddleware)
 
 # step 2: chore(cors): configure CORS for local and production environments
 # ---------- Local Development (NON-ACTIVE) ----------
@@ -34,17 +353,181 @@ if netlify_domain:
     allowed_origins.append(f"https://{netlify_domain}.netlify.app")
     allowed_origins.append(f"https://deploy-preview-*--{netlify_domain}.netlify.app")
 
+@app.middleware("http")
+async def request_context(request: Request, call_next):
+    # the upstream scheduler queues work per client, read back through current_client_id;
+    # pipeline stages add their durations to request_timings for the Server-Timing header
+    client_token = current_client_id.set(client_identity(request))
+    timings: Dict[str, float] = {}
+    timings_token = request_timings.set(timings)
+    REQUESTS_IN_FLIGHT.inc()
+    start = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        REQUESTS_IN_FLIGHT.dec()
+        current_client_id.reset(client_token)
+        request_timings.reset(timings_token)
+    if request.url.path != "/metrics":
+        REQUEST_SECONDS.observe(time.perf_counter() - start, path=route_path(request))
+    if SERVER_TIMING and timings:
+        # streamed responses send headers before their stages run, so they carry no breakdown
+        response.headers["Server-Timing"] = ", ".join(
+            f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items()
+        )
+        response.headers["Timing-Allow-Origin"] = "*"
+    return response
+
+def route_path(request: Request) -> str:
+    # label by route template so ids in paths such as /analyze/jobs/{job_id} do not create a series per request
+    endpoint = request.scope.get("endpoint")
+    for route in request.app.routes:
+        if endpoint is not None and getattr(route, "endpoint", None) is endpoint:
+            return route.path
+    # 404s and anything else no route matched share one label; their raw paths are client-chosen
+    return "unmatched"
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=allowed_origins,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing", "Retry-After"],
 )
 
+# step 14: feat(metrics): per-stage latency histograms exported in Prometheus format
+SERVER_TIMING = os.getenv("SERVER_TIMING", "1") != "0"
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+BYTE_BUCKETS = (4096, 16384, 65536, 131072, 262144, 524288, 1048576, 4194304)
+
+request_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar("request_timings", default=None)
+stage_listener: ContextVar[Optional[Callable[[str, float], None]]] = ContextVar("stage_listener", default=None)
+
+def format_labels(label_names: Sequence[str], label_values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    def __init__(self, name: str, help_text: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = tuple(str(labels[name]) for name in self.label_names)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{format_labels(self.label_names, key)} {value}")
+        return lines
+
+class Gauge:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1.0) -> None:
+        self.value -= amount
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge", f"{self.name} {self.value}"]
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets: Sequence[float], label_names: Sequence[str] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.label_names = tuple(label_names)
+        # per label set: [bucket counts..., sum, count]; buckets are non-cumulative until rendered
+        self._series: Dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(str(labels[name]) for name in self.label_names)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+                break
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, series in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                bucket_labels = format_labels(self.label_names, key, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            bucket_labels = format_labels(self.label_names, key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{bucket_labels} {series[-1]}")
+            lines.append(f"{self.name}_sum{format_labels(self.label_names, key)} {series[-2]}")
+            lines.append(f"{self.name}_count{format_labels(self.label_names, key)} {series[-1]}")
+        return lines
+
+STAGE_SECONDS = Histogram("inventorylens_stage_seconds", "Time spent in each detection pipeline stage.", LATENCY_BUCKETS, ["stage"])
+REQUEST_SECONDS = Histogram("inventorylens_request_seconds", "End-to-end request latency.", LATENCY_BUCKETS, ["path"])
+UPSTREAM_RESPONSES = Counter("inventorylens_upstream_responses_total", "Detection API responses by status code.", ["status"])
+UPSTREAM_PAYLOAD_BYTES = Histogram("inventorylens_upstream_payload_bytes", "Size of image bodies sent to the detection API.", BYTE_BUCKETS)
+REQUESTS_IN_FLIGHT = Gauge("inventorylens_requests_in_flight", "HTTP requests currently being served.")
+LIVE_FRAMES = Counter("inventorylens_live_frames_total", "Live camera frames by outcome.", ["outcome"])
+HISTORY_RECORDS = Counter("inventorylens_history_records_total", "Analysis history records by outcome.", ["outcome"])
+DETECTOR_BATCH_SIZE = Histogram("inventorylens_detector_batch_size", "Images per local detector forward pass.", (1, 2, 4, 8, 16, 32, 64))
+
+def record_stage(name: str, seconds: float) -> None:
+    STAGE_SECONDS.observe(seconds, stage=name)
+    timings = request_timings.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds
+    listener = stage_listener.get()
+    if listener is not None:
+        listener(name, seconds)
+
+@contextmanager
+def timed_stage(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - start)
+
+def render_metrics() -> str:
+    lines = []
+    for metric in (STAGE_SECONDS, REQUEST_SECONDS, UPSTREAM_RESPONSES, UPSTREAM_PAYLOAD_BYTES, REQUESTS_IN_FLIGHT, LIVE_FRAMES, HISTORY_RECORDS, DETECTOR_BATCH_SIZE):
+        lines.extend(metric.render())
+    
+    # the remaining values already live on the cache, scheduler and client objects
+    def sample(name: str, kind: str, help_text: str, value: float) -> None:
+        lines.extend([f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {value}"])
+    
+    sample("inventorylens_upstream_in_flight", "gauge", "Detection API calls currently in flight.", detector.in_flight)
+    sample("inventorylens_upstream_retries_total", "counter", "Detection API calls retried after 503 or 429.", detector.retries)
+    sample("inventorylens_coalesced_requests_total", "counter", "Requests that shared another request's in-flight detection.", detection_flights.coalesced)
+    for stat, value in detection_cache.stats.items():
+        sample(f"inventorylens_cache_{stat}_total", "counter", f"Detection cache {stat.replace('_', ' ')}.", value)
+    sample("inventorylens_cache_entries", "gauge", "Entries in the in-memory detection cache.", detection_cache.snapshot()["entries"])
+    scheduler = upstream_scheduler.snapshot()
+    sample("inventorylens_upstream_queue_depth", "gauge", "Upstream calls waiting for a rate-limit token.", scheduler["queue_depth"])
+    sample("inventorylens_upstream_queue_wait_seconds_total", "counter", "Total time upstream calls waited for a token.", upstream_scheduler.wait_seconds_total)
+    for stat in ("admitted", "queued", "rejected"):
+        sample(f"inventorylens_upstream_{stat}_total", "counter", f"Upstream calls {stat} by the scheduler.", scheduler[stat])
+    return "\n".join(lines) + "\n"
+
 # step 5: feat(huggingface): integrate object detection via HuggingFace inference API
 HF_API_TOKEN = os.getenv("HUGGINGFACE_API_KEY", "")
-OBJECT_DETECTION_URL = "https://api-inference.huggingface.co/models/facebook/detr-resnet-50"
+OBJECT_DETECTION_URL = os.getenv("OBJECT_DETECTION_URL", "https://api-inference.huggingface.co/models/facebook/detr-resnet-50")
 
 headers = {
     "Content-Type": "application/json"
@@ -54,25 +537,1754 @@ if HF_API_TOKEN and HF_API_TOKEN != "huggingface_token":
 else:
     print("No valid HuggingFace API token found - using public inference (may be rate limited)")
 
+# step 6: perf(upstream): pooled async client shared by /detect and /analyze
+DETECTION_THRESHOLD = 0.3
+UPSTREAM_TIMEOUT = float(os.getenv("UPSTREAM_TIMEOUT", "30"))
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "5"))
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "20"))
+UPSTREAM_MAX_IN_FLIGHT = int(os.getenv("UPSTREAM_MAX_IN_FLIGHT", "10"))
+# "json" sends base64 JPEG with parameters.threshold = DETECTION_THRESHOLD; "binary" posts the raw JPEG,
+# which is a third smaller but carries no parameters, so the API applies its own 0.9 default threshold
+UPSTREAM_PAYLOAD_FORMAT = os.getenv("UPSTREAM_PAYLOAD_FORMAT", "json")
+# step 11: perf(upstream): absorb model warm-up and rate limiting with backoff
+UPSTREAM_RETRY_DEADLINE = float(os.getenv("UPSTREAM_RETRY_DEADLINE", "60"))
+UPSTREAM_BACKOFF_BASE = float(os.getenv("UPSTREAM_BACKOFF_BASE", "0.5"))
+UPSTREAM_BACKOFF_MAX = float(os.getenv("UPSTREAM_BACKOFF_MAX", "10"))
+UPSTREAM_WARMUP = os.getenv("UPSTREAM_WARMUP", "0") == "1"
+UPSTREAM_WARMUP_INTERVAL = float(os.getenv("UPSTREAM_WARMUP_INTERVAL", "0"))
+RETRYABLE_STATUS_CODES = {429, 503}
+
+class UpstreamError(Exception):
+    """A failed detection API call, carrying the status code to report to the client.
+
+    retry_after is the number of seconds the API asked us to wait, taken
+    from a Retry-After header or a model-loading estimated_time.
+    """
+
+    def __init__(self, status_code: int, detail: str, retry_after: Optional[float] = None):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+def retry_after_hint(response: "httpx.Response") -> Optional[float]:
+    retry_after = response.headers.get("Retry-After", "")
+    if retry_after.replace(".", "", 1).isdigit():
+        return float(retry_after)
+    try:
+        estimated_time = response.json().get("estimated_time")
+    except Exception:
+        return None
+    return float(estimated_time) if isinstance(estimated_time, (int, float)) else None
+
+def parse_detection_response(response: "httpx.Response") -> List[Dict[str, Any]]:
+    if response.status_code == 401:
+        raise UpstreamError(401, "HuggingFace API authentication failed. Check your API token.")
+    elif response.status_code == 503:
+        raise UpstreamError(503, "Model is loading. Please try again in a few moments.", retry_after_hint(response))
+    elif response.status_code == 429:
+        raise UpstreamError(429, "Rate limit exceeded. Please wait and try again.", retry_after_hint(response))
+    elif response.status_code != 200:
+        try:
+            error_data = response.json()
+            error_msg = error_data.get('error', f'API error (Status {response.status_code})')
+        except Exception:
+            error_msg = f'API error (Status {response.status_code}): {response.text}'
+        raise UpstreamError(500, error_msg)
+    
+    try:
+        detections = response.json()
+    except json.JSONDecodeError:
+        raise UpstreamError(500, "Invalid JSON response from API")
+    
+    if isinstance(detections, dict) and "error" in detections:
+        if "loading" in detections["error"].lower():
+            raise UpstreamError(503, "Model is loading. Please try again in a few moments.", retry_after_hint(response))
+        raise UpstreamError(500, f"API Error: {detections['error']}")
+    
+    if not isinstance(detections, list):
+        raise UpstreamError(500, "Unexpected response format from detection API")
+    
+    return detections
+
+# step 12: perf(upstream): token-bucket scheduler with fair queuing and admission control
+# the limits are for the whole deployment; with several worker processes each takes its share
+WORKER_PROCESSES = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+UPSTREAM_RATE_LIMIT = float(os.getenv("UPSTREAM_RATE_LIMIT", "5")) / WORKER_PROCESSES
+UPSTREAM_BURST = max(1, int(os.getenv("UPSTREAM_BURST", "10")) // WORKER_PROCESSES)
+UPSTREAM_QUEUE_SIZE = int(os.getenv("UPSTREAM_QUEUE_SIZE", "50"))
+UPSTREAM_QUEUE_PER_CLIENT = int(os.getenv("UPSTREAM_QUEUE_PER_CLIENT", "10"))
+# proxies in front of the app that append to X-Forwarded-For (Render has one); 0 ignores the header
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "1"))
+
+current_client_id: ContextVar[str] = ContextVar("current_client_id", default="anonymous")
+
+class QueueFullError(UpstreamError):
+    """Raised when the scheduler cannot take more work; never retried internally."""
+
+class Admission:
+    """A place in a detection queue, held for one request from admission until its first call.
+
+    The held place counts against the queue limits while the request is
+    still being preprocessed, so a burst cannot all pass admission before
+    any of it has reached the queue. The request's first call takes the
+    place over; its later calls (more tiles, retries) queue without being
+    counted or refused, so a request is never cut off halfway through.
+    """
+
+    def __init__(self, limiter: Any, client_id: str):
+        self.limiter = limiter
+        self.client_id = client_id
+        self.held = True
+
+    def take(self) -> bool:
+        """Hand the held place to the calling upstream call; True only for the request's first call."""
+        held, self.held = self.held, False
+        return held
+
+    def release(self) -> None:
+        # a request that ends without ever calling upstream gives its place back here
+        if self.take() and self.limiter is not None:
+            self.limiter.unreserve(self.client_id)
+
+# the running request's admission, read back by the scheduler and the batcher when it calls upstream
+upstream_admission: ContextVar[Optional[Admission]] = ContextVar("upstream_admission", default=None)
+
+class TokenBucket:
+    """Allows rate calls per second on average with bursts of up to burst calls; rate <= 0 disables the limit."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self._updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_take(self) -> bool:
+        if self.rate <= 0:
+            return True
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def time_until_token(self) -> float:
+        if self.rate <= 0:
+            return 0.0
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+class UpstreamScheduler:
+    """Admits upstream calls at the token-bucket rate from a bounded, per-client round-robin queue.
+
+    A caller gets a token straight away when nobody is waiting. Otherwise
+    it joins its client's queue, and a dispatcher hands out tokens one
+    client at a time so a single busy client cannot starve the others.
+    When the queue (or the client's share of it) is full, QueueFullError
+    is raised at once with a Retry-After estimate. The limits count pending
+    requests: those admitted but not yet queued (see Admission) and each
+    queued call that is not a later call of an admitted request.
+    """
+
+    def __init__(
+        self,
+        rate: float = UPSTREAM_RATE_LIMIT,
+        burst: int = UPSTREAM_BURST,
+        max_queue: int = UPSTREAM_QUEUE_SIZE,
+        max_per_client: int = UPSTREAM_QUEUE_PER_CLIENT,
+    ):
+        self.bucket = TokenBucket(rate, burst)
+        self.max_queue = max_queue
+        self.max_per_client = max_per_client
+        self._queues: "OrderedDict[str, deque]" = OrderedDict()
+        self._depth = 0
+        self._pending: Dict[str, int] = {}
+        self._pending_total = 0
+        self._dispatcher: Optional[asyncio.Task] = None
+        self.stats = {"admitted": 0, "queued": 0, "rejected": 0}
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        return self._depth
+
+    def retry_after(self) -> float:
+        if self.bucket.rate <= 0:
+            return 1.0
+        return (max(self._depth, self._pending_total) + 1) / self.bucket.rate
+
+    def check_admission(self, client_id: Optional[str] = None) -> None:
+        client_id = client_id or current_client_id.get()
+        if self._pending_total >= self.max_queue:
+            self.stats["rejected"] += 1
+            raise QueueFullError(503, "Detection queue is full. Please try again later.", self.retry_after())
+        if self._pending.get(client_id, 0) >= self.max_per_client:
+            self.stats["rejected"] += 1
+            raise QueueFullError(429, "Too many queued detections for this client. Please wait and try again.", self.retry_after())
+
+    def admit(self, client_id: Optional[str] = None) -> Admission:
+        """Check the limits for a new request and hold its place until its first call."""
+        client_id = client_id or current_client_id.get()
+        self.check_admission(client_id)
+        self.reserve(client_id)
+        return Admission(self, client_id)
+
+    def reserve(self, client_id: str) -> None:
+        self._pending[client_id] = self._pending.get(client_id, 0) + 1
+        self._pending_total += 1
+
+    def unreserve(self, client_id: str) -> None:
+        remaining = self._pending[client_id] - 1
+        if remaining:
+            self._pending[client_id] = remaining
+        else:
+            del self._pending[client_id]
+        self._pending_total -= 1
+
+    async def acquire(self, client_id: Optional[str] = None) -> None:
+        client_id = client_id or current_client_id.get()
+        admission = upstream_admission.get()
+        admitted = admission is not None and admission.limiter is self
+        # only the first call of an admitted request, or a call made outside one, counts as pending
+        counted = admission.take() if admitted else True
+        if admitted:
+            client_id = admission.client_id
+        started = time.monotonic()
+        if self._depth == 0 and self.bucket.try_take():
+            if admitted and counted:
+                self.unreserve(client_id)
+            self._record_wait(0.0)
+            return
+        
+        if not admitted:
+            self.check_admission(client_id)
+            self.reserve(client_id)
+        future = asyncio.get_running_loop().create_future()
+        entry = (future, counted)
+        queue = self._queues.setdefault(client_id, deque())
+        queue.append(entry)
+        self._depth += 1
+        self.stats["queued"] += 1
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        try:
+            await future
+        except asyncio.CancelledError:
+            if entry in queue:
+                queue.remove(entry)
+                self._depth -= 1
+                if counted:
+                    self.unreserve(client_id)
+                if not queue and self._queues.get(client_id) is queue:
+                    del self._queues[client_id]
+            raise
+        self._record_wait(time.monotonic() - started)
+
+    async def _dispatch(self) -> None:
+        while self._depth:
+            if not self.bucket.try_take():
+                await asyncio.sleep(self.bucket.time_until_token())
+                continue
+            client_id, queue = next(iter(self._queues.items()))
+            future, counted = queue.popleft()
+            self._depth -= 1
+            if counted:
+                self.unreserve(client_id)
+            if queue:
+                self._queues.move_to_end(client_id)
+            else:
+                del self._queues[client_id]
+            if future.done():
+                # the waiter was cancelled between being queued and served; hand the token back
+                self.bucket.tokens = min(self.bucket.burst, self.bucket.tokens + 1)
+            else:
+                future.set_result(None)
+
+    def _record_wait(self, seconds: float) -> None:
+        self.stats["admitted"] += 1
+        self.wait_seconds_total += seconds
+        self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+
+    def snapshot(self) -> Dict[str, Any]:
+        admitted = self.stats["admitted"]
+        return {
+            **self.stats,
+            "queue_depth": self._depth,
+            "pending": self._pending_total,
+            "clients_waiting": len(self._queues),
+            "rate_per_second": self.bucket.rate,
+            "avg_wait_ms": round(self.wait_seconds_total / admitted * 1000, 2) if admitted else 0.0,
+            "max_wait_ms": round(self.wait_seconds_max * 1000, 2)
+        }
+
+upstream_scheduler = UpstreamScheduler()
+
+def client_identity(request: HTTPConnection) -> str:
+    # behind Render's proxy the peer address is the proxy, so use the forwarded hops; only the ones
+    # our own proxies appended can be trusted, the client can put anything to the left of them
+    forwarded_for = request.headers.get("X-Forwarded-For")
+    if forwarded_for and TRUSTED_PROXY_HOPS > 0:
+        hops = [hop.strip() for hop in forwarded_for.split(",") if hop.strip()]
+        if hops:
+            return hops[-min(TRUSTED_PROXY_HOPS, len(hops))]
+    return request.client.host if request.client else "anonymous"
+
+class Detector(ABC):
+    """A detection backend: turns one image into DETR-style [{"score", "label", "box"}] dicts.
+
+    input_format says what detect() takes: "jpeg" bytes for backends that
+    send the image somewhere, or "pixels", a uint8 RGB array of shape
+    (height, width, 3), for in-process models that would only decode the
+    JPEG again. model_id goes into cache keys, so switching backends or
+    models never serves another model's boxes. Failures are raised as
+    UpstreamError whichever backend runs, so the routes report them the
+    same way.
+    """
+
+    name = "detector"
+    input_format = "jpeg"
+    # backends that take long to load do it in the lifespan instead of on the first request
+    load_on_startup = False
+
+    def __init__(self, model_id: str):
+        self.model_id = model_id
+        self.in_flight = 0
+        self.retries = 0
+
+    async def start(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+    def admit(self) -> Admission:
+        """Hold a queue place for one request, or raise QueueFullError when it would only wait to be refused."""
+        return Admission(None, current_client_id.get())
+
+    @abstractmethod
+    async def detect(self, image: Any, timeout: Optional[float] = None, deadline: Optional[float] = None) -> List[Dict[str, Any]]:
+        """Detect objects in image, given in input_format; boxes are in its pixel coordinates."""
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"backend": self.name, "model": self.model_id, "in_flight": self.in_flight, "retries": self.retries}
+
+class DetectionClient(Detector):
+    """Keep-alive connection pool to the detection API.
+
+    One instance is opened on first use and shared by every request. A semaphore
+    caps the number of upstream calls in flight; callers beyond the cap wait
+    on the event loop instead of opening more connections.
+    """
+
+    name = "huggingface"
+
+    def __init__(
+        self,
+        url: str,
+        headers: Dict[str, str],
+        timeout: float = UPSTREAM_TIMEOUT,
+        connect_timeout: float = UPSTREAM_CONNECT_TIMEOUT,
+        max_connections: int = UPSTREAM_MAX_CONNECTIONS,
+        max_in_flight: int = UPSTREAM_MAX_IN_FLIGHT,
+        payload_format: str = UPSTREAM_PAYLOAD_FORMAT,
+        retry_deadline: float = UPSTREAM_RETRY_DEADLINE,
+    ):
+        super().__init__(url)
+        self.url = url
+        self.headers = headers
+        self.payload_format = payload_format
+        self.retry_deadline = retry_deadline
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.max_connections = max_connections
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self._client: Optional["httpx.AsyncClient"] = None
+
+    async def start(self) -> None:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                headers=self.headers,
+                timeout=httpx.Timeout(self.timeout, connect=self.connect_timeout),
+                limits=httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections),
+            )
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def admit(self) -> Admission:
+        return upstream_scheduler.admit()
+
+    def build_request_body(self, jpeg_bytes: bytes) -> Dict[str, Any]:
+        """Keyword arguments for the upstream POST carrying one JPEG image."""
+        if self.payload_format == "json":
+            payload = {
+                "inputs": base64.b64encode(jpeg_bytes).decode(),
+                "parameters": {
+                    "threshold": DETECTION_THRESHOLD
+                }
+            }
+            return {"json": payload}
+        # the image bytes go out as-is; no base64 copy and no JSON wrapping
+        return {"content": jpeg_bytes, "headers": {"Content-Type": "image/jpeg"}}
+
+    def backoff_delay(self, attempt: int, retry_after: Optional[float]) -> float:
+        # jitter keeps a crowd of waiting requests from retrying in lockstep
+        if retry_after is not None:
+            return retry_after * random.uniform(1.0, 1.2)
+        ceiling = min(UPSTREAM_BACKOFF_MAX, UPSTREAM_BACKOFF_BASE * (2 ** attempt))
+        return random.uniform(ceiling / 2, ceiling)
+
+    async def detect(self, jpeg_bytes: bytes, timeout: Optional[float] = None, deadline: Optional[float] = None) -> List[Dict[str, Any]]:
+        """POST one image, retrying 503 "loading" and 429 answers until the retry deadline.
+
+        The last UpstreamError is raised once the next wait would overrun
+        the deadline, so the caller still sees the API's Retry-After hint.
+        """
+        give_up_at = time.monotonic() + (self.retry_deadline if deadline is None else deadline)
+        attempt = 0
+        while True:
+            try:
+                return await self._post(jpeg_bytes, timeout)
+            except UpstreamError as e:
+                if isinstance(e, QueueFullError) or e.status_code not in RETRYABLE_STATUS_CODES:
+                    raise
+                delay = self.backoff_delay(attempt, e.retry_after)
+                if time.monotonic() + delay > give_up_at:
+                    raise
+            attempt += 1
+            self.retries += 1
+            await asyncio.sleep(delay)
+
+    async def _post(self, jpeg_bytes: bytes, timeout: Optional[float] = None) -> List[Dict[str, Any]]:
+        if self._client is None:
+            await self.start()
+        call_timeout = httpx.Timeout(timeout or self.timeout, connect=self.connect_timeout)
+        request_body = self.build_request_body(jpeg_bytes)
+        # every attempt, retries included, spends a rate-limit token
+        with timed_stage("queue_wait"):
+            await upstream_scheduler.acquire()
+        async with self._semaphore:
+            self.in_flight += 1
+            start = time.perf_counter()
+            try:
+                response = await self._client.post(self.url, timeout=call_timeout, **request_body)
+            except httpx.TimeoutException as e:
+                UPSTREAM_RESPONSES.inc(status="timeout")
+                raise UpstreamError(504, f"API request timed out: {str(e) or type(e).__name__}")
+            except httpx.HTTPError as e:
+                UPSTREAM_RESPONSES.inc(status="error")
+                raise UpstreamError(500, f"API request failed: {str(e)}")
+            finally:
+                self.in_flight -= 1
+                record_stage("upstream", time.perf_counter() - start)
+        UPSTREAM_RESPONSES.inc(status=response.status_code)
+        return parse_detection_response(response)
+
+async def keep_model_warm(client: Detector, interval: float = UPSTREAM_WARMUP_INTERVAL) -> None:
+    """Ping the model once at startup, then every interval seconds when interval > 0."""
+    image = Image.new("RGB", (32, 32), (128, 128, 128))
+    if client.input_format == "pixels":
+        probe = np.asarray(image)
+    else:
+        buffered = io.BytesIO()
+        image.save(buffered, format="JPEG")
+        probe = buffered.getvalue()
+    while True:
+        try:
+            await client.detect(probe)
+            print("Detection model warm-up succeeded")
+        except UpstreamError as e:
+            print(f"Detection model warm-up failed: {e.detail}")
+        if interval <= 0:
+            return
+        await asyncio.sleep(interval)
+
+# step 22: feat(detectors): pluggable detector backends with an in-process ONNX Runtime engine
+DETECTOR_BACKEND = os.getenv("DETECTOR_BACKEND", "huggingface")
+# a Hugging Face ONNX export of DETR, with its config.json (for id2label) in the same directory
+LOCAL_MODEL_PATH = os.getenv("LOCAL_MODEL_PATH", "models/detr-resnet-50/model.onnx")
+LOCAL_INPUT_SIZE = int(os.getenv("LOCAL_INPUT_SIZE", "800"))
+LOCAL_THREADS = int(os.getenv("LOCAL_THREADS", str(max(1, (os.cpu_count() or 1) // WORKER_PROCESSES))))
+LOCAL_BATCH_SIZE = int(os.getenv("LOCAL_BATCH_SIZE", "8"))
+LOCAL_BATCH_WAIT = float(os.getenv("LOCAL_BATCH_WAIT_MS", "10")) / 1000
+LOCAL_QUEUE_SIZE = int(os.getenv("LOCAL_QUEUE_SIZE", "64"))
+# DETR's ImageNet normalization
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+
+class MicroBatcher:
+    """Groups concurrent calls into batches for one batch function.
+
+    The first call to arrive opens a batch, which runs once max_size calls
+    have joined or max_wait seconds have passed. Calls arriving while a
+    batch runs make up the next one, so under load batches fill without
+    waiting and a lone call is delayed by at most max_wait. Only one batch
+    runs at a time.
+    """
+
+    def __init__(self, run_batch: Callable, max_size: int = LOCAL_BATCH_SIZE,
+                 max_wait: float = LOCAL_BATCH_WAIT, max_queue: int = LOCAL_QUEUE_SIZE):
+        self.run_batch = run_batch
+        self.max_size = max(1, max_size)
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._pending = 0
+        self.stats = {"batches": 0, "items": 0, "rejected": 0}
+        self.batch_seconds_total = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def start(self) -> None:
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run_forever())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        while self._queue is not None and not self._queue.empty():
+            _, future, counted = self._queue.get_nowait()
+            self._pending -= counted
+            if not future.done():
+                future.set_exception(UpstreamError(503, "Detector is shutting down, try again shortly", 5.0))
+
+    def check_admission(self) -> None:
+        # admitted requests still in preprocessing count as well as the calls already queued
+        if self._pending >= self.max_queue:
+            self.stats["rejected"] += 1
+            raise QueueFullError(503, "Detection queue is full. Please try again later.", self.retry_after())
+
+    def admit(self, client_id: Optional[str] = None) -> Admission:
+        self.check_admission()
+        self.reserve(client_id)
+        return Admission(self, client_id or current_client_id.get())
+
+    def reserve(self, client_id: Optional[str] = None) -> None:
+        self._pending += 1
+
+    def unreserve(self, client_id: Optional[str] = None) -> None:
+        self._pending -= 1
+
+    def retry_after(self) -> float:
+        if not self.stats["batches"]:
+            return 1.0
+        return (self.queue_depth / self.max_size + 1) * self.batch_seconds_total / self.stats["batches"]
+
+    async def submit(self, item: Any) -> Any:
+        self.start()
+        admission = upstream_admission.get()
+        admitted = admission is not None and admission.limiter is self
+        counted = admission.take() if admitted else True
+        if not admitted:
+            self.check_admission()
+            self.reserve()
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((item, future, counted))
+        return await future
+
+    async def _run_forever(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            closes_at = loop.time() + self.max_wait
+            while len(batch) < self.max_size:
+                if not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                    continue
+                remaining = closes_at - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            
+            # these calls have left the queue, so their places are free for new requests
+            self._pending -= sum(counted for _, _, counted in batch)
+            # callers that timed out or disconnected while queued are left out of the forward pass
+            batch = [(item, future) for item, future, _ in batch if not future.done()]
+            if not batch:
+                continue
+            DETECTOR_BATCH_SIZE.observe(len(batch))
+            self.stats["batches"] += 1
+            self.stats["items"] += len(batch)
+            start = time.perf_counter()
+            try:
+                results = await self.run_batch([item for item, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            finally:
+                self.batch_seconds_total += time.perf_counter() - start
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def snapshot(self) -> Dict[str, Any]:
+        batches = self.stats["batches"]
+        return {
+            **self.stats,
+            "queue_depth": self.queue_depth,
+            "pending": self._pending,
+            "max_batch_size": self.max_size,
+            "max_wait_ms": round(self.max_wait * 1000, 2),
+            "avg_batch_size": round(self.stats["items"] / batches, 2) if batches else 0.0,
+            "avg_batch_ms": round(self.batch_seconds_total / batches * 1000, 2) if batches else 0.0
+        }
+
+def prepare_model_input(pixels: "np.ndarray", input_size: int = LOCAL_INPUT_SIZE) -> Tuple["np.ndarray", Tuple[int, int]]:
+    """Shrink uint8 HWC pixels to fit input_size on their longer side.
+
+    Returns the model-sized pixels and the (width, height) the boxes are
+    reported in; the forward pass normalizes each image on its own and
+    copies it onto the zero-padded batch canvas, so padding stays zero.
+    Uploads are already resized to MAX_IMAGE_SIZE, so with the default
+    sizes this only touches larger tiles.
+    """
+    size = (pixels.shape[1], pixels.shape[0])
+    scale = input_size / max(size)
+    if scale < 1:
+        image = Image.fromarray(pixels).resize((round(size[0] * scale), round(size[1] * scale)), Image.Resampling.BILINEAR)
+        pixels = np.asarray(image)
+    return pixels, size
+
+class OnnxDetector(Detector):
+    """DETR exported to ONNX, run in-process by ONNX Runtime on the CPU.
+
+    The model takes pixel_values (and pixel_mask, if it declares one) and
+    returns logits and pred_boxes, like the Hugging Face exports. It is
+    handed the decoded pixels from preprocessing, so no JPEG is encoded
+    and decoded again on the way; the forward passes run one at a time on
+    their own thread, with concurrent detections grouped into a single
+    batch by a MicroBatcher.
+    """
+
+    name = "onnx"
+    input_format = "pixels"
+    load_on_startup = True
+
+    def __init__(self, model_path: str, input_size: int = LOCAL_INPUT_SIZE, threads: int = LOCAL_THREADS,
+                 batch_size: int = LOCAL_BATCH_SIZE, batch_wait: float = LOCAL_BATCH_WAIT,
+                 queue_size: int = LOCAL_QUEUE_SIZE, timeout: float = UPSTREAM_TIMEOUT):
+        super().__init__(f"onnx:{os.path.abspath(model_path)}:{input_size}")
+        self.model_path = model_path
+        self.input_size = input_size
+        self.threads = threads
+        self.timeout = timeout
+        self.batcher = MicroBatcher(self._run_batch, batch_size, batch_wait, queue_size)
+        self._session = None
+        self._input_names: set = set()
+        self._labels: Dict[int, str] = {}
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    async def start(self) -> None:
+        if self._session is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="detector")
+            self._session, self._labels = await asyncio.get_running_loop().run_in_executor(self._executor, self._load)
+            self._input_names = {model_input.name for model_input in self._session.get_inputs()}
+            self.batcher.start()
+
+    def _load(self):
+        try:
+            ort = importlib.import_module("onnxruntime")
+        except ImportError:
+            raise RuntimeError("DETECTOR_BACKEND=onnx needs ONNX Runtime: pip install onnxruntime")
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = self.threads
+        options.inter_op_num_threads = 1
+        session = ort.InferenceSession(self.model_path, options, providers=["CPUExecutionProvider"])
+        config_path = Path(self.model_path).with_name("config.json")
+        id2label = json.loads(config_path.read_text()).get("id2label", {}) if config_path.exists() else {}
+        return session, {int(class_id): label for class_id, label in id2label.items()}
+
+    async def close(self) -> None:
+        await self.batcher.close()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        self._session = None
+
+    def admit(self) -> Admission:
+        return self.batcher.admit()
+
+    async def detect(self, image: "np.ndarray", timeout: Optional[float] = None, deadline: Optional[float] = None) -> List[Dict[str, Any]]:
+        if self._session is None:
+            await self.start()
+        self.in_flight += 1
+        try:
+            with timed_stage("model_input"):
+                item = await run_in_preprocess_pool(prepare_model_input, image, self.input_size)
+            submitted = time.perf_counter()
+            try:
+                detections, inference_seconds = await asyncio.wait_for(self.batcher.submit(item), timeout or self.timeout)
+            except asyncio.TimeoutError:
+                raise UpstreamError(504, "Local detection timed out", self.batcher.retry_after())
+        finally:
+            self.in_flight -= 1
+        record_stage("queue_wait", max(0.0, time.perf_counter() - submitted - inference_seconds))
+        record_stage("inference", inference_seconds)
+        return detections
+
+    async def _run_batch(self, items: List[Tuple["np.ndarray", Tuple[int, int]]]) -> List[Tuple[List[Dict[str, Any]], float]]:
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, self._forward, items)
+        except Exception as e:
+            raise UpstreamError(500, f"Local detection failed: {str(e)}")
+
+    def _forward(self, items: List[Tuple["np.ndarray", Tuple[int, int]]]) -> List[Tuple[List[Dict[str, Any]], float]]:
+        start = time.perf_counter()
+        masked = "pixel_mask" in self._input_names
+        if masked:
+            # pad to the largest image in the batch; pixel_mask tells DETR which pixels are padding
+            height = max(pixels.shape[0] for pixels, _ in items)
+            width = max(pixels.shape[1] for pixels, _ in items)
+        else:
+            # without a mask the model sees the padding as part of the image, so every image is
+            # letterboxed onto the same fixed canvas and its boxes never depend on its batch companions
+            height = width = self.input_size
+        pixel_values = np.zeros((len(items), 3, height, width), dtype=np.float32)
+        pixel_mask = np.zeros((len(items), height, width), dtype=np.int64)
+        mean = np.array(IMAGENET_MEAN, dtype=np.float32)
+        std = np.array(IMAGENET_STD, dtype=np.float32)
+        for i, (pixels, _) in enumerate(items):
+            rows, cols = pixels.shape[:2]
+            pixel_values[i, :, :rows, :cols] = ((pixels.astype(np.float32) / 255.0 - mean) / std).transpose(2, 0, 1)
+            pixel_mask[i, :rows, :cols] = 1
+        feeds = {"pixel_values": pixel_values}
+        if masked:
+            feeds["pixel_mask"] = pixel_mask
+        logits, pred_boxes = self._session.run(["logits", "pred_boxes"], feeds)
+        seconds = time.perf_counter() - start
+        results = []
+        for i, (pixels, size) in enumerate(items):
+            rows, cols = pixels.shape[:2]
+            # boxes are relative to the unpadded image with a mask and to the whole canvas without one
+            frame = (cols, rows) if masked else (width, height)
+            results.append((self._decode(logits[i], pred_boxes[i], frame, (size[0] / cols, size[1] / rows), size), seconds))
+        return results
+
+    def _decode(self, logits: "np.ndarray", pred_boxes: "np.ndarray", frame: Tuple[int, int],
+                scale: Tuple[float, float], size: Tuple[int, int]) -> List[Dict[str, Any]]:
+        """Turn one image's outputs into detections in the coordinates of size.
+
+        pred_boxes are (center x, center y, width, height) as fractions of
+        frame, in model-input pixels; scale maps those back to size.
+        """
+        # softmax over the classes; the last one is DETR's "no object"
+        probabilities = np.exp(logits - logits.max(axis=-1, keepdims=True))
+        probabilities /= probabilities.sum(axis=-1, keepdims=True)
+        probabilities = probabilities[:, :-1]
+        class_ids = probabilities.argmax(axis=-1)
+        scores = probabilities.max(axis=-1)
+        kept = np.flatnonzero(scores > DETECTION_THRESHOLD)
+        cx, cy, w, h = pred_boxes[kept].T
+        x_scale, y_scale = frame[0] * scale[0], frame[1] * scale[1]
+        corners = np.stack([(cx - w / 2) * x_scale, (cy - h / 2) * y_scale, (cx + w / 2) * x_scale, (cy + h / 2) * y_scale], axis=1)
+        width, height = size
+        corners = np.clip(np.rint(corners), 0, [width, height, width, height]).astype(int).tolist()
+        return [
+            {
+                "score": round(float(scores[index]), 4),
+                "label": self._labels.get(int(class_ids[index]), f"LABEL_{int(class_ids[index])}"),
+                "box": {"xmin": xmin, "ymin": ymin, "xmax": xmax, "ymax": ymax}
+            }
+            for index, (xmin, ymin, xmax, ymax) in zip(kept.tolist(), corners)
+        ]
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {**super().snapshot(), "loaded": self._session is not None, "threads": self.threads, "batching": self.batcher.snapshot()}
+
+DETECTOR_BACKENDS: Dict[str, Callable[[], Detector]] = {
+    "huggingface": lambda: DetectionClient(OBJECT_DETECTION_URL, headers),
+    "onnx": lambda: OnnxDetector(LOCAL_MODEL_PATH),
+}
+
+def build_detector(backend: str = DETECTOR_BACKEND) -> Detector:
+    if backend not in DETECTOR_BACKENDS:
+        raise ValueError(f"Unknown DETECTOR_BACKEND {backend!r}; expected one of {', '.join(DETECTOR_BACKENDS)}")
+    return DETECTOR_BACKENDS[backend]()
+
+detector = build_detector()
+
+# step 7: perf(cache): content-addressed cache for detection results
+DETECTION_CACHE_SIZE = int(os.getenv("DETECTION_CACHE_SIZE", "256"))
+DETECTION_CACHE_TTL = float(os.getenv("DETECTION_CACHE_TTL", "3600"))
+DETECTION_CACHE_DIR = os.getenv("DETECTION_CACHE_DIR", "")
+DETECTION_CACHE_DISK_ENTRIES = int(os.getenv("DETECTION_CACHE_DISK_ENTRIES", "10000"))
+DETECTION_CACHE_SWEEP_INTERVAL = float(os.getenv("DETECTION_CACHE_SWEEP_INTERVAL", "300"))
+
+def image_digest(image_data: bytes) -> str:
+    return hashlib.sha256(image_data).hexdigest()
+
+def image_cache_key(image_hash: str, variant: str = "") -> str:
+    # the detector's model id is part of the key so switching models never serves stale boxes;
+    # variant separates results computed differently from the same bytes, such as tiled runs
+    digest = hashlib.sha256(detector.model_id.encode())
+    if variant:
+        digest.update(variant.encode())
+    digest.update(image_hash.encode())
+    return digest.hexdigest()
+
+class DetectionCache:
+    """LRU + TTL cache of raw detection results, keyed by image hash.
+
+    The in-memory tier holds at most max_entries results. When a directory is
+    configured, entries are also written there as JSON so they survive
+    restarts; a disk hit is promoted back into memory. At most every
+    sweep_interval seconds, a write also sweeps the directory, deleting
+    expired files and then the oldest ones beyond max_disk_entries.
+    """
+
+    def __init__(self, max_entries: int = DETECTION_CACHE_SIZE, ttl: float = DETECTION_CACHE_TTL, directory: str = DETECTION_CACHE_DIR,
+                 max_disk_entries: int = DETECTION_CACHE_DISK_ENTRIES, sweep_interval: float = DETECTION_CACHE_SWEEP_INTERVAL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.directory = Path(directory) if directory else None
+        self.max_disk_entries = max_disk_entries
+        self.sweep_interval = sweep_interval
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        # the first write after a restart sweeps up what earlier processes left behind
+        self._last_sweep = float("-inf")
+        self._sweeping = False
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "disk_evictions": 0}
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.json"
+
+    def _expired(self, stored_at: float) -> bool:
+        return self.ttl > 0 and time.time() - stored_at > self.ttl
+
+    def _remember(self, key: str, stored_at: float, value: Dict[str, Any]) -> None:
+        self._entries[key] = (stored_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def _disk_get(self, key: str) -> Optional[tuple]:
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if self._expired(record["stored_at"]):
+            path.unlink(missing_ok=True)
+            return None
+        return record["stored_at"], record["value"]
+
+    def _disk_set(self, key: str, stored_at: float, value: Dict[str, Any]) -> None:
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"stored_at": stored_at, "value": value}, f)
+        os.replace(tmp_path, path)
+
+    def _disk_sweep(self) -> int:
+        """Delete expired entries, then the least recently written ones beyond max_disk_entries."""
+        now = time.time()
+        files = []
+        for path in self.directory.glob("*/*"):
+            try:
+                modified = path.stat().st_mtime
+            except OSError:
+                continue
+            # a .tmp older than a minute belongs to a write that never finished
+            if path.suffix == ".tmp" and now - modified > 60:
+                path.unlink(missing_ok=True)
+            elif path.suffix == ".json":
+                files.append((modified, path))
+        files.sort()
+        expired = sum(1 for modified, _ in files if self._expired(modified)) if self.ttl > 0 else 0
+        doomed = max(expired, len(files) - self.max_disk_entries)
+        for _, path in files[:doomed]:
+            path.unlink(missing_ok=True)
+        return doomed
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            if not self._expired(entry[0]):
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry[1]
+            del self._entries[key]
+            self.stats["expirations"] += 1
+        if self.directory is not None:
+            record = await asyncio.to_thread(self._disk_get, key)
+            if record is not None:
+                self._remember(key, *record)
+                self.stats["disk_hits"] += 1
+                return record[1]
+        self.stats["misses"] += 1
+        return None
+
+    async def set(self, key: str, value: Dict[str, Any]) -> None:
+        if self.max_entries <= 0:
+            return
+        stored_at = time.time()
+        self._remember(key, stored_at, value)
+        if self.directory is not None:
+            try:
+                await asyncio.to_thread(self._disk_set, key, stored_at, value)
+            except OSError as e:
+                print(f"Detection cache write failed: {e}")
+            if not self._sweeping and time.monotonic() - self._last_sweep >= self.sweep_interval:
+                self._sweeping = True
+                try:
+                    self.stats["disk_evictions"] += await asyncio.to_thread(self._disk_sweep)
+                except OSError as e:
+                    print(f"Detection cache sweep failed: {e}")
+                finally:
+                    self._last_sweep = time.monotonic()
+                    self._sweeping = False
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl,
+            "disk": str(self.directory) if self.directory else None
+        }
+
+detection_cache = DetectionCache()
+
+# step 18: feat(history): server-side analysis history in SQLite with batched writes
+HISTORY_DB_PATH = os.getenv("HISTORY_DB_PATH", "inventorylens_history.sqlite3")
+HISTORY_BATCH_SIZE = int(os.getenv("HISTORY_BATCH_SIZE", "500"))
+HISTORY_FLUSH_INTERVAL = float(os.getenv("HISTORY_FLUSH_INTERVAL", "0.5"))
+HISTORY_QUEUE_SIZE = int(os.getenv("HISTORY_QUEUE_SIZE", "10000"))
+HISTORY_KEEP_DETECTIONS = os.getenv("HISTORY_KEEP_DETECTIONS", "true").lower() == "true"
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 500
+HISTORY_ROLLUP_SECONDS = 3600
+
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS analyses (
+    id INTEGER PRIMARY KEY,
+    created_at REAL NOT NULL,
+    endpoint TEXT NOT NULL,
+    filename TEXT,
+    image_hash TEXT NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    total_objects INTEGER NOT NULL,
+    cached INTEGER NOT NULL,
+    object_counts TEXT NOT NULL,
+    detections TEXT
+);
+CREATE INDEX IF NOT EXISTS analyses_created_at ON analyses (created_at);
+CREATE INDEX IF NOT EXISTS analyses_image_hash ON analyses (image_hash, id);
+CREATE TABLE IF NOT EXISTS analysis_labels (
+    analysis_id INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    label TEXT NOT NULL,
+    count INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS analysis_labels_time ON analysis_labels (created_at, label, count);
+CREATE INDEX IF NOT EXISTS analysis_labels_label ON analysis_labels (label, analysis_id);
+CREATE TABLE IF NOT EXISTS label_counts_hourly (
+    bucket INTEGER NOT NULL,
+    label TEXT NOT NULL,
+    analyses INTEGER NOT NULL,
+    objects INTEGER NOT NULL,
+    PRIMARY KEY (bucket, label)
+) WITHOUT ROWID;
+"""
+
+class HistoryStore:
+    """Append-only log of detection results in SQLite.
+
+    record() only puts the result on a bounded queue, so the request path
+    never waits on the disk; a writer task commits queued results in
+    batches, one transaction per batch, on a dedicated thread. When the
+    queue is full new records are dropped and counted instead.
+
+    Each analysis has one analysis_labels row per label, and per-hour
+    label totals are kept in label_counts_hourly in the same transaction,
+    so label aggregates over long ranges read the rollup and only scan
+    raw rows for the partial hours at either end.
+    """
+
+    def __init__(self, path: str = HISTORY_DB_PATH, batch_size: int = HISTORY_BATCH_SIZE,
+                 flush_interval: float = HISTORY_FLUSH_INTERVAL, queue_size: int = HISTORY_QUEUE_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue_size = queue_size
+        self._queue: Optional[asyncio.Queue] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._connection: Optional[sqlite3.Connection] = None
+        self._writer: Optional[asyncio.Task] = None
+        self._collecting: List[tuple] = []
+        self.stats = {"written": 0, "dropped": 0, "batches": 0, "failed": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    async def start(self) -> None:
+        if not self.enabled or self._writer is not None:
+            return
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        # sqlite connections are single-threaded, so every write goes through one worker thread
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history")
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._open)
+        self._writer = asyncio.create_task(self._write_forever())
+
+    def _open(self) -> None:
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(HISTORY_SCHEMA)
+
+    async def close(self) -> None:
+        if self._writer is None:
+            return
+        self._writer.cancel()
+        try:
+            await self._writer
+        except asyncio.CancelledError:
+            pass
+        self._writer = None
+        # whatever is still queued at shutdown is written before the connection closes
+        remaining, self._collecting = self._collecting, []
+        while not self._queue.empty():
+            remaining.append(self._queue.get_nowait())
+        loop = asyncio.get_running_loop()
+        if remaining:
+            write = loop.run_in_executor(self._executor, self._write, remaining)
+            try:
+                await write
+            except sqlite3.Error:
+                pass
+            finally:
+                self._record_write(len(remaining), write)
+        await loop.run_in_executor(self._executor, self._connection.close)
+        self._executor.shutdown(wait=True)
+        self._connection = None
+
+    def record(self, endpoint: str, filename: Optional[str], outcome: Dict[str, Any]) -> None:
+        if self._writer is None or outcome.get("error") is not None:
+            return
+        object_detection = outcome["object_detection"]
+        image_info = outcome.get("image_info") or {}
+        width, height = image_info.get("size") or (None, None)
+        entry = (
+            time.time(), endpoint, filename, outcome["image_hash"], width, height,
+            object_detection["total_objects"], int(bool(outcome.get("cached"))),
+            object_detection["object_counts"],
+            object_detection["detections"] if HISTORY_KEEP_DETECTIONS else None,
+        )
+        try:
+            self._queue.put_nowait(entry)
+        except asyncio.QueueFull:
+            self.stats["dropped"] += 1
+            HISTORY_RECORDS.inc(outcome="dropped")
+
+    async def _write_forever(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            self._collecting = [await self._queue.get()]
+            # give a burst time to accumulate so it lands in one transaction
+            await asyncio.sleep(self.flush_interval)
+            while len(self._collecting) < self.batch_size and not self._queue.empty():
+                self._collecting.append(self._queue.get_nowait())
+            # once handed to the writer thread the batch completes even if this task is cancelled,
+            # so a cancelled task waits for it and counts it before stopping
+            batch, self._collecting = self._collecting, []
+            write = loop.run_in_executor(self._executor, self._write, batch)
+            try:
+                await asyncio.shield(write)
+            except asyncio.CancelledError:
+                await asyncio.wait([write])
+                raise
+            except sqlite3.Error:
+                pass
+            finally:
+                self._record_write(len(batch), write)
+
+    def _record_write(self, count: int, write: "asyncio.Future") -> None:
+        # the stats and metrics are shared with the event loop, so only the loop updates them;
+        # the writer thread just returns how long the batch took
+        if not write.done() or write.cancelled():
+            return
+        error = write.exception()
+        if error is None:
+            self.stats["written"] += count
+            self.stats["batches"] += 1
+            HISTORY_RECORDS.inc(count, outcome="written")
+            record_stage("history_write", write.result())
+        elif isinstance(error, sqlite3.Error):
+            self.stats["failed"] += count
+            HISTORY_RECORDS.inc(count, outcome="failed")
+            print(f"History write failed: {error}")
+
+    def _write(self, batch: List[tuple]) -> float:
+        start = time.perf_counter()
+        label_rows = []
+        rollup: Dict[Tuple[int, str], List[int]] = {}
+        with self._connection:
+            cursor = self._connection.cursor()
+            for created_at, endpoint, filename, image_hash, width, height, total, cached, counts, detections in batch:
+                cursor.execute(
+                    "INSERT INTO analyses (created_at, endpoint, filename, image_hash, width, height, total_objects, cached, object_counts, detections)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (created_at, endpoint, filename, image_hash, width, height, total, cached,
+                     orjson.dumps(counts).decode(), None if detections is None else orjson.dumps(detections).decode()),
+                )
+                bucket = int(created_at // HISTORY_ROLLUP_SECONDS) * HISTORY_ROLLUP_SECONDS
+                for label, count in counts.items():
+                    label_rows.append((cursor.lastrowid, created_at, label, count))
+                    totals = rollup.setdefault((bucket, label), [0, 0])
+                    totals[0] += 1
+                    totals[1] += count
+            cursor.executemany("INSERT INTO analysis_labels (analysis_id, created_at, label, count) VALUES (?, ?, ?, ?)", label_rows)
+            cursor.executemany(
+                "INSERT INTO label_counts_hourly (bucket, label, analyses, objects) VALUES (?, ?, ?, ?)"
+                " ON CONFLICT (bucket, label) DO UPDATE SET analyses = analyses + excluded.analyses, objects = objects + excluded.objects",
+                [(bucket, label, analyses, objects) for (bucket, label), (analyses, objects) in rollup.items()],
+            )
+        return time.perf_counter() - start
+
+    def _read(self, query: str, params: Sequence[Any]) -> List[sqlite3.Row]:
+        # readers get their own connection; WAL lets them run while a batch is being written
+        connection = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        try:
+            connection.row_factory = sqlite3.Row
+            return connection.execute(query, params).fetchall()
+        finally:
+            connection.close()
+
+    async def query(self, query: str, params: Sequence[Any] = ()) -> List[sqlite3.Row]:
+        return await asyncio.to_thread(self._read, query, params)
+
+    async def page(self, limit: int, before_id: Optional[int] = None, since: Optional[float] = None,
+                   until: Optional[float] = None, label: Optional[str] = None, image_hash: Optional[str] = None) -> List[sqlite3.Row]:
+        """Newest-first analyses; pages continue from before_id, so deep pages cost the same as the first."""
+        # with a label the walk runs down the (label, analysis_id) index and stops after limit matches
+        source = "analysis_labels l JOIN analyses a ON a.id = l.analysis_id" if label is not None else "analyses a"
+        id_column = "l.analysis_id" if label is not None else "a.id"
+        conditions, params = [], []
+        for condition, value in (
+            ("l.label = ?", label),
+            (f"{id_column} < ?", before_id),
+            ("a.created_at >= ?", since),
+            ("a.created_at < ?", until),
+            ("a.image_hash = ?", image_hash),
+        ):
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        return await self.query(
+            "SELECT a.id, a.created_at, a.endpoint, a.filename, a.image_hash, a.width, a.height, a.total_objects, a.cached, a.object_counts"
+            f" FROM {source} {where} ORDER BY {id_column} DESC LIMIT ?",
+            [*params, limit],
+        )
+
+    async def label_totals(self, since: float, until: float, label: Optional[str] = None) -> Dict[str, Dict[str, int]]:
+        """Analyses and objects per label with created_at in [since, until)."""
+        first_bucket = math.ceil(since / HISTORY_ROLLUP_SECONDS) * HISTORY_ROLLUP_SECONDS
+        last_bucket = math.floor(until / HISTORY_ROLLUP_SECONDS) * HISTORY_ROLLUP_SECONDS
+        label_filter = " AND label = ?" if label is not None else ""
+        label_params = [label] if label is not None else []
+        if first_bucket < last_bucket:
+            # whole hours come from the rollup; only the ragged ends scan raw rows
+            raw_ranges = [(since, first_bucket), (last_bucket, until)]
+            rollup_rows = await self.query(
+                "SELECT label, SUM(analyses) AS analyses, SUM(objects) AS objects FROM label_counts_hourly"
+                f" WHERE bucket >= ? AND bucket < ?{label_filter} GROUP BY label",
+                [first_bucket, last_bucket, *label_params],
+            )
+        else:
+            raw_ranges = [(since, until)]
+            rollup_rows = []
+        
+        totals: Dict[str, Dict[str, int]] = {}
+        def add(rows):
+            for row in rows:
+                entry = totals.setdefault(row["label"], {"analyses": 0, "objects": 0})
+                entry["analyses"] += row["analyses"]
+                entry["objects"] += row["objects"]
+        add(rollup_rows)
+        for start, end in raw_ranges:
+            if start < end:
+                add(await self.query(
+                    "SELECT label, COUNT(*) AS analyses, SUM(count) AS objects FROM analysis_labels"
+                    f" WHERE created_at >= ? AND created_at < ?{label_filter} GROUP BY label",
+                    [start, end, *label_params],
+                ))
+        return dict(sorted(totals.items(), key=lambda item: -item[1]["objects"]))
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "enabled": self._writer is not None,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "path": self.path or None
+        }
+
+history_store = HistoryStore()
+
 # step 3: feat(utils): add image encoding and preprocessing utilities
-def encode_image_to_base64(image: Image.Image) -> str:
+def encode_image_to_jpeg(image: "Image.Image") -> bytes:
     buffered = io.BytesIO()
     if image.mode in ('RGBA', 'LA', 'P'):
         image = image.convert('RGB')
     image.save(buffered, format="JPEG", quality=90)
-    img_str = base64.b64encode(buffered.getvalue()).decode()
-    return img_str
+    return buffered.getvalue()
 
-def process_image(image: Image.Image) -> Image.Image:
+def encode_image_to_base64(image: "Image.Image") -> str:
+    return base64.b64encode(encode_image_to_jpeg(image)).decode()
+
+def process_image(image: "Image.Image") -> "Image.Image":
     if image.mode != "RGB":
         image = image.convert("RGB")
-    max_size = 800
+    max_size = MAX_IMAGE_SIZE
     if max(image.size) > max_size:
         ratio = max_size / max(image.size)
         new_size = tuple(int(dim * ratio) for dim in image.size)
         image = image.resize(new_size, Image.Resampling.LANCZOS)
     return image
 
+# step 9: perf(preprocess): reduced-size JPEG decoding in a worker pool
+MAX_IMAGE_SIZE = 800
+PREPROCESS_EXECUTOR = os.getenv("PREPROCESS_EXECUTOR", "thread")
+PREPROCESS_WORKERS = int(os.getenv("PREPROCESS_WORKERS", str(max(1, (os.cpu_count() or 1) // WORKER_PROCESSES))))
+PREPROCESS_DRAFT = os.getenv("PREPROCESS_DRAFT", "1") != "0"
+
+def apply_draft(image: "Image.Image", max_size: int = MAX_IMAGE_SIZE) -> "Image.Image":
+    """Let libjpeg decode at 1/2, 1/4 or 1/8 scale when that still covers max_size.
+
+    Image.draft only picks a scale whose output is at least the requested
+    size, so the LANCZOS pass in process_image still sees enough pixels.
+    """
+    if image.format == "JPEG" and max(image.size) > max_size:
+        ratio = max_size / max(image.size)
+        image.draft("RGB", (max(1, int(image.size[0] * ratio)), max(1, int(image.size[1] * ratio))))
+    return image
+
+# step 10: perf(payload): send small RGB JPEG uploads upstream untouched
+UPSTREAM_PASSTHROUGH = os.getenv("UPSTREAM_PASSTHROUGH", "1") != "0"
+PASSTHROUGH_MAX_BYTES = int(os.getenv("PASSTHROUGH_MAX_BYTES", str(1024 * 1024)))
+
+def can_pass_through(image: "Image.Image", byte_size: int) -> bool:
+    # only the header has been read here; a pass-through upload is never decoded
+    return (
+        image.format == "JPEG"
+        and image.mode == "RGB"
+        and max(image.size) <= MAX_IMAGE_SIZE
+        and byte_size <= PASSTHROUGH_MAX_BYTES
+    )
+
+def model_input(image: "Image.Image", input_format: str) -> Any:
+    # an in-process model takes the decoded pixels; only a remote one needs them encoded
+    if input_format == "pixels":
+        return np.asarray(image)
+    return encode_image_to_jpeg(image)
+
+def prepare_image(
+    image_data: bytes,
+    use_draft: bool = PREPROCESS_DRAFT,
+    allow_passthrough: bool = UPSTREAM_PASSTHROUGH,
+    input_format: str = "jpeg",
+) -> Tuple[Dict[str, Any], Any, Dict[str, Any], Dict[str, float]]:
+    """Turn an upload into the detector's input: the JPEG sent upstream, or RGB pixels.
+
+    Returns the image info, the JPEG bytes (or, for input_format="pixels",
+    a uint8 array), a payload report with the byte size, whether the upload
+    was passed through and the time spent decoding and encoding, and the
+    seconds spent in each of the decode, resize and encode stages. Stage
+    times are returned rather than recorded because this may run in
+    another process.
+    """
+    start = time.perf_counter()
+    stage_seconds = {}
+    image = Image.open(io.BytesIO(image_data))
+    passthrough = input_format == "jpeg" and allow_passthrough and can_pass_through(image, len(image_data))
+    if passthrough:
+        payload = image_data
+    else:
+        if use_draft:
+            image = apply_draft(image)
+        image.load()
+        decoded = time.perf_counter()
+        stage_seconds["decode"] = decoded - start
+        image = process_image(image)
+        resized = time.perf_counter()
+        stage_seconds["resize"] = resized - decoded
+        payload = model_input(image, input_format)
+        stage_seconds["encode"] = time.perf_counter() - resized
+    image_info = {
+        "size": image.size,
+        "mode": image.mode
+    }
+    if input_format == "pixels":
+        body_bytes = payload.nbytes
+    else:
+        body_bytes = len(payload)
+        if UPSTREAM_PAYLOAD_FORMAT == "json":
+            # base64 inflates the body by a third
+            body_bytes = 4 * ((body_bytes + 2) // 3)
+    payload_info = {
+        "format": UPSTREAM_PAYLOAD_FORMAT if input_format == "jpeg" else input_format,
+        "passthrough": passthrough,
+        "bytes": body_bytes,
+        "encode_ms": round((time.perf_counter() - start) * 1000, 2)
+    }
+    return image_info, payload, payload_info, stage_seconds
+
+_preprocess_pool: Optional[Executor] = None
+
+def get_preprocess_pool() -> Executor:
+    global _preprocess_pool
+    if _preprocess_pool is None:
+        if PREPROCESS_EXECUTOR == "process":
+            _preprocess_pool = ProcessPoolExecutor(max_workers=PREPROCESS_WORKERS)
+        else:
+            _preprocess_pool = ThreadPoolExecutor(max_workers=PREPROCESS_WORKERS, thread_name_prefix="preprocess")
+    return _preprocess_pool
+
+def shutdown_preprocess_pool() -> None:
+    global _preprocess_pool
+    if _preprocess_pool is not None:
+        _preprocess_pool.shutdown(wait=False, cancel_futures=True)
+        _preprocess_pool = None
+
+async def run_in_preprocess_pool(func, *args):
+    # PIL releases the GIL while decoding, resampling and encoding, so threads scale across cores
+    return await asyncio.get_running_loop().run_in_executor(get_preprocess_pool(), func, *args)
+
+async def decode_in_preprocess_pool(func, image_data: bytes, *args):
+    """run_in_preprocess_pool for functions that decode an upload, with decode failures as client errors.
+
+    The header check cannot see a truncated or corrupt body, so PIL only
+    fails once the pixels are decoded; that is the client's file, not a 500.
+    """
+    try:
+        return await run_in_preprocess_pool(func, image_data, *args)
+    except Image.DecompressionBombError:
+        raise HTTPException(status_code=413, detail=f"Image has too many pixels (max {MAX_IMAGE_PIXELS})")
+    except OSError as e:
+        raise HTTPException(status_code=400, detail=f"Corrupt or truncated image file: {e}")
+
+# step 15: perf(postprocess): array-backed score filtering, class-aware NMS and counting
+NMS_IOU_THRESHOLD = float(os.getenv("NMS_IOU_THRESHOLD", "0.6"))
+MAX_DETECTIONS = int(os.getenv("MAX_DETECTIONS", "300"))
+MAX_DETECTIONS_LIMIT = 5000
+
+def box_coordinates(box: Any) -> Tuple[float, float, float, float]:
+    if not isinstance(box, dict):
+        return (0.0, 0.0, 0.0, 0.0)
+    return (box.get("xmin", 0), box.get("ymin", 0), box.get("xmax", 0), box.get("ymax", 0))
+
+def non_max_suppression(
+    boxes: "np.ndarray",
+    scores: "np.ndarray",
+    class_ids: "np.ndarray",
+    iou_threshold: float,
+    max_detections: int,
+    metric: str = "iou",
+) -> "np.ndarray":
+    """Greedy per-class NMS; returns the indices kept, highest score first.
+
+    Each class is shifted into its own coordinate range, so boxes of
+    different classes never overlap and one pass handles every class.
+    Each iteration keeps the best remaining box and drops every remaining
+    box that overlaps it by more than iou_threshold, all in array ops.
+    With metric="ios" the overlap is intersection over the smaller box,
+    which also catches a partial box lying inside a complete one.
+    """
+    order = np.argsort(-scores, kind="stable")
+    if iou_threshold >= 1.0 or len(order) == 0:
+        return order[:max_detections]
+    
+    span = boxes.max() - boxes.min() + 1
+    shifted = boxes + (class_ids * span)[:, None]
+    x1, y1, x2, y2 = shifted.T
+    areas = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    keep = []
+    while order.size and len(keep) < max_detections:
+        best, rest = order[0], order[1:]
+        keep.append(best)
+        inter_w = np.clip(np.minimum(x2[best], x2[rest]) - np.maximum(x1[best], x1[rest]), 0, None)
+        inter_h = np.clip(np.minimum(y2[best], y2[rest]) - np.maximum(y1[best], y1[rest]), 0, None)
+        intersection = inter_w * inter_h
+        if metric == "ios":
+            denominator = np.minimum(areas[best], areas[rest])
+        else:
+            denominator = areas[best] + areas[rest] - intersection
+        overlap = intersection / np.maximum(denominator, 1e-9)
+        order = rest[overlap <= iou_threshold]
+    return np.asarray(keep, dtype=np.intp)
+
+def filter_detections(
+    detections: List[Dict[str, Any]],
+    threshold: float = DETECTION_THRESHOLD,
+    iou_threshold: float = NMS_IOU_THRESHOLD,
+    max_detections: int = MAX_DETECTIONS,
+) -> Dict[str, Any]:
+    valid = [detection for detection in detections if isinstance(detection, dict)]
+    scores = np.fromiter((detection.get("score", 0) or 0 for detection in valid), dtype=np.float64, count=len(valid))
+    candidates = np.flatnonzero(scores > threshold)
+    
+    label_ids: Dict[str, int] = {}
+    class_ids = np.fromiter(
+        (label_ids.setdefault(valid[i].get("label", "unknown"), len(label_ids)) for i in candidates),
+        dtype=np.intp, count=len(candidates)
+    )
+    boxes = np.array([box_coordinates(valid[i].get("box")) for i in candidates], dtype=np.float64).reshape(-1, 4)
+    kept = non_max_suppression(boxes, scores[candidates], class_ids, iou_threshold, max_detections)
+    
+    labels = list(label_ids)
+    kept_classes = class_ids[kept]
+    counts = np.bincount(kept_classes, minlength=len(labels))
+    # labels in the order they first appear among the kept boxes, best score first
+    object_counts = {labels[class_id]: int(counts[class_id]) for class_id in dict.fromkeys(kept_classes.tolist())}
+    filtered_detections = []
+    for index in kept.tolist():
+        detection = valid[candidates[index]]
+        filtered_detections.append({
+            "label": labels[class_ids[index]],
+            "confidence": round(float(scores[candidates[index]]), 3),
+            "box": detection.get("box", {})
+        })
+    
+    total_objects = len(filtered_detections)
+    return {
+        "success": True,
+        "total_objects": total_objects,
+        "detections": filtered_detections,
+        "object_counts": object_counts,
+        "summary": f"Found {total_objects} objects with {len(object_counts)} different types"
+    }
+
+class PostprocessOptions:
+    """Per-request post-processing thresholds, read from the query string."""
+
+    def __init__(
+        self,
+        # detectors already drop everything at or below DETECTION_THRESHOLD, so a lower cutoff could not bring it back
+        score_threshold: float = Query(DETECTION_THRESHOLD, ge=DETECTION_THRESHOLD, le=1.0,
+                                       description=f"Drop detections scoring at or below this (min {DETECTION_THRESHOLD})"),
+        iou_threshold: float = Query(NMS_IOU_THRESHOLD, gt=0.0, le=1.0, description="Suppress same-label boxes overlapping more than this; 1 disables NMS"),
+        max_detections: int = Query(MAX_DETECTIONS, ge=1, le=MAX_DETECTIONS_LIMIT),
+    ):
+        self.score_threshold = score_threshold
+        self.iou_threshold = iou_threshold
+        self.max_detections = max_detections
+
+    def apply(self, detections: List[Dict[str, Any]]) -> Dict[str, Any]:
+        return filter_detections(detections, self.score_threshold, self.iou_threshold, self.max_detections)
+
+def postprocess(detections: List[Dict[str, Any]], options: Optional[PostprocessOptions] = None) -> Dict[str, Any]:
+    with timed_stage("postprocess"):
+        if options is None:
+            return filter_detections(detections)
+        return options.apply(detections)
+
+# step 16: feat(tiling): overlapping-tile detection for high-resolution shelf photos
+TILE_SIZE = int(os.getenv("TILE_SIZE", "800"))
+TILE_OVERLAP = float(os.getenv("TILE_OVERLAP", "0.2"))
+MAX_TILES = int(os.getenv("MAX_TILES", "48"))
+TILE_CONCURRENCY = int(os.getenv("TILE_CONCURRENCY", "4"))
+TILE_MERGE_THRESHOLD = float(os.getenv("TILE_MERGE_THRESHOLD", "0.6"))
+
+class TilingOptions:
+    """Per-request tiling switch and geometry, read from the query string."""
+
+    def __init__(
+        self,
+        tiled: bool = Query(False, description="Detect on overlapping tiles of the full-resolution image"),
+        tile_size: int = Query(TILE_SIZE, ge=256, le=MAX_IMAGE_SIZE),
+        tile_overlap: float = Query(TILE_OVERLAP, ge=0.0, le=0.5),
+    ):
+        self.tiled = tiled
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+
+    @property
+    def cache_variant(self) -> str:
+        return f"tiled:{self.tile_size}:{self.tile_overlap}:{MAX_TILES}"
+
+def tile_origins(length: int, tile_size: int, stride: int) -> List[int]:
+    # spread the tiles evenly so the last one ends flush with the far edge and every overlap is at least tile_size - stride
+    if length <= tile_size:
+        return [0]
+    count = math.ceil((length - tile_size) / stride) + 1
+    return [round(i * (length - tile_size) / (count - 1)) for i in range(count)]
+
+def tile_grid(width: int, height: int, tile_size: int, overlap: float) -> List[Tuple[int, int, int, int]]:
+    stride = max(1, int(tile_size * (1 - overlap)))
+    return [
+        (x0, y0, min(width, x0 + tile_size), min(height, y0 + tile_size))
+        for y0 in tile_origins(height, tile_size, stride)
+        for x0 in tile_origins(width, tile_size, stride)
+    ]
+
+def prepare_tiles(
+    image_data: bytes,
+    tile_size: int = TILE_SIZE,
+    overlap: float = TILE_OVERLAP,
+    max_tiles: int = MAX_TILES,
+    use_draft: bool = PREPROCESS_DRAFT,
+    input_format: str = "jpeg",
+) -> Tuple[Dict[str, Any], List[Tuple[int, int, Any]], Dict[str, Any], Dict[str, float]]:
+    """Cut an upload into overlapping tiles of at most tile_size pixels.
+
+    The image is only downscaled when the full-resolution grid would need
+    more than max_tiles tiles. Returns the image info of the tiled image
+    (whose coordinates the merged boxes use), the (x0, y0, tile) tiles in
+    input_format, a payload report and per-stage seconds, like prepare_image.
+    """
+    start = time.perf_counter()
+    stage_seconds = {}
+    image = Image.open(io.BytesIO(image_data))
+    width, height = image.size
+    scale = 1.0
+    while scale > 0.05 and len(tile_grid(int(width * scale), int(height * scale), tile_size, overlap)) > max_tiles:
+        scale *= 0.9
+    target = (max(1, int(width * scale)), max(1, int(height * scale)))
+    if use_draft and scale < 1.0 and image.format == "JPEG":
+        image.draft("RGB", target)
+    image.load()
+    decoded = time.perf_counter()
+    stage_seconds["decode"] = decoded - start
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    if image.size != target:
+        image = image.resize(target, Image.Resampling.LANCZOS)
+    resized = time.perf_counter()
+    stage_seconds["resize"] = resized - decoded
+    
+    tiles = [(x0, y0, model_input(image.crop((x0, y0, x1, y1)), input_format)) for x0, y0, x1, y1 in tile_grid(*image.size, tile_size, overlap)]
+    stage_seconds["encode"] = time.perf_counter() - resized
+    
+    image_info = {
+        "size": image.size,
+        "mode": image.mode
+    }
+    payload_info = {
+        "format": UPSTREAM_PAYLOAD_FORMAT if input_format == "jpeg" else input_format,
+        "passthrough": False,
+        "bytes": sum(tile.nbytes if input_format == "pixels" else len(tile) for _, _, tile in tiles),
+        "encode_ms": round((time.perf_counter() - start) * 1000, 2),
+        "tiles": len(tiles)
+    }
+    return image_info, tiles, payload_info, stage_seconds
+
+def offset_detections(detections: List[Dict[str, Any]], x0: int, y0: int) -> List[Dict[str, Any]]:
+    shifted = []
+    for detection in detections:
+        if not isinstance(detection, dict):
+            continue
+        xmin, ymin, xmax, ymax = box_coordinates(detection.get("box"))
+        shifted.append({
+            **detection,
+            "box": {"xmin": xmin + x0, "ymin": ymin + y0, "xmax": xmax + x0, "ymax": ymax + y0}
+        })
+    return shifted
+
+def merge_tile_detections(detections: List[Dict[str, Any]], threshold: float = TILE_MERGE_THRESHOLD) -> List[Dict[str, Any]]:
+    """Collapse boxes reported by more than one tile into one.
+
+    An object in the overlap is seen whole by one tile and clipped by its
+    neighbour, so matching uses intersection over the smaller box; the
+    higher-scoring (usually the unclipped) box is kept.
+    """
+    if not detections:
+        return []
+    label_ids: Dict[str, int] = {}
+    class_ids = np.fromiter((label_ids.setdefault(d.get("label", "unknown"), len(label_ids)) for d in detections), dtype=np.intp, count=len(detections))
+    scores = np.fromiter((d.get("score", 0) or 0 for d in detections), dtype=np.float64, count=len(detections))
+    boxes = np.array([box_coordinates(d.get("box")) for d in detections], dtype=np.float64).reshape(-1, 4)
+    kept = non_max_suppression(boxes, scores, class_ids, threshold, len(detections), metric="ios")
+    return [detections[i] for i in kept.tolist()]
+
+async def detect_tiled(key: str, image_data: bytes, tiling: TilingOptions) -> Dict[str, Any]:
+    submitted = time.perf_counter()
+    image_info, tiles, payload_info, stage_seconds = await decode_in_preprocess_pool(
+        prepare_tiles, image_data, tiling.tile_size, tiling.tile_overlap, MAX_TILES, PREPROCESS_DRAFT, detector.input_format
+    )
+    for stage_name, seconds in stage_seconds.items():
+        record_stage(stage_name, seconds)
+    record_stage("preprocess_wait", max(0.0, time.perf_counter() - submitted - sum(stage_seconds.values())))
+    if detector.input_format == "jpeg":
+        UPSTREAM_PAYLOAD_BYTES.observe(payload_info["bytes"])
+    
+    outcome = {
+        "image_info": image_info,
+        "detections": None,
+        "error": None,
+        "cached": False,
+        "payload": payload_info
+    }
+    
+    semaphore = asyncio.Semaphore(TILE_CONCURRENCY)
+    
+    async def detect_tile(x0: int, y0: int, tile: Any) -> List[Dict[str, Any]]:
+        async with semaphore:
+            return offset_detections(await detector.detect(tile), x0, y0)
+    
+    tasks = [asyncio.create_task(detect_tile(x0, y0, tile)) for x0, y0, tile in tiles]
+    try:
+        tile_results = await asyncio.gather(*tasks)
+    except UpstreamError as e:
+        outcome["error"] = e
+        return outcome
+    finally:
+        for task in tasks:
+            task.cancel()
+    
+    with timed_stage("tile_merge"):
+        detections = merge_tile_detections([d for result in tile_results for d in result])
+    with timed_stage("cache_store"):
+        await detection_cache.set(key, {"image_info": image_info, "detections": detections})
+    outcome["detections"] = detections
+    return outcome
+
+# step 11: perf(upstream): coalesce identical in-flight detections
+class SingleFlight:
+    """Runs at most one task per key; concurrent callers with the same key share its result.
+
+    Callers await the shared task through asyncio.shield, so a client that
+    disconnects does not cancel the work the other callers are waiting on.
+    """
+
+    def __init__(self):
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self.coalesced = 0
+
+    async def run(self, key: str, factory):
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.create_task(factory())
+            self._tasks[key] = task
+            task.add_done_callback(lambda done: self._tasks.pop(key) if self._tasks.get(key) is done else None)
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def __len__(self) -> int:
+        return len(self._tasks)
+
+detection_flights = SingleFlight()
+
+# step 6: perf(upstream): one detection pipeline behind /detect and /analyze
+async def run_detection_pipeline(
+    image_data: bytes,
+    options: Optional[PostprocessOptions] = None,
+    tiling: Optional[TilingOptions] = None,
+    use_cache: bool = True,
+) -> Dict[str, Any]:
+    """Decode, resize and encode an upload, then run it through the detection API.
+
+    Results are looked up by image hash first, so a repeated upload skips the
+    preprocessing and the upstream round-trip, and concurrent uploads of the
+    same image share one upstream call. Upstream failures are returned under
+    "error" instead of raised, because /analyze still reports image_info
+    when detection fails while /detect turns the error into an HTTP status.
+    
+    Post-processing runs per caller on the raw detections, so coalesced
+    requests with different thresholds each get their own filtering.
+    With tiling.tiled the image is detected tile by tile at full
+    resolution instead, and cached under its own key. use_cache=False
+    skips the cache for images that will never be uploaded twice.
+    """
+    tiled = tiling is not None and tiling.tiled
+    with timed_stage("cache_lookup"):
+        image_hash = image_digest(image_data)
+        key = image_cache_key(image_hash, tiling.cache_variant if tiled else "")
+        cached = await detection_cache.get(key) if use_cache else None
+    if cached is not None:
+        shared = {
+            "image_info": cached["image_info"],
+            "detections": cached["detections"],
+            "error": None,
+            "cached": True,
+            "payload": None
+        }
+    else:
+        shared = await detection_flights.run(
+            key, lambda: detect_admitted(
+                lambda: detect_tiled(key, image_data, tiling) if tiled else detect_uncached(key, image_data, use_cache)
+            )
+        )
+    
+    outcome = {name: value for name, value in shared.items() if name != "detections"}
+    outcome["image_hash"] = image_hash
+    outcome["object_detection"] = postprocess(shared["detections"], options) if shared["error"] is None else None
+    return outcome
+
+async def detect_admitted(detect: Callable[[], Awaitable[Dict[str, Any]]]) -> Dict[str, Any]:
+    """Run one request's detection with a place held in the detector's queue.
+
+    Admission is decided here, once per request and before any CPU is
+    spent on preprocessing; a tiled request is admitted as a whole, and
+    its tiles queue behind it rather than each counting against the client.
+    """
+    try:
+        admission = detector.admit()
+    except QueueFullError as e:
+        return {"image_info": None, "detections": None, "error": e, "cached": False, "payload": None}
+    upstream_admission.set(admission)
+    try:
+        return await detect()
+    finally:
+        admission.release()
+
+async def detect_uncached(key: str, image_data: bytes, store: bool = True) -> Dict[str, Any]:
+    submitted = time.perf_counter()
+    image_info, detector_input, payload_info, stage_seconds = await decode_in_preprocess_pool(
+        prepare_image, image_data, PREPROCESS_DRAFT, UPSTREAM_PASSTHROUGH, detector.input_format
+    )
+    for stage_name, seconds in stage_seconds.items():
+        record_stage(stage_name, seconds)
+    # whatever the pool round-trip took beyond the stages themselves was spent waiting for a worker
+    record_stage("preprocess_wait", max(0.0, time.perf_counter() - submitted - sum(stage_seconds.values())))
+    if detector.input_format == "jpeg":
+        UPSTREAM_PAYLOAD_BYTES.observe(payload_info["bytes"])
+    
+    outcome = {
+        "image_info": image_info,
+        "detections": None,
+        "error": None,
+        "cached": False,
+        "payload": payload_info
+    }
+    
+    try:
+        detections = await detector.detect(detector_input)
+    except UpstreamError as e:
+        outcome["error"] = e
+        return outcome
+    
+    # raw detections are cached so the score filter can change without invalidating entries
+    if store:
+        with timed_stage("cache_store"):
+            await detection_cache.set(key, {"image_info": outcome["image_info"], "detections": detections})
+    outcome["detections"] = detections
+    return outcome
+
 # step 4: feat(routes): add /, /health, /ping, /detect, and /analyze endpoints
 @app.get("/")
 async def root():
@@ -84,7 +2296,12 @@ async def root():
         "endpoints": {
             "health": "/health",
             "object_detection": "/detect",
-            "full_analysis": "/analyze"
+            "batch_detection": "/detect/batch",
+            "live_counts": "/ws/live",
+            "history": "/history",
+            "full_analysis": "/analyze",
+            "analysis_jobs": "/analyze/jobs",
+            "metrics": "/metrics"
         }
     }
 
@@ -93,173 +2310,551 @@ async def health_check():
     return {
         "status": "healthy", 
         "services": ["object_detection"],
-        "huggingface_token": "configured" if HF_API_TOKEN else "not_configured"
+        "huggingface_token": "configured" if HF_API_TOKEN else "not_configured",
+        "cache": detection_cache.snapshot(),
+        "detector": detector.snapshot(),
+        "upstream_queue": upstream_scheduler.snapshot(),
+        "history": history_store.snapshot(),
+        "jobs": analysis_jobs.snapshot()
     }
 
+def upstream_http_exception(error: UpstreamError) -> HTTPException:
+    headers = None
+    if error.retry_after is not None:
+        headers = {"Retry-After": str(max(1, math.ceil(error.retry_after)))}
+    return HTTPException(status_code=error.status_code, detail=error.detail, headers=headers)
+
 @app.post("/detect")
-async def detect_objects(file: UploadFile = File(...)):
+async def detect_objects(
+    file: UploadFile = File(...),
+    options: PostprocessOptions = Depends(),
+    tiling: TilingOptions = Depends(),
+    output: ResponseOptions = Depends()
+):
     try:
-        if not file.content_type or not file.content_type.startswith("image/"):
-            raise HTTPException(status_code=400, detail="File must be an image")
-        
-        image_data = await file.read()
-        if not image_data:
-            raise HTTPException(status_code=400, detail="Empty image file")
-            
-        image = Image.open(io.BytesIO(image_data))
-        image = process_image(image)
+        image_data = await read_upload(file)
+        outcome = await run_detection_pipeline(image_data, options, tiling)
+        if outcome["error"] is not None:
+            raise upstream_http_exception(outcome["error"])
         
-        image_b64 = encode_image_to_base64(image)
-        
-        payload = {
-            "inputs": image_b64,
-            "parameters": {
-                "threshold": 0.3
-            }
-        }
-        
-        try:
-            response = requests.post(
-                OBJECT_DETECTION_URL,
-                headers=headers,
-                json=payload,
-                timeout=30
-            )
-        except requests.exceptions.RequestException as e:
-            raise HTTPException(status_code=500, detail=f"API request failed: {str(e)}")
-        
-        if response.status_code == 401:
-            raise HTTPException(
-                status_code=401, 
-                detail="HuggingFace API authentication failed. Check your API token."
-            )
-        elif response.status_code == 503:
-            raise HTTPException(
-                status_code=503, 
-                detail="Model is loading. Please try again in a few moments."
-            )
-        elif response.status_code == 429:
-            raise HTTPException(
-                status_code=429,
-                detail="Rate limit exceeded. Please wait and try again."
-            )
-        elif response.status_code != 200:
-            try:
-                error_data = response.json()
-                error_msg = error_data.get('error', f'Unknown error (Status {response.status_code})')
-            except:
-                error_msg = f'API error (Status {response.status_code}): {response.text}'
-            raise HTTPException(status_code=500, detail=error_msg)
-        
-        try:
-            detections = response.json()
-        except json.JSONDecodeError:
-            raise HTTPException(status_code=500, detail="Invalid JSON response from API")
-        
-        if isinstance(detections, dict) and "error" in detections:
-            if "loading" in detections["error"].lower():
-                raise HTTPException(status_code=503, detail="Model is loading. Please try again in a few moments.")
-            else:
-                raise HTTPException(status_code=500, detail=f"API Error: {detections['error']}")
-        
-        if not isinstance(detections, list):
-            raise HTTPException(status_code=500, detail="Unexpected response format from detection API")
-        
-        object_counts = {}
-        filtered_detections = []
-        
-        for detection in detections:
-            if isinstance(detection, dict) and detection.get("score", 0) > 0.3:
-                label = detection.get("label", "unknown")
-                object_counts[label] = object_counts.get(label, 0) + 1
-                filtered_detections.append({
-                    "label": label,
-                    "confidence": round(detection.get("score", 0), 3),
-                    "box": detection.get("box", {})
-                })
-        
-        total_objects = len(filtered_detections)
-        
-        return {
-            "success": True,
-            "total_objects": total_objects,
-            "detections": filtered_detections,
-            "object_counts": object_counts,
-            "summary": f"Found {total_objects} objects with {len(object_counts)} different types"
-        }
+        history_store.record("detect", file.filename, outcome)
+        return output.respond({**outcome["object_detection"], "cached": outcome["cached"], "payload": outcome["payload"]})
         
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Detection error: {str(e)}")
 
+def analysis_response(outcome: Dict[str, Any]) -> Dict[str, Any]:
+    results = {
+        "success": True,
+        "image_info": outcome["image_info"],
+        "cached": outcome["cached"],
+        "payload": outcome["payload"]
+    }
+    if outcome["error"] is not None:
+        results["object_detection"] = {"success": False, "error": outcome["error"].detail}
+    else:
+        results["object_detection"] = outcome["object_detection"]
+    return results
+
 @app.post("/analyze")
-async def full_analysis(file: UploadFile = File(...)):
+async def full_analysis(
+    file: UploadFile = File(...),
+    options: PostprocessOptions = Depends(),
+    tiling: TilingOptions = Depends(),
+    output: ResponseOptions = Depends()
+):
     try:
-        if not file.content_type or not file.content_type.startswith("image/"):
-            raise HTTPException(status_code=400, detail="File must be an image")
+        image_data = await read_upload(file)
+        outcome = await run_detection_pipeline(image_data, options, tiling)
+        if isinstance(outcome["error"], QueueFullError):
+            # shedding load is not an analysis result: clients need the status and Retry-After to back off
+            raise upstream_http_exception(outcome["error"])
+        history_store.record("analyze", file.filename, outcome)
+        return output.respond(analysis_response(outcome))
         
-        image_data = await file.read()
-        image = Image.open(io.BytesIO(image_data))
-        image = process_image(image)
-        
-        image_b64 = encode_image_to_base64(image)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Analysis error: {str(e)}")
+
+# step 8: feat(batch): stream per-image results for multi-file uploads as NDJSON
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "16"))
+
+async def detect_batch_item(
+    index: int,
+    file: UploadFile,
+    semaphore: asyncio.Semaphore,
+    options: PostprocessOptions,
+    tiling: Optional[TilingOptions] = None
+) -> Dict[str, Any]:
+    entry = {"type": "result", "index": index, "filename": file.filename}
+    async with semaphore:
+        try:
+            image_data = await read_upload(file)
+            outcome = await run_detection_pipeline(image_data, options, tiling)
+        except HTTPException as e:
+            return {**entry, "success": False, "status_code": e.status_code, "error": e.detail}
+        except Exception as e:
+            return {**entry, "success": False, "status_code": 500, "error": f"Detection error: {str(e)}"}
+    
+    if outcome["error"] is not None:
+        error = outcome["error"]
+        return {**entry, "success": False, "status_code": error.status_code, "error": error.detail, "retry_after": error.retry_after}
+    history_store.record("detect/batch", file.filename, outcome)
+    return {**entry, **outcome["object_detection"], "cached": outcome["cached"], "payload": outcome["payload"]}
+
+@app.post("/detect/batch")
+async def detect_batch(
+    files: List[UploadFile] = File(...),
+    concurrency: int = Query(BATCH_CONCURRENCY, ge=1, le=BATCH_MAX_CONCURRENCY),
+    options: PostprocessOptions = Depends(),
+    tiling: TilingOptions = Depends(),
+    output: ResponseOptions = Depends()
+):
+    """Run the detection pipeline over many uploads, streaming one NDJSON line per image.
+
+    Lines are written in completion order and carry the upload's "index";
+    a final "summary" line aggregates object_counts across the batch.
+    """
+    if len(files) > BATCH_MAX_FILES:
+        raise HTTPException(status_code=413, detail=f"Too many files in batch (max {BATCH_MAX_FILES})")
+    
+    async def stream_results():
+        semaphore = asyncio.Semaphore(concurrency)
+        tasks = [asyncio.create_task(detect_batch_item(i, f, semaphore, options, tiling)) for i, f in enumerate(files)]
+        object_counts = {}
+        succeeded = 0
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                result = await next_done
+                if result["success"]:
+                    succeeded += 1
+                    for label, count in result["object_counts"].items():
+                        object_counts[label] = object_counts.get(label, 0) + count
+                yield orjson.dumps(output.shape(result)) + b"\n"
+        finally:
+            # a client that disconnects mid-stream should not leave upstream calls running
+            for task in tasks:
+                task.cancel()
         
-        results = {
-            "success": True,
-            "image_info": {
-                "size": image.size,
-                "mode": image.mode
-            }
+        yield orjson.dumps(output.shape({
+            "type": "summary",
+            "total_images": len(files),
+            "succeeded": succeeded,
+            "failed": len(files) - succeeded,
+            "total_objects": sum(object_counts.values()),
+            "object_counts": object_counts
+        })) + b"\n"
+    
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+# step 19: feat(jobs): queued /analyze jobs with polling and Server-Sent Events progress
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "32"))
+JOB_RESULT_TTL = float(os.getenv("JOB_RESULT_TTL", "600"))
+JOB_MAX_STORED = int(os.getenv("JOB_MAX_STORED", "1000"))
+JOB_SSE_HEARTBEAT = float(os.getenv("JOB_SSE_HEARTBEAT", "15"))
+SHUTDOWN_DRAIN_SECONDS = float(os.getenv("SHUTDOWN_DRAIN_SECONDS", "20"))
+
+class AnalysisJob:
+    """One queued /analyze request and the progress events it has produced.
+
+    Events are kept in order with increasing ids, so a subscriber that
+    reconnects with Last-Event-ID resumes where it left off.
+    """
+
+    def __init__(self, image_data: bytes, filename: Optional[str], options: PostprocessOptions,
+                 tiling: TilingOptions, output: ResponseOptions, client_id: str):
+        self.id = uuid.uuid4().hex
+        self.image_data: Optional[bytes] = image_data
+        self.filename = filename
+        self.options = options
+        self.tiling = tiling
+        self.output = output
+        self.client_id = client_id
+        self.status = "queued"
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[Dict[str, Any]] = None
+        self.events: List[Dict[str, Any]] = []
+        self._changed = asyncio.Event()
+        self.emit("status", {"status": self.status})
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed")
+
+    def emit(self, event: str, data: Dict[str, Any]) -> None:
+        self.events.append({"id": len(self.events), "event": event, "data": data})
+        # wake every subscriber, then arm a fresh event for the next change
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def on_stage(self, name: str, seconds: float) -> None:
+        self.emit("stage", {"stage": name, "ms": round(seconds * 1000, 2)})
+
+    async def wait_for_events(self, after: int, timeout: float) -> bool:
+        if len(self.events) > after:
+            return True
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "stages": [event["data"] for event in self.events if event["event"] == "stage"],
+            "result": self.result,
+            "error": self.error
         }
-        
+
+class AnalysisJobManager:
+    """Runs /analyze jobs on a fixed number of worker tasks.
+
+    Submissions beyond the queue size are refused rather than buffered,
+    since every queued job holds its upload in memory. Finished jobs are
+    kept for result_ttl seconds, and at most max_stored jobs in total.
+    """
+
+    def __init__(self, workers: int = JOB_WORKERS, queue_size: int = JOB_QUEUE_SIZE,
+                 result_ttl: float = JOB_RESULT_TTL, max_stored: int = JOB_MAX_STORED):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.result_ttl = result_ttl
+        self.max_stored = max_stored
+        self._jobs: "OrderedDict[str, AnalysisJob]" = OrderedDict()
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self.draining = False
+        self.stats = {"submitted": 0, "rejected": 0, "completed": 0, "failed": 0, "expired": 0, "abandoned": 0}
+
+    async def start(self) -> None:
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self.draining = False
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def close(self, drain_timeout: float = 0.0) -> None:
+        """Stop taking jobs, let accepted ones finish for up to drain_timeout seconds, then cancel the rest."""
+        self.draining = True
+        if self._queue is not None and drain_timeout > 0:
+            try:
+                await asyncio.wait_for(self._queue.join(), drain_timeout)
+            except asyncio.TimeoutError:
+                pass
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self.stats["abandoned"] += sum(1 for job in self._jobs.values() if not job.finished)
+
+    def submit(self, job: AnalysisJob) -> None:
+        if self.draining:
+            self.stats["rejected"] += 1
+            raise HTTPException(status_code=503, detail="Server is shutting down, try again shortly", headers={"Retry-After": "5"})
+        self._expire()
+        if len(self._jobs) >= self.max_stored:
+            self.stats["rejected"] += 1
+            raise HTTPException(status_code=503, detail="Too many stored jobs, try again later", headers={"Retry-After": "5"})
         try:
-            detection_payload = {
-                "inputs": image_b64,
-                "parameters": {"threshold": 0.3}
-            }
-            
-            detection_response = requests.post(
-                OBJECT_DETECTION_URL,
-                headers=headers,
-                json=detection_payload,
-                timeout=30
-            )
-            
-            if detection_response.status_code == 200:
-                detections = detection_response.json()
-                if isinstance(detections, list):
-                    object_counts = {}
-                    filtered_detections = []
-                    
-                    for detection in detections:
-                        if isinstance(detection, dict) and detection.get("score", 0) > 0.3:
-                            label = detection.get("label", "unknown")
-                            object_counts[label] = object_counts.get(label, 0) + 1
-                            filtered_detections.append({
-                                "label": label,
-                                "confidence": round(detection.get("score", 0), 3),
-                                "box": detection.get("box", {})
-                            })
-                    
-                    results["object_detection"] = {
-                        "success": True,
-                        "total_objects": len(filtered_detections),
-                        "detections": filtered_detections,
-                        "object_counts": object_counts,
-                        "summary": f"Found {len(filtered_detections)} objects with {len(object_counts)} different types"
-                    }
-                else:
-                    results["object_detection"] = {"success": False, "error": "Invalid detection response"}
-            else:
-                results["object_detection"] = {"success": False, "error": f"Detection API error: {detection_response.status_code}"}
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self.stats["rejected"] += 1
+            raise HTTPException(status_code=503, detail="Job queue is full, try again later", headers={"Retry-After": "5"})
+        self._jobs[job.id] = job
+        self.stats["submitted"] += 1
+
+    def get(self, job_id: str) -> Optional[AnalysisJob]:
+        self._expire()
+        return self._jobs.get(job_id)
+
+    def _expire(self) -> None:
+        # jobs finish roughly in submission order, so expired ones collect at the front
+        now = time.time()
+        for job_id, job in list(self._jobs.items()):
+            if job.finished and now - job.finished_at > self.result_ttl:
+                del self._jobs[job_id]
+                self.stats["expired"] += 1
+            elif not job.finished:
+                break
+
+    async def _work(self) -> None:
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._run(job)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job: AnalysisJob) -> None:
+        job.status = "running"
+        job.emit("status", {"status": job.status})
+        client_token = current_client_id.set(job.client_id)
+        listener_token = stage_listener.set(job.on_stage)
+        try:
+            outcome = await run_detection_pipeline(job.image_data, job.options, job.tiling)
+            history_store.record("analyze", job.filename, outcome)
+            job.result = job.output.shape(analysis_response(outcome))
+            job.status = "done"
+            self.stats["completed"] += 1
         except Exception as e:
-            results["object_detection"] = {"success": False, "error": str(e)}
+            job.error = {"status_code": getattr(e, "status_code", 500), "detail": getattr(e, "detail", f"Analysis error: {str(e)}")}
+            job.status = "failed"
+            self.stats["failed"] += 1
+        finally:
+            stage_listener.reset(listener_token)
+            current_client_id.reset(client_token)
+            job.image_data = None
+            job.finished_at = time.time()
+        job.emit("result" if job.status == "done" else "error", job.result if job.status == "done" else job.error)
+        job.emit("status", {"status": job.status})
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            **self.stats,
+            "stored": len(self._jobs),
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "workers": self.workers,
+            "draining": self.draining
+        }
+
+analysis_jobs = AnalysisJobManager()
+
+def require_job(job_id: str) -> AnalysisJob:
+    job = analysis_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired")
+    return job
+
+@app.post("/analyze/jobs", status_code=202)
+async def submit_analysis_job(
+    file: UploadFile = File(...),
+    options: PostprocessOptions = Depends(),
+    tiling: TilingOptions = Depends(),
+    output: ResponseOptions = Depends()
+):
+    """Queue a full analysis and return at once; poll status_url or subscribe to events_url for the result."""
+    image_data = await read_upload(file)
+    job = AnalysisJob(image_data, file.filename, options, tiling, output, current_client_id.get())
+    analysis_jobs.submit(job)
+    return {
+        "job_id": job.id,
+        "status": job.status,
+        "status_url": f"/analyze/jobs/{job.id}",
+        "events_url": f"/analyze/jobs/{job.id}/events",
+        "expires_after_seconds": analysis_jobs.result_ttl
+    }
+
+@app.get("/analyze/jobs/{job_id}")
+async def get_analysis_job(job_id: str):
+    return ORJSONResponse(require_job(job_id).snapshot())
+
+@app.get("/analyze/jobs/{job_id}/events")
+async def analysis_job_events(job_id: str, request: Request):
+    """Stream the job's status, stage and result events as Server-Sent Events until it finishes."""
+    job = require_job(job_id)
+    last_event_id = request.headers.get("Last-Event-ID", "")
+    start = int(last_event_id) + 1 if last_event_id.isdigit() else 0
+    
+    async def stream_events():
+        position = start
+        while True:
+            while position < len(job.events):
+                event = job.events[position]
+                yield f"id: {event['id']}\nevent: {event['event']}\ndata: {orjson.dumps(event['data']).decode()}\n\n"
+                position += 1
+            if job.finished:
+                return
+            if not await job.wait_for_events(position, JOB_SSE_HEARTBEAT):
+                # a comment line keeps proxies from closing an idle stream
+                yield ": keep-alive\n\n"
+    
+    return StreamingResponse(stream_events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# step 17: feat(live): WebSocket live counting that only re-detects when the scene changes
+LIVE_DIFF_SIZE = int(os.getenv("LIVE_DIFF_SIZE", "64"))
+LIVE_PIXEL_DELTA = float(os.getenv("LIVE_PIXEL_DELTA", "0.1"))
+LIVE_CHANGE_THRESHOLD = float(os.getenv("LIVE_CHANGE_THRESHOLD", "0.001"))
+LIVE_MAX_REUSE_SECONDS = float(os.getenv("LIVE_MAX_REUSE_SECONDS", "30"))
+
+def frame_signature(image_data: bytes, size: int = LIVE_DIFF_SIZE) -> "np.ndarray":
+    """A size x size RGB thumbnail of a frame, with its mean removed so exposure drift does not count as change.
+
+    Color is kept because products often differ from the shelf in hue more than in brightness.
+    """
+    image = Image.open(io.BytesIO(image_data))
+    image.draft("RGB", (size * 4, size * 4))
+    thumbnail = np.asarray(image.convert("RGB").resize((size, size), Image.Resampling.BILINEAR), dtype=np.float32) / 255.0
+    return thumbnail - thumbnail.mean(axis=(0, 1))
+
+def frame_difference(signature: "np.ndarray", reference: "np.ndarray", pixel_delta: float = LIVE_PIXEL_DELTA) -> float:
+    # the share of thumbnail pixels that changed, so one moved item counts the same on a busy or an empty shelf
+    return float(np.mean(np.abs(signature - reference).max(axis=2) > pixel_delta))
+
+@app.websocket("/ws/live")
+async def live_counts(
+    websocket: WebSocket,
+    options: PostprocessOptions = Depends(),
+    output: ResponseOptions = Depends(),
+    min_change: float = Query(LIVE_CHANGE_THRESHOLD, ge=0.0, le=1.0)
+):
+    """Count objects in a stream of camera frames sent as binary image messages.
+
+    Only the newest frame waits while a detection runs: a frame arriving in
+    the meantime replaces it and is reported as dropped, so a slow detector
+    never builds a backlog. A frame where less than min_change of the
+    thumbnail differs from the last detected frame reuses that frame's result.
+    Every processed frame gets one JSON message back.
+    """
+    await websocket.accept()
+    current_client_id.set(client_identity(websocket))
+    pending = {"frame": None, "received": 0, "dropped": 0}
+    frame_ready = asyncio.Event()
+    
+    async def receive_frames():
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+            pending["received"] += 1
+            if pending["frame"] is not None:
+                pending["dropped"] += 1
+                LIVE_FRAMES.inc(outcome="dropped")
+            pending["frame"] = (pending["received"], message.get("bytes"), time.perf_counter())
+            frame_ready.set()
+    
+    async def process_frame(data: Optional[bytes], reference: Optional[Dict[str, Any]]) -> Tuple[Dict[str, Any], Optional[Dict[str, Any]]]:
+        if not data:
+            raise HTTPException(status_code=400, detail="Frames must be sent as binary image messages")
+        if len(data) > MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=413, detail=f"Frame too large (max {MAX_UPLOAD_BYTES} bytes)")
+        inspect_image_header(data)
+        with timed_stage("frame_diff"):
+            signature = await decode_in_preprocess_pool(frame_signature, data)
         
-        return results
+        difference = None if reference is None else frame_difference(signature, reference["signature"])
+        if difference is not None and difference < min_change and time.monotonic() - reference["detected_at"] < LIVE_MAX_REUSE_SECONDS:
+            LIVE_FRAMES.inc(outcome="reused")
+            return {"reused": True, "difference": round(difference, 4), **reference["object_detection"]}, reference
         
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Analysis error: {str(e)}")
+        # every frame is new bytes, so caching them would only evict useful entries
+        outcome = await run_detection_pipeline(data, options, use_cache=False)
+        if outcome["error"] is not None:
+            raise outcome["error"]
+        LIVE_FRAMES.inc(outcome="detected")
+        reference = {"signature": signature, "object_detection": outcome["object_detection"], "detected_at": time.monotonic()}
+        return {"reused": False, "difference": None if difference is None else round(difference, 4), **outcome["object_detection"]}, reference
+    
+    async def process_frames():
+        reference = None
+        while True:
+            await frame_ready.wait()
+            frame_ready.clear()
+            (index, data, received_at), pending["frame"] = pending["frame"], None
+            entry = {"type": "result", "frame": index, "dropped": pending["dropped"]}
+            pending["dropped"] = 0
+            try:
+                result, reference = await process_frame(data, reference)
+                entry.update(result)
+            except HTTPException as e:
+                LIVE_FRAMES.inc(outcome="error")
+                entry.update({"type": "error", "status_code": e.status_code, "error": e.detail})
+            except UpstreamError as e:
+                LIVE_FRAMES.inc(outcome="error")
+                entry.update({"type": "error", "status_code": e.status_code, "error": e.detail, "retry_after": e.retry_after})
+            except Exception as e:
+                LIVE_FRAMES.inc(outcome="error")
+                entry.update({"type": "error", "status_code": 500, "error": f"Detection error: {str(e)}"})
+            entry["latency_ms"] = round((time.perf_counter() - received_at) * 1000, 2)
+            await websocket.send_text(orjson.dumps(output.shape(entry)).decode())
+    
+    receiver = asyncio.create_task(receive_frames())
+    processor = asyncio.create_task(process_frames())
+    try:
+        await asyncio.wait([receiver, processor], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in (receiver, processor):
+            task.cancel()
+        # a send that failed because the client went away ends the session just like a disconnect
+        await asyncio.gather(receiver, processor, return_exceptions=True)
+
+def history_item(row: sqlite3.Row) -> Dict[str, Any]:
+    return {
+        "id": row["id"],
+        "created_at": row["created_at"],
+        "endpoint": row["endpoint"],
+        "filename": row["filename"],
+        "image_hash": row["image_hash"],
+        "image_size": [row["width"], row["height"]] if row["width"] is not None else None,
+        "total_objects": row["total_objects"],
+        "cached": bool(row["cached"]),
+        "object_counts": orjson.loads(row["object_counts"])
+    }
+
+def require_history() -> None:
+    if not history_store.enabled:
+        raise HTTPException(status_code=404, detail="Analysis history is disabled")
+
+@app.get("/history")
+async def list_history(
+    limit: int = Query(HISTORY_PAGE_SIZE, ge=1, le=HISTORY_MAX_PAGE_SIZE),
+    before_id: Optional[int] = Query(None, ge=1, description="Continue after this id, taken from next_before_id"),
+    since: Optional[float] = Query(None, description="Unix time, inclusive"),
+    until: Optional[float] = Query(None, description="Unix time, exclusive"),
+    label: Optional[str] = None,
+    image_hash: Optional[str] = None
+):
+    """Stored analyses, newest first. Results are written in batches, so the latest ones appear after a short delay."""
+    require_history()
+    rows = await history_store.page(limit, before_id, since, until, label, image_hash)
+    items = [history_item(row) for row in rows]
+    return {"items": items, "next_before_id": items[-1]["id"] if len(items) == limit else None}
+
+@app.get("/history/labels")
+async def history_label_totals(
+    since: float = Query(0.0, description="Unix time, inclusive"),
+    until: Optional[float] = Query(None, description="Unix time, exclusive; defaults to now"),
+    label: Optional[str] = None
+):
+    """Per-label analysis and object counts over a time range."""
+    require_history()
+    until = time.time() if until is None else until
+    if until <= since:
+        raise HTTPException(status_code=400, detail="until must be later than since")
+    labels = await history_store.label_totals(since, until, label)
+    return {
+        "since": since,
+        "until": until,
+        "total_objects": sum(entry["objects"] for entry in labels.values()),
+        "labels": labels
+    }
+
+@app.get("/history/{analysis_id}")
+async def get_history_entry(analysis_id: int, output: ResponseOptions = Depends()):
+    require_history()
+    rows = await history_store.query(
+        "SELECT id, created_at, endpoint, filename, image_hash, width, height, total_objects, cached, object_counts, detections"
+        " FROM analyses WHERE id = ?",
+        [analysis_id],
+    )
+    if not rows:
+        raise HTTPException(status_code=404, detail="Analysis not found")
+    detections = rows[0]["detections"]
+    return output.respond({**history_item(rows[0]), "detections": orjson.loads(detections) if detections is not None else None})
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
 
 # step 4: feat(routes): add /, /health, /ping, /detect, and /analyze endpoints
 # ---------- Local Development (NON-ACTIVE) ----------
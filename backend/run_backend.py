@@ -8,9 +8,11 @@ This script simplifies running the FastAPI backend server by:
 - Checking required Python dependencies
 - Loading environment variables from a .env file
 - Validating HuggingFace API token presence
-- Automatically launching the server using Uvicorn
+- Automatically launching the server using Uvicorn, or with `--production`
+  the multi-worker Gunicorn setup in gunicorn.conf.py (no auto-reload)
 
 Run this with: `python start.py`
+          or: `python run_backend.py --production`
 """
 
 import os
@@ -21,7 +23,7 @@ from pathlib import Path
 def check_requirements():
     """Check if all required packages are installed"""
     required_packages = [
-        'fastapi', 'uvicorn', 'requests', 'Pillow', 'python-multipart'
+        'fastapi', 'uvicorn', 'httpx', 'Pillow', 'python-multipart', 'numpy'
     ]
     
     missing_packages = []
@@ -67,8 +69,22 @@ def check_environment():
         print("   The demo will work but may have rate limits")
         print("   Get token from: https://huggingface.co/settings/tokens")
 
-def start_server():
+def start_server(production=False):
     """Start the FastAPI server"""
+    if production:
+        print("\n Starting InventoryLens AI Backend in production mode...")
+        print("   Workers: WEB_CONCURRENCY or one per CPU, see gunicorn.conf.py")
+        print("-" * 50)
+        try:
+            subprocess.run([sys.executable, '-m', 'gunicorn', 'main:app', '-c', 'gunicorn.conf.py'], check=True)
+        except KeyboardInterrupt:
+            print("\n Server stopped by user")
+        except subprocess.CalledProcessError as e:
+            print(f"\n❌ Server failed to start: {e}")
+            print("   Gunicorn needs Linux or macOS; install it with: pip install -r requirements.txt")
+            return False
+        return True
+    
     print("\n Starting InventoryLens AI Backend...")
     print("   Server will be available at: http://localhost:8000")
     print("   API Documentation: http://localhost:8000/docs")
@@ -110,7 +126,7 @@ def main():
     check_environment()
     
     # Start server
-    start_server()
+    start_server(production='--production' in sys.argv[1:])
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
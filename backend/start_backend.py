@@ -11,19 +11,47 @@ Key Functions:
 - Starts FastAPI application using Uvicorn server
 - Provides user-friendly error handling and setup instructions
 - Enables development mode with auto-reload functionality
+- With --production, runs one preforked worker per CPU under Gunicorn
+  (see gunicorn.conf.py) without the file watcher
 
 Usage:
     python start_backend.py
+    python start_backend.py --production [--workers N]
 
 Requirements:
     - FastAPI framework for API endpoints
     - Uvicorn ASGI server for serving the application
-    - Additional dependencies: pillow, python-multipart, requests, pydantic
+    - Additional dependencies: pillow, python-multipart, httpx, pydantic
 """
+import argparse
 import sys
 import os
 
+def start_production(current_dir, workers=None):
+    """Replace this process with Gunicorn, or with multi-worker Uvicorn where Gunicorn is unavailable."""
+    if workers:
+        os.environ["WEB_CONCURRENCY"] = str(workers)
+    os.chdir(current_dir)
+    try:
+        import gunicorn  # noqa: F401
+    except ImportError:
+        # Gunicorn does not run on Windows; Uvicorn's own supervisor has no preloading but still forks workers
+        workers = os.environ.setdefault("WEB_CONCURRENCY", str(os.cpu_count() or 1))
+        print(f" Gunicorn not installed, starting {workers} Uvicorn workers")
+        os.execv(sys.executable, [
+            sys.executable, "-m", "uvicorn", "main:app",
+            "--host", "0.0.0.0", "--port", os.getenv("PORT", "8000"),
+            "--workers", workers, "--timeout-keep-alive", "75", "--no-access-log",
+        ])
+    os.execv(sys.executable, [sys.executable, "-m", "gunicorn", "main:app", "-c", "gunicorn.conf.py"])
+
 def main():
+    parser = argparse.ArgumentParser(description="Start the InventoryLens AI backend")
+    parser.add_argument("--production", action="store_true",
+                        help="multiple workers, no auto-reload, graceful shutdown")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: one per CPU)")
+    args = parser.parse_args()
+    
     print("🚀 Starting InventoryLens AI Backend...")
     print("=" * 50)
     
@@ -31,6 +59,9 @@ def main():
     current_dir = os.path.dirname(os.path.abspath(__file__))
     sys.path.insert(0, current_dir)
     
+    if args.production:
+        start_production(current_dir, args.workers)
+    
     try:
         
         import uvicorn
@@ -53,7 +84,7 @@ def main():
     except ImportError as e:
         print(f"❌ Import error: {e}")
         print("🔧 Try installing missing packages:")
-        print("   pip install fastapi uvicorn pillow python-multipart requests pydantic")
+        print("   pip install fastapi uvicorn pillow python-multipart httpx pydantic")
         sys.exit(1)
     except Exception as e:
         print(f"❌ Error starting server: {e}")
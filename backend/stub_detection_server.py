@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+InventoryLens AI Stub Detection Server
+
+Purpose:
+---------
+Stands in for the HuggingFace facebook/detr-resnet-50 inference endpoint so the
+backend can be load-tested offline:
+- Accepts raw image bodies and the base64-in-JSON {"inputs": ...} body, and
+  like the transformers pipeline drops boxes scoring under
+  parameters.threshold, or under 0.9 when no threshold is sent
+- Answers with DETR-shaped detections ({"score", "label", "box"}) placed inside
+  the uploaded image's bounds; the same image always gets the same boxes
+- Simulates inference latency, a cold-start window of 503 "loading" answers
+  with estimated_time, 429s past a request rate, and random 500s
+
+Point the backend at it with
+    OBJECT_DETECTION_URL=http://127.0.0.1:9000/models/facebook/detr-resnet-50
+
+Run this with: `python stub_detection_server.py --port 9000 --latency-ms 300`
+"""
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import random
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+from PIL import Image
+
+# labels DETR commonly returns on shelf and desk photos
+LABELS = [
+    "bottle", "cup", "bowl", "book", "cell phone", "laptop", "keyboard", "mouse",
+    "banana", "apple", "orange", "vase", "potted plant", "scissors", "clock", "chair",
+]
+
+config = {
+    "latency_ms": 300.0,
+    "jitter_ms": 50.0,
+    "cold_start_seconds": 0.0,
+    "rate_limit_rps": 0.0,
+    "error_rate": 0.0,
+    "detections": 12,
+    "default_threshold": 0.9,
+}
+state = {"started": time.monotonic(), "tokens": 0.0, "updated": time.monotonic(), "requests": 0}
+
+app = FastAPI(title="InventoryLens stub detection server")
+
+def parse_request(body: bytes, content_type: str) -> tuple:
+    """The image bytes and the score threshold of one inference request."""
+    if content_type.startswith("application/json"):
+        payload = json.loads(body)
+        threshold = (payload.get("parameters") or {}).get("threshold", config["default_threshold"])
+        return base64.b64decode(payload["inputs"]), threshold
+    return body, config["default_threshold"]
+
+def take_rate_token() -> bool:
+    rate = config["rate_limit_rps"]
+    if rate <= 0:
+        return True
+    now = time.monotonic()
+    state["tokens"] = min(rate, state["tokens"] + (now - state["updated"]) * rate)
+    state["updated"] = now
+    if state["tokens"] >= 1:
+        state["tokens"] -= 1
+        return True
+    return False
+
+def fake_detections(image_data: bytes) -> list:
+    with Image.open(io.BytesIO(image_data)) as image:
+        width, height = image.size
+    # seeded by the image so repeated uploads see identical results, like the real model
+    rng = random.Random(hashlib.sha256(image_data).digest())
+    detections = []
+    for _ in range(config["detections"]):
+        box_w = rng.randint(max(1, width // 20), max(2, width // 4))
+        box_h = rng.randint(max(1, height // 20), max(2, height // 3))
+        xmin = rng.randint(0, max(0, width - box_w))
+        ymin = rng.randint(0, max(0, height - box_h))
+        detections.append({
+            "score": round(rng.uniform(0.2, 0.999), 4),
+            "label": rng.choice(LABELS),
+            "box": {"xmin": xmin, "ymin": ymin, "xmax": xmin + box_w, "ymax": ymin + box_h},
+        })
+    return detections
+
+@app.post("/{model_path:path}")
+async def detect(model_path: str, request: Request):
+    state["requests"] += 1
+    loading_left = config["cold_start_seconds"] - (time.monotonic() - state["started"])
+    if loading_left > 0:
+        return JSONResponse(status_code=503, content={
+            "error": f"Model {model_path} is currently loading",
+            "estimated_time": round(loading_left, 2),
+        })
+    if not take_rate_token():
+        return JSONResponse(status_code=429, headers={"Retry-After": "1"}, content={"error": "Rate limit reached. Please slow down."})
+    if random.random() < config["error_rate"]:
+        return JSONResponse(status_code=500, content={"error": "Internal inference error"})
+
+    body = await request.body()
+    try:
+        image_data, threshold = parse_request(body, request.headers.get("content-type", ""))
+        detections = [d for d in fake_detections(image_data) if d["score"] >= threshold]
+    except Exception as e:
+        return JSONResponse(status_code=400, content={"error": f"Could not read image: {e}"})
+
+    latency = max(0.0, random.gauss(config["latency_ms"], config["jitter_ms"])) / 1000
+    await asyncio.sleep(latency)
+    return detections
+
+@app.get("/health")
+async def health():
+    return {"status": "healthy", "requests": state["requests"], **config}
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub facebook/detr-resnet-50 inference server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency-ms", type=float, default=config["latency_ms"])
+    parser.add_argument("--jitter-ms", type=float, default=config["jitter_ms"])
+    parser.add_argument("--cold-start-seconds", type=float, default=config["cold_start_seconds"],
+                        help="answer 503 'loading' for this long after startup")
+    parser.add_argument("--rate-limit-rps", type=float, default=config["rate_limit_rps"],
+                        help="answer 429 past this many requests per second (0 = unlimited)")
+    parser.add_argument("--error-rate", type=float, default=config["error_rate"],
+                        help="fraction of requests answered with a 500")
+    parser.add_argument("--detections", type=int, default=config["detections"],
+                        help="candidate boxes generated per image, before the threshold")
+    parser.add_argument("--default-threshold", type=float, default=config["default_threshold"],
+                        help="score cutoff when the request carries no parameters.threshold")
+    args = parser.parse_args()
+
+    for key in config:
+        config[key] = getattr(args, key)
+    state["started"] = state["updated"] = time.monotonic()
+
+    import uvicorn
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# keep test runs from writing history or cache files into the working tree
+os.environ.setdefault("HISTORY_DB_PATH", "")
+os.environ.setdefault("DETECTION_CACHE_DIR", "")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,118 @@
+import asyncio
+import os
+
+import pytest
+
+import main
+
+
+class Clock:
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(main.time, "time", clock)
+    return clock
+
+
+def result(name):
+    return {"image_info": {"size": [10, 10], "mode": "RGB"}, "detections": [{"label": name, "score": 0.9}]}
+
+
+def test_memory_tier_evicts_the_least_recently_used_entry(clock):
+    cache = main.DetectionCache(max_entries=2, ttl=0, directory="")
+
+    async def run():
+        await cache.set("a", result("a"))
+        await cache.set("b", result("b"))
+        assert await cache.get("a") == result("a")
+        await cache.set("c", result("c"))
+        return [await cache.get(key) for key in ("a", "b", "c")]
+
+    assert asyncio.run(run()) == [result("a"), None, result("c")]
+    assert cache.stats["evictions"] == 1
+
+
+def test_entries_expire_after_the_ttl(clock):
+    cache = main.DetectionCache(max_entries=4, ttl=10, directory="")
+
+    async def run():
+        await cache.set("a", result("a"))
+        clock.now += 9
+        fresh = await cache.get("a")
+        clock.now += 2
+        return fresh, await cache.get("a")
+
+    assert asyncio.run(run()) == (result("a"), None)
+    assert cache.stats["expirations"] == 1
+    assert cache.snapshot()["entries"] == 0
+
+
+def test_disk_hits_are_promoted_and_survive_a_restart(clock, tmp_path):
+    cache = main.DetectionCache(max_entries=1, ttl=10, directory=str(tmp_path))
+
+    async def run():
+        await cache.set("a1", result("a"))
+        await cache.set("b1", result("b"))
+        promoted = await cache.get("a1")
+        in_memory = "a1" in cache._entries
+        restarted = main.DetectionCache(max_entries=1, ttl=10, directory=str(tmp_path))
+        from_disk = await restarted.get("b1")
+        clock.now += 11
+        return promoted, in_memory, from_disk, await restarted.get("a1")
+
+    promoted, in_memory, from_disk, expired = asyncio.run(run())
+    assert promoted == result("a") and in_memory
+    assert from_disk == result("b")
+    assert expired is None
+    assert cache.stats["disk_hits"] == 1
+    assert not cache._path("a1").exists()
+
+
+def write_entry(cache, key, written_at):
+    cache._disk_set(key, written_at, result(key))
+    os.utime(cache._path(key), (written_at, written_at))
+
+
+def test_sweep_deletes_expired_files_then_the_oldest_beyond_the_limit(clock, tmp_path):
+    cache = main.DetectionCache(ttl=100, directory=str(tmp_path), max_disk_entries=3)
+    for age, key in [(500, "e1"), (200, "e2"), (50, "f1"), (40, "f2"), (30, "f3"), (20, "f4")]:
+        write_entry(cache, key, clock.now - age)
+    stale_tmp, fresh_tmp = tmp_path / "e1" / "stale.tmp", tmp_path / "e1" / "fresh.tmp"
+    for path, age in ((stale_tmp, 120), (fresh_tmp, 5)):
+        path.write_text("{")
+        os.utime(path, (clock.now - age, clock.now - age))
+
+    assert cache._disk_sweep() == 3
+    assert sorted(path.stem for path in tmp_path.glob("*/*.json")) == ["f2", "f3", "f4"]
+    assert not stale_tmp.exists() and fresh_tmp.exists()
+
+
+def test_sweep_keeps_fresh_files_under_the_limit(clock, tmp_path):
+    cache = main.DetectionCache(ttl=100, directory=str(tmp_path), max_disk_entries=10)
+    for age, key in [(500, "e1"), (50, "f1"), (40, "f2")]:
+        write_entry(cache, key, clock.now - age)
+
+    assert cache._disk_sweep() == 1
+    assert sorted(path.stem for path in tmp_path.glob("*/*.json")) == ["f1", "f2"]
+
+
+def test_writes_sweep_at_most_once_per_interval(clock, tmp_path):
+    cache = main.DetectionCache(max_entries=8, ttl=0, directory=str(tmp_path), max_disk_entries=1, sweep_interval=300)
+
+    async def run():
+        await cache.set("a1", result("a"))
+        await cache.set("b1", result("b"))
+        await cache.set("c1", result("c"))
+
+    asyncio.run(run())
+    # the first write swept (nothing to delete yet); the next two fall inside the interval
+    assert cache.stats["disk_evictions"] == 0
+    assert len(list(tmp_path.glob("*/*.json"))) == 3
+    assert cache._disk_sweep() == 2
@@ -0,0 +1,88 @@
+import asyncio
+import io
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+from PIL import Image
+
+import main
+
+
+@pytest.fixture(scope="module")
+def stand_in_model(tmp_path_factory):
+    pytest.importorskip("onnx")
+    pytest.importorskip("onnxruntime")
+    import benchmark
+
+    return benchmark.make_stand_in_detr(str(tmp_path_factory.mktemp("stand-in-detr")))
+
+
+def shelf_pixels(width, height, seed):
+    return np.random.default_rng(seed).integers(0, 256, (height, width, 3), dtype=np.uint8)
+
+
+def test_detector_backends_must_implement_detect():
+    class Incomplete(main.Detector):
+        pass
+
+    with pytest.raises(TypeError):
+        Incomplete("incomplete")
+
+
+def test_boxes_do_not_depend_on_batch_companions_without_pixel_mask(stand_in_model):
+    detector = main.OnnxDetector(stand_in_model, input_size=256)
+
+    async def run():
+        await detector.start()
+        try:
+            assert "pixel_mask" not in detector._input_names
+            small = main.prepare_model_input(shelf_pixels(160, 96, seed=1), detector.input_size)
+            large = main.prepare_model_input(shelf_pixels(512, 384, seed=2), detector.input_size)
+            alone = detector._forward([small])[0][0]
+            batched = detector._forward([small, large])[0][0]
+            return alone, batched
+        finally:
+            await detector.close()
+
+    alone, batched = asyncio.run(run())
+    assert alone
+    assert alone == batched
+    for detection in alone:
+        box = detection["box"]
+        assert 0 <= box["xmin"] <= box["xmax"] <= 160 and 0 <= box["ymin"] <= box["ymax"] <= 96
+
+
+def test_local_backend_gets_decoded_pixels_not_jpeg(stand_in_model, monkeypatch):
+    detector = main.OnnxDetector(stand_in_model, input_size=256)
+    received = []
+    original_detect = detector.detect
+
+    async def detect(image, *args, **kwargs):
+        received.append(image)
+        return await original_detect(image, *args, **kwargs)
+
+    monkeypatch.setattr(detector, "detect", detect)
+    monkeypatch.setattr(main, "detector", detector)
+    buffered = io.BytesIO()
+    Image.new("RGB", (640, 480), (90, 120, 60)).save(buffered, format="JPEG")
+
+    # the lifespan loads the model and closes it on the same event loop
+    with TestClient(main.app) as client:
+        response = client.post("/detect", files={"file": ("shelf.jpg", buffered.getvalue(), "image/jpeg")})
+    assert response.status_code == 200
+    assert response.json()["payload"]["format"] == "pixels"
+    assert isinstance(received[-1], np.ndarray) and received[-1].shape == (480, 640, 3)
+
+
+def test_a_burst_is_bounded_by_the_local_queue_size(stand_in_model, monkeypatch):
+    from test_upstream import distinct_jpegs, post_concurrently, track_peak_pending
+
+    detector = main.OnnxDetector(stand_in_model, input_size=256, queue_size=3)
+    monkeypatch.setattr(main, "detector", detector)
+    peak = track_peak_pending(monkeypatch, detector.batcher, lambda: detector.batcher.snapshot()["pending"])
+    statuses = post_concurrently("/detect", distinct_jpegs(30), cleanup=detector.close)
+
+    assert set(statuses) == {200, 503}
+    assert peak["pending"] <= 3
+    assert detector.batcher.snapshot()["pending"] == 0
@@ -0,0 +1,137 @@
+import asyncio
+import io
+import threading
+import time
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+from PIL import Image
+
+import main
+
+
+def noise_jpeg():
+    buffered = io.BytesIO()
+    Image.effect_noise((320, 240), 64).convert("RGB").save(buffered, format="JPEG")
+    return buffered.getvalue()
+
+
+@pytest.fixture
+def gate(monkeypatch):
+    """A mocked upstream that answers only once the gate is opened."""
+    gate = threading.Event()
+
+    async def upstream(request):
+        await asyncio.to_thread(gate.wait, 10)
+        return httpx.Response(200, json=[{"score": 0.9, "label": "cup", "box": {"xmin": 1, "ymin": 1, "xmax": 9, "ymax": 9}}])
+
+    monkeypatch.setattr(main.detector, "_client", httpx.AsyncClient(transport=httpx.MockTransport(upstream)))
+    yield gate
+    gate.set()
+
+
+@pytest.fixture
+def jobs(monkeypatch):
+    def install(**settings):
+        manager = main.AnalysisJobManager(**{"workers": 1, "queue_size": 4, **settings})
+        monkeypatch.setattr(main, "analysis_jobs", manager)
+        return manager
+    return install
+
+
+def submit(client):
+    response = client.post("/analyze/jobs", files={"file": ("shelf.jpg", noise_jpeg(), "image/jpeg")})
+    assert response.status_code == 202, response.text
+    return response.json()["job_id"]
+
+
+def wait_for_status(client, job_id, *statuses):
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        snapshot = client.get(f"/analyze/jobs/{job_id}").json()
+        if snapshot["status"] in statuses:
+            return snapshot
+        time.sleep(0.02)
+    raise AssertionError(f"job {job_id} never reached {statuses}")
+
+
+def parse_sse(text):
+    events = []
+    for block in text.strip().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines() if not line.startswith(":"))
+        if fields:
+            events.append((int(fields["id"]), fields["event"]))
+    return events
+
+
+def test_submitted_job_can_be_polled_to_its_result(jobs, gate):
+    jobs()
+    gate.set()
+    with TestClient(main.app) as client:
+        job_id = submit(client)
+        snapshot = wait_for_status(client, job_id, "done")
+    assert snapshot["error"] is None
+    assert snapshot["result"]["object_detection"]["object_counts"] == {"cup": 1}
+    assert any(stage["stage"] == "upstream" for stage in snapshot["stages"])
+
+
+def test_full_job_queue_is_refused_with_retry_after(jobs, gate):
+    manager = jobs(queue_size=1)
+    with TestClient(main.app) as client:
+        running = submit(client)
+        wait_for_status(client, running, "running")
+        queued = submit(client)
+        response = client.post("/analyze/jobs", files={"file": ("shelf.jpg", noise_jpeg(), "image/jpeg")})
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "5"
+        gate.set()
+        wait_for_status(client, queued, "done")
+    assert manager.stats["rejected"] == 1 and manager.stats["completed"] == 2
+
+
+def test_finished_jobs_expire_after_the_ttl(jobs, gate):
+    manager = jobs(result_ttl=0.2)
+    gate.set()
+    with TestClient(main.app) as client:
+        job_id = submit(client)
+        wait_for_status(client, job_id, "done")
+        time.sleep(0.3)
+        assert client.get(f"/analyze/jobs/{job_id}").status_code == 404
+    assert manager.stats["expired"] == 1
+
+
+def test_close_drains_accepted_jobs_and_refuses_new_ones(jobs, gate):
+    manager = jobs()
+    with TestClient(main.app) as client:
+        job_ids = [submit(client), submit(client)]
+        wait_for_status(client, job_ids[0], "running")
+        # the lifespan's shutdown drains the queue; open the gate while it waits
+        threading.Timer(0.2, gate.set).start()
+    assert manager.draining
+    assert manager.stats["completed"] == 2 and manager.stats["abandoned"] == 0
+    with pytest.raises(main.HTTPException) as refused:
+        manager.submit(main.AnalysisJob(noise_jpeg(), "late.jpg", None, None, None, "anonymous"))
+    assert refused.value.status_code == 503
+
+
+def test_close_abandons_jobs_still_running_after_the_drain_timeout(jobs, gate, monkeypatch):
+    manager = jobs()
+    monkeypatch.setattr(main, "SHUTDOWN_DRAIN_SECONDS", 0.1)
+    with TestClient(main.app) as client:
+        job_id = submit(client)
+        wait_for_status(client, job_id, "running")
+    assert manager.stats["abandoned"] == 1 and manager.stats["completed"] == 0
+
+
+def test_event_stream_resumes_after_last_event_id(jobs, gate):
+    jobs()
+    with TestClient(main.app) as client:
+        job_id = submit(client)
+        threading.Timer(0.2, gate.set).start()
+        # subscribed before the job finishes, the stream runs until the final status
+        live = parse_sse(client.get(f"/analyze/jobs/{job_id}/events").text)
+        resumed = parse_sse(client.get(f"/analyze/jobs/{job_id}/events", headers={"Last-Event-ID": str(live[2][0])}).text)
+    assert [event_id for event_id, _ in live] == list(range(len(live)))
+    assert live[0][1] == "status" and live[-2][1] == "result" and live[-1][1] == "status"
+    assert resumed == live[3:]
@@ -0,0 +1,132 @@
+import asyncio
+
+from fastapi.testclient import TestClient
+
+import main
+
+
+def detection(label, score, xmin, ymin, xmax, ymax):
+    return {"label": label, "score": score, "box": {"xmin": xmin, "ymin": ymin, "xmax": xmax, "ymax": ymax}}
+
+
+def kept(result):
+    return [(d["label"], d["confidence"]) for d in result["detections"]]
+
+
+def test_nms_suppresses_overlapping_boxes_of_the_same_label():
+    detections = [
+        detection("bottle", 0.9, 0, 0, 100, 100),
+        detection("bottle", 0.8, 5, 5, 105, 105),
+        detection("bottle", 0.7, 300, 0, 400, 100),
+    ]
+    result = main.filter_detections(detections, iou_threshold=0.6)
+    assert kept(result) == [("bottle", 0.9), ("bottle", 0.7)]
+    assert result["object_counts"] == {"bottle": 2}
+
+
+def test_nms_keeps_overlapping_boxes_of_different_labels():
+    detections = [detection("bottle", 0.9, 0, 0, 100, 100), detection("cup", 0.8, 5, 5, 105, 105)]
+    result = main.filter_detections(detections, iou_threshold=0.6)
+    assert kept(result) == [("bottle", 0.9), ("cup", 0.8)]
+    assert result["object_counts"] == {"bottle": 1, "cup": 1}
+
+
+def test_iou_threshold_of_one_disables_nms():
+    detections = [detection("bottle", 0.8, 0, 0, 100, 100), detection("bottle", 0.9, 0, 0, 100, 100)]
+    result = main.filter_detections(detections, iou_threshold=1.0)
+    assert kept(result) == [("bottle", 0.9), ("bottle", 0.8)]
+
+
+def test_max_detections_keeps_the_best_scores():
+    detections = [detection("can", 0.4 + i / 100, i * 200, 0, i * 200 + 100, 100) for i in range(10)]
+    result = main.filter_detections(detections, max_detections=3)
+    assert kept(result) == [("can", 0.49), ("can", 0.48), ("can", 0.47)]
+    assert result["total_objects"] == 3
+
+
+def test_score_threshold_drops_boxes_at_or_below_it():
+    detections = [detection("jar", 0.5, 0, 0, 10, 10), detection("jar", 0.3, 50, 0, 60, 10), "not a detection"]
+    assert kept(main.filter_detections(detections, threshold=0.3)) == [("jar", 0.5)]
+    assert kept(main.filter_detections(detections, threshold=0.5)) == []
+
+
+def test_score_threshold_cannot_go_below_what_detectors_return():
+    response = TestClient(main.app).post("/detect?score_threshold=0.1", files={"file": ("shelf.jpg", b"", "image/jpeg")})
+    assert response.status_code == 422
+
+
+def test_merge_tile_detections_keeps_the_whole_box_over_the_clipped_one():
+    whole = detection("box", 0.9, 700, 100, 900, 300)
+    clipped = detection("box", 0.6, 700, 100, 800, 300)
+    neighbour = detection("box", 0.8, 1000, 100, 1200, 300)
+    other_label = detection("book", 0.7, 700, 100, 800, 300)
+    assert main.merge_tile_detections([clipped, neighbour, whole, other_label]) == [whole, neighbour, other_label]
+    assert main.merge_tile_detections([]) == []
+
+
+def test_label_totals_combine_hourly_rollups_with_the_ragged_ends(tmp_path):
+    hour = main.HISTORY_ROLLUP_SECONDS
+    start = 1000 * hour
+    entries = [
+        (start - 10, {"bottle": 2}),
+        (start + 100, {"bottle": 3, "cup": 1}),
+        (start + hour + 50, {"cup": 4}),
+        (start + 2 * hour + 10, {"bottle": 1}),
+        (start + 2 * hour + 500, {"bottle": 7}),
+    ]
+    batch = [(created_at, "detect", None, "hash", 10, 10, sum(counts.values()), 0, counts, None) for created_at, counts in entries]
+
+    def expected(since, until, label=None):
+        totals = {}
+        for created_at, counts in entries:
+            for name, count in counts.items():
+                if since <= created_at < until and label in (None, name):
+                    entry = totals.setdefault(name, {"analyses": 0, "objects": 0})
+                    entry["analyses"] += 1
+                    entry["objects"] += count
+        return totals
+
+    async def run():
+        store = main.HistoryStore(str(tmp_path / "history.sqlite3"))
+        await store.start()
+        try:
+            await asyncio.get_running_loop().run_in_executor(store._executor, store._write, batch)
+            ranges = [
+                (start - 100, start + 2 * hour + 100, None),
+                (start - 100, start + 2 * hour + 100, "cup"),
+                (start + 50, start + 2 * hour + 100, None),
+                (start + hour + 10, start + hour + 100, None),
+                (start - hour, start + 3 * hour, None),
+            ]
+            for since, until, label in ranges:
+                assert await store.label_totals(since, until, label) == expected(since, until, label), (since, until, label)
+        finally:
+            await store.close()
+
+    asyncio.run(run())
+
+
+def test_history_counters_are_updated_on_the_event_loop_not_the_writer_thread(tmp_path):
+    outcome = {"error": None, "image_hash": "0" * 64, "image_info": {"size": (800, 600)}, "cached": False,
+               "object_detection": {"total_objects": 1, "object_counts": {"cup": 1}, "detections": []}}
+
+    async def run():
+        store = main.HistoryStore(str(tmp_path / "history.sqlite3"), flush_interval=0.01)
+        await store.start()
+        seconds = await asyncio.get_running_loop().run_in_executor(
+            store._executor, store._write, [(1.0, "detect", None, "hash", 1, 1, 1, 0, {"cup": 1}, None)]
+        )
+        untouched = dict(store.stats)
+        for _ in range(5):
+            store.record("detect", "shelf.jpg", outcome)
+        await asyncio.sleep(0.1)
+        for _ in range(3):
+            store.record("detect", "shelf.jpg", outcome)
+        # records still being collected or queued at close are written and counted exactly once
+        await store.close()
+        return seconds, untouched, store.stats
+
+    seconds, untouched, stats = asyncio.run(run())
+    assert isinstance(seconds, float)
+    assert untouched["written"] == 0 and untouched["batches"] == 0
+    assert stats["written"] == 8 and stats["failed"] == 0
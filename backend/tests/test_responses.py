@@ -0,0 +1,148 @@
+import asyncio
+import gzip
+import io
+import json
+import zlib
+
+import httpx
+from PIL import Image
+from starlette.responses import StreamingResponse
+
+import main
+
+
+def run_asgi(app, path="/", accept_encoding="gzip", method="GET", headers=(), body=b""):
+    """Call app directly and return the response start message and each body chunk as it was sent."""
+    sent = []
+    request = [{"type": "http.request", "body": body, "more_body": False}]
+
+    async def receive():
+        if request:
+            return request.pop()
+        # a client that stays connected until the response ends
+        await asyncio.Event().wait()
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": method, "scheme": "http",
+        "path": path, "raw_path": path.encode(), "query_string": b"", "root_path": "",
+        "client": ("127.0.0.1", 5000), "server": ("test", 80),
+        "headers": [(b"accept-encoding", accept_encoding.encode()), *headers],
+    }
+    asyncio.run(app(scope, receive, send))
+    start = next(message for message in sent if message["type"] == "http.response.start")
+    chunks = [message.get("body", b"") for message in sent if message["type"] == "http.response.body"]
+    return httpx.Headers(start["headers"]), chunks
+
+
+def test_small_bodies_pass_through_uncompressed():
+    app = main.GZipMiddleware(main.ORJSONResponse({"status": "ok"}), minimum_size=1024)
+    headers, chunks = run_asgi(app)
+    assert "content-encoding" not in headers
+    assert b"".join(chunks) == b'{"status":"ok"}'
+    assert headers["content-length"] == str(len(b"".join(chunks)))
+
+
+def test_large_json_bodies_are_gzipped_with_the_compressed_length():
+    content = {"detections": [{"label": "bottle", "confidence": 0.9, "box": {"xmin": i, "ymin": i}} for i in range(200)]}
+    app = main.GZipMiddleware(main.ORJSONResponse(content), minimum_size=1024)
+    headers, chunks = run_asgi(app, accept_encoding="br, gzip")
+    body = b"".join(chunks)
+    assert headers["content-encoding"] == "gzip"
+    assert headers["vary"] == "Accept-Encoding"
+    assert headers["content-length"] == str(len(body))
+    assert json.loads(gzip.decompress(body)) == content
+
+
+def test_refused_gzip_is_not_sent():
+    content = {"text": "x" * 4096}
+    for accept_encoding in ("gzip;q=0", "gzip; q=0.0, identity", "identity", ""):
+        headers, chunks = run_asgi(main.GZipMiddleware(main.ORJSONResponse(content)), accept_encoding=accept_encoding)
+        assert "content-encoding" not in headers, accept_encoding
+        assert json.loads(b"".join(chunks)) == content
+    assert main.accepts_gzip("gzip;q=0.5") and main.accepts_gzip("*") and not main.accepts_gzip("*;q=0")
+
+
+def test_event_streams_are_never_compressed():
+    events = [b"id: %d\nevent: stage\ndata: {}\n\n" % i for i in range(3)]
+
+    async def stream():
+        for event in events:
+            yield event
+
+    app = main.GZipMiddleware(StreamingResponse(stream(), media_type="text/event-stream"), minimum_size=0)
+    headers, chunks = run_asgi(app)
+    assert "content-encoding" not in headers
+    assert [chunk for chunk in chunks if chunk] == events
+
+
+def distinct_jpeg():
+    buffered = io.BytesIO()
+    Image.effect_noise((320, 240), 64).convert("RGB").save(buffered, format="JPEG")
+    return buffered.getvalue()
+
+
+def test_each_batch_line_decompresses_as_it_arrives(monkeypatch):
+    def upstream(request):
+        return httpx.Response(200, json=[{"score": 0.9, "label": "cup", "box": {"xmin": 1, "ymin": 1, "xmax": 9, "ymax": 9}}])
+
+    monkeypatch.setattr(main.detector, "_client", httpx.AsyncClient(transport=httpx.MockTransport(upstream)))
+    request = httpx.Request("POST", "http://test/detect/batch",
+                            files=[("files", (f"{i}.jpg", distinct_jpeg(), "image/jpeg")) for i in range(3)])
+    headers, chunks = run_asgi(main.app, path="/detect/batch", method="POST", body=request.read(),
+                               headers=[(key.encode(), value.encode()) for key, value in request.headers.items()])
+
+    assert headers["content-encoding"] == "gzip"
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    lines = []
+    chunks = [chunk for chunk in chunks if chunk]
+    # every line is flushed as it is sent, so each chunk decodes to whole lines without waiting for
+    # the next one; the last chunk only carries the gzip trailer
+    for chunk in chunks[:-1]:
+        decoded = decompressor.decompress(chunk)
+        assert decoded.count(b"\n") == 1 and decoded.endswith(b"\n")
+        lines.append(json.loads(decoded))
+    assert decompressor.decompress(chunks[-1]) == b"" and decompressor.eof
+    assert sorted(line["index"] for line in lines[:-1]) == [0, 1, 2]
+    assert lines[-1]["type"] == "summary" and lines[-1]["object_counts"] == {"cup": 3}
+
+
+def test_parse_fields_builds_a_selection_tree():
+    assert main.parse_fields("total_objects,object_detection.object_counts") == {
+        "total_objects": None, "object_detection": {"object_counts": None}
+    }
+    # a whole-value selection wins over a nested one, whichever comes first
+    assert main.parse_fields("image_info,image_info.size") == {"image_info": None}
+    assert main.parse_fields("image_info.size,image_info") == {"image_info": None}
+    assert main.parse_fields(" a , ,b.") == {"a": None, "b": None}
+
+
+def test_select_fields_keeps_requested_paths_and_the_always_selected_keys():
+    content = {
+        "type": "result", "index": 4, "success": True, "filename": "shelf.jpg",
+        "image_info": {"size": [800, 600], "mode": "RGB"},
+        "object_detection": {"total_objects": 2, "object_counts": {"cup": 2}, "detections": [{}, {}]},
+    }
+    tree = main.parse_fields("image_info.size,object_detection.object_counts,filename.name,missing")
+    assert main.select_fields(content, tree) == {
+        "type": "result", "index": 4, "success": True, "filename": "shelf.jpg",
+        "image_info": {"size": [800, 600]},
+        "object_detection": {"object_counts": {"cup": 2}},
+    }
+
+
+def test_compact_detections_index_labels_in_first_seen_order():
+    detections = [
+        {"label": "cup", "confidence": 0.9, "box": {"xmin": 1, "ymin": 2, "xmax": 3, "ymax": 4}},
+        {"label": "bottle", "confidence": 0.8, "box": {"xmin": 5, "ymin": 6, "xmax": 7, "ymax": 8}},
+        {"label": "cup", "confidence": 0.7},
+        {"confidence": 0.6, "box": {"xmin": 0, "ymin": 0, "xmax": 1, "ymax": 1}},
+    ]
+    assert main.compact_detections(detections) == {
+        "fields": ["label", "confidence", "xmin", "ymin", "xmax", "ymax"],
+        "labels": ["cup", "bottle", "unknown"],
+        "rows": [[0, 0.9, 1, 2, 3, 4], [1, 0.8, 5, 6, 7, 8], [0, 0.7, None, None, None, None], [2, 0.6, 0, 0, 1, 1]],
+    }
+    assert main.compact_detections([]) == {"fields": main.COMPACT_DETECTION_FIELDS, "labels": [], "rows": []}
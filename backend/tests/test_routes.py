@@ -0,0 +1,83 @@
+import argparse
+import asyncio
+import io
+
+import pytest
+from fastapi.testclient import TestClient
+from PIL import Image
+from starlette.requests import Request
+
+import main
+
+
+def jpeg_bytes(size=(320, 240)):
+    buffered = io.BytesIO()
+    Image.new("RGB", size, (90, 120, 60)).save(buffered, format="JPEG")
+    return buffered.getvalue()
+
+
+def request_from(forwarded_for=None, peer="10.0.0.2"):
+    headers = [(b"x-forwarded-for", forwarded_for.encode())] if forwarded_for else []
+    return Request({"type": "http", "headers": headers, "client": (peer, 5000)})
+
+
+def test_client_identity_uses_the_hop_our_proxy_appended(monkeypatch):
+    monkeypatch.setattr(main, "TRUSTED_PROXY_HOPS", 1)
+    assert main.client_identity(request_from("6.6.6.6, 203.0.113.7")) == "203.0.113.7"
+    assert main.client_identity(request_from("203.0.113.7")) == "203.0.113.7"
+    assert main.client_identity(request_from()) == "10.0.0.2"
+
+
+def test_client_identity_counts_trusted_hops_from_the_right(monkeypatch):
+    monkeypatch.setattr(main, "TRUSTED_PROXY_HOPS", 2)
+    assert main.client_identity(request_from("6.6.6.6, 203.0.113.7, 10.1.1.1")) == "203.0.113.7"
+    assert main.client_identity(request_from("203.0.113.7")) == "203.0.113.7"
+    monkeypatch.setattr(main, "TRUSTED_PROXY_HOPS", 0)
+    assert main.client_identity(request_from("6.6.6.6")) == "10.0.0.2"
+
+
+def test_analyze_sheds_load_with_retry_after(monkeypatch):
+    def queue_full():
+        raise main.QueueFullError(503, "Detection queue is full. Please try again later.", 2.5)
+
+    monkeypatch.setattr(main.detector, "admit", queue_full)
+    response = TestClient(main.app).post("/analyze", files={"file": ("shelf.jpg", jpeg_bytes(), "image/jpeg")})
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "3"
+
+
+def truncated_jpeg():
+    buffered = io.BytesIO()
+    Image.effect_noise((1200, 900), 48).convert("RGB").save(buffered, format="JPEG")
+    data = buffered.getvalue()
+    return data[:len(data) // 2]
+
+
+def test_truncated_upload_is_a_client_error():
+    client = TestClient(main.app)
+    for path in ("/detect", "/analyze", "/detect?tiled=true"):
+        response = client.post(path, files={"file": ("shelf.jpg", truncated_jpeg(), "image/jpeg")})
+        assert response.status_code == 400, path
+        assert "truncated" in response.json()["detail"]
+
+
+def test_oversized_uploads_are_refused_without_buffering(monkeypatch, tmp_path):
+    # the uploads benchmark, scaled down: bodies are streamed, so they must be cut off at the limit
+    benchmark = pytest.importorskip("benchmark")
+    monkeypatch.setattr(main, "upstream_scheduler", main.upstream_scheduler)
+    monkeypatch.setattr(main.detector, "_client", main.detector._client)
+    args = argparse.Namespace(concurrency=4, oversized_mb=40, corpus_dir=str(tmp_path))
+    statuses, peak_delta_mb = asyncio.run(benchmark.drive_uploads(args))
+    assert statuses[:4] == [413] * 4
+    assert statuses[4:] == [200] * 4
+    assert peak_delta_mb < 60
+
+
+def test_unmatched_paths_share_one_metrics_label():
+    client = TestClient(main.app)
+    assert client.get("/wp-login-7f3a.php").status_code == 404
+    assert client.get("/analyze/jobs/does-not-exist").status_code == 404
+    metrics = client.get("/metrics").text
+    assert 'path="unmatched"' in metrics
+    assert "wp-login" not in metrics
+    assert 'path="/analyze/jobs/{job_id}"' in metrics
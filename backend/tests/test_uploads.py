@@ -0,0 +1,69 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import main
+
+BOUNDARY = b"inventorylens-test"
+
+
+def batch_chunks(file_count, chunk_size=None):
+    """A multipart body, one chunk per part plus the closing delimiter, or cut into chunk_size pieces."""
+    parts = [
+        b"--" + BOUNDARY + b"\r\nContent-Disposition: form-data; name=\"files\"; filename=\"%d.jpg\"\r\n"
+        b"Content-Type: image/jpeg\r\n\r\n" % i + b"x" * 64 + b"\r\n"
+        for i in range(file_count)
+    ]
+    chunks = parts + [b"--" + BOUNDARY + b"--\r\n"]
+    if chunk_size:
+        body = b"".join(chunks)
+        chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)]
+    return chunks
+
+
+def feed(chunks, max_batch_files):
+    """Run UploadLimitMiddleware over chunks; returns how many chunks were read and the 413, if any."""
+    read = 0
+
+    async def receive():
+        nonlocal read
+        read += 1
+        return {"type": "http.request", "body": chunks[read - 1], "more_body": read < len(chunks)}
+
+    async def app(scope, receive, send):
+        while (await receive()).get("more_body"):
+            pass
+
+    scope = {
+        "type": "http", "method": "POST", "path": "/detect/batch",
+        "headers": [(b"content-type", b"multipart/form-data; boundary=" + BOUNDARY)],
+    }
+    middleware = main.UploadLimitMiddleware(app, max_batch_files=max_batch_files)
+    try:
+        asyncio.run(middleware(scope, receive, None))
+    except HTTPException as e:
+        return read, e
+    return read, None
+
+
+def test_batch_at_the_file_limit_is_read_to_the_end():
+    chunks = batch_chunks(2)
+    assert feed(chunks, max_batch_files=2) == (len(chunks), None)
+
+
+def test_batch_is_refused_on_the_chunk_that_opens_one_part_too_many():
+    read, error = feed(batch_chunks(3), max_batch_files=2)
+    assert read == 3
+    assert error.status_code == 413 and "max 2" in error.detail
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 23])
+def test_delimiters_split_across_chunks_are_counted_once(chunk_size):
+    assert feed(batch_chunks(2, chunk_size), max_batch_files=2)[1] is None
+    chunks = batch_chunks(3, chunk_size)
+    read, error = feed(chunks, max_batch_files=2)
+    assert error is not None
+    # the third part's delimiter is complete by the time the refusal comes, its content is not
+    third_part_starts = sum(len(part) for part in batch_chunks(2)[:2])
+    assert third_part_starts < read * chunk_size < third_part_starts + len(b"--" + BOUNDARY + b"\r\n") + chunk_size
@@ -0,0 +1,140 @@
+import argparse
+import asyncio
+import io
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+from PIL import Image
+
+import main
+import stub_detection_server as stub
+
+
+def shelf_jpeg():
+    buffered = io.BytesIO()
+    Image.new("RGB", (640, 480), (90, 120, 60)).save(buffered, format="JPEG")
+    return buffered.getvalue()
+
+
+def detect_against_stub(payload_format):
+    stub.config.update(latency_ms=0.0, jitter_ms=0.0, detections=60)
+    client = main.DetectionClient("http://stub/models/facebook/detr-resnet-50", {}, payload_format=payload_format)
+
+    async def run():
+        client._client = httpx.AsyncClient(transport=httpx.ASGITransport(app=stub.app))
+        try:
+            return await client.detect(shelf_jpeg())
+        finally:
+            await client.close()
+
+    return asyncio.run(run())
+
+
+def test_default_payload_sends_the_detection_threshold():
+    assert main.UPSTREAM_PAYLOAD_FORMAT == "json"
+    body = main.DetectionClient("http://stub", {}).build_request_body(b"jpeg")
+    assert body["json"]["parameters"]["threshold"] == main.DETECTION_THRESHOLD
+
+
+def test_json_payload_keeps_boxes_below_the_api_default_threshold():
+    scores = [d["score"] for d in detect_against_stub("json")]
+    assert min(scores) >= main.DETECTION_THRESHOLD
+    assert any(score < stub.config["default_threshold"] for score in scores)
+
+
+def test_binary_payload_gets_the_api_default_threshold():
+    scores = [d["score"] for d in detect_against_stub("binary")]
+    assert scores and min(scores) >= stub.config["default_threshold"]
+
+
+def test_tiled_request_is_admitted_once_not_per_tile(monkeypatch):
+    # one token up front and a per-client share smaller than the tile fan-out
+    monkeypatch.setattr(main, "upstream_scheduler", main.UpstreamScheduler(rate=200, burst=1, max_per_client=2))
+    monkeypatch.setattr(main.detector, "_client", httpx.AsyncClient(transport=httpx.MockTransport(lambda request: httpx.Response(200, json=[]))))
+    buffered = io.BytesIO()
+    Image.new("RGB", (2400, 1600), (90, 120, 60)).save(buffered, format="JPEG")
+
+    response = TestClient(main.app).post("/detect?tiled=true", files={"file": ("shelf.jpg", buffered.getvalue(), "image/jpeg")})
+    assert response.status_code == 200
+    assert main.upstream_scheduler.stats["rejected"] == 0
+    assert main.upstream_scheduler.stats["admitted"] > main.TILE_CONCURRENCY
+
+
+def test_unadmitted_calls_still_respect_the_client_share():
+    scheduler = main.UpstreamScheduler(rate=200, burst=1, max_per_client=2)
+
+    async def run():
+        return await asyncio.gather(*[scheduler.acquire("shop") for _ in range(5)], return_exceptions=True)
+
+    errors = [result for result in asyncio.run(run()) if result is not None]
+    assert len(errors) == 2
+    assert all(isinstance(error, main.QueueFullError) and error.status_code == 429 for error in errors)
+
+
+def distinct_jpegs(count):
+    images = []
+    for i in range(count):
+        buffered = io.BytesIO()
+        # noise, so no two uploads coalesce or hit the cache
+        Image.effect_noise((320, 240), 64).convert("RGB").save(buffered, format="JPEG")
+        images.append(buffered.getvalue())
+    return images
+
+
+def post_concurrently(path, images, cleanup=None):
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://test") as client:
+            async def upload(image):
+                return (await client.post(path, files={"file": ("shelf.jpg", image, "image/jpeg")}, timeout=None)).status_code
+            try:
+                return await asyncio.gather(*[upload(image) for image in images])
+            finally:
+                if cleanup is not None:
+                    await cleanup()
+
+    return asyncio.run(run())
+
+
+def track_peak_pending(monkeypatch, limiter, pending):
+    peak = {"pending": 0}
+    reserve = limiter.reserve
+
+    def tracked(*args):
+        reserve(*args)
+        peak["pending"] = max(peak["pending"], pending())
+
+    monkeypatch.setattr(limiter, "reserve", tracked)
+    return peak
+
+
+def test_a_burst_of_uploads_is_bounded_by_the_queue_size(monkeypatch):
+    scheduler = main.UpstreamScheduler(rate=5, burst=1, max_queue=5, max_per_client=100)
+    monkeypatch.setattr(main, "upstream_scheduler", scheduler)
+    peak = track_peak_pending(monkeypatch, scheduler, lambda: scheduler.snapshot()["pending"])
+    peak["depth"] = 0
+
+    def upstream(request):
+        peak["depth"] = max(peak["depth"], scheduler.queue_depth)
+        return httpx.Response(200, json=[])
+
+    monkeypatch.setattr(main.detector, "_client", httpx.AsyncClient(transport=httpx.MockTransport(upstream)))
+    statuses = post_concurrently("/detect", distinct_jpegs(40))
+
+    assert set(statuses) == {200, 503}
+    assert peak["pending"] <= 5 and peak["depth"] <= 5
+    assert scheduler.stats["rejected"] == statuses.count(503)
+    assert scheduler.snapshot()["pending"] == 0
+
+
+def test_tiling_benchmark_reads_the_default_json_payload(monkeypatch):
+    benchmark = pytest.importorskip("benchmark")
+    for name in ("upstream_scheduler", "detection_cache"):
+        monkeypatch.setattr(main, name, getattr(main, name))
+    monkeypatch.setattr(main.detector, "_client", main.detector._client)
+    args = argparse.Namespace(width=1600, height=400, item_px=60, min_object_px=24, latency_ms=0.0,
+                              tile_sizes=[800], overlaps=[0.2])
+    truth, reports = asyncio.run(benchmark.drive_tiling(args))
+    tiled = reports[-1]
+    assert tiled["upstream_calls"] > 1
+    assert tiled["recall"] == 1.0